@@ -1,10 +1,300 @@
 """该文件定义了一个API封装类，可以将Python代码封装为API形式，以实现远程调用"""
 
+import gzip
+import io
+import json
+import threading
+import time
 import warnings
+import wave
+from collections import OrderedDict
+from bisect import bisect_left
 from datetime import datetime, timezone, timedelta
+from functools import wraps
 
-from flask import Flask
-from werkzeug.exceptions import HTTPException
+from flask import Flask, Request, Response, request, make_response
+from werkzeug.exceptions import HTTPException, ServiceUnavailable, GatewayTimeout, BadRequest, Conflict
+
+try:
+    import msgpack  # 可选，用于支持MessagePack格式的请求与响应
+except ImportError:
+    msgpack = None
+try:
+    import zstandard  # 可选，用于支持zstd压缩
+except ImportError:
+    zstandard = None
+try:
+    from pydub import AudioSegment  # 可选，用于将音频编码为mp3或ogg(opus)，需安装ffmpeg
+except ImportError:
+    AudioSegment = None
+
+audioMimeTypes = {"wav": "audio/wav", "mp3": "audio/mpeg", "ogg": "audio/ogg"}  # 支持的音频格式
+
+
+def encodeAudio(samples, sampleRate: int, audioFormat: str = "wav", bitrate: str = None, targetRate: int = None) -> bytes:
+    """
+    将单声道的音频采样编码为指定格式
+    :param samples: np.ndarray 音频采样，int16或取值-1~1的浮点数
+    :param sampleRate: int 采样率
+    :param audioFormat: str "wav"、"mp3"或"ogg"(opus编码)
+    :param bitrate: str 目标码率，如"32k"，仅对mp3与ogg有效
+    :param targetRate: int 目标采样率，为None时保持不变(opus仅支持8k/12k/16k/24k/48k，其余采样率由ffmpeg重采样至48k)
+    :return: bytes 编码后的音频文件内容
+    """
+    if audioFormat not in audioMimeTypes:
+        raise ValueError(f"Unsupported audio format: {audioFormat}")
+    if samples.dtype.kind == "f":
+        samples = (samples.clip(-1, 1) * 32767).astype("int16")
+    pcm = samples.astype("<i2").tobytes()
+    buffer = io.BytesIO()
+    if audioFormat == "wav" and not targetRate:
+        with wave.open(buffer, "wb") as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(sampleRate)
+            file.writeframes(pcm)
+        return buffer.getvalue()
+    if AudioSegment is None:
+        raise ImportError("Encoding mp3/ogg audio requires 'pydub' and ffmpeg.")
+    segment = AudioSegment(data=pcm, sample_width=2, frame_rate=sampleRate, channels=1)
+    parameters = ["-ar", str(targetRate)] if targetRate else []
+    if audioFormat == "ogg":
+        segment.export(buffer, format="ogg", codec="libopus", bitrate=bitrate, parameters=parameters)
+    else:
+        segment.export(buffer, format=audioFormat, bitrate=bitrate, parameters=parameters)
+    return buffer.getvalue()
+
+
+class NegotiatedRequest(Request):
+    """
+    支持内容协商的请求类：get_json()可以解析经gzip/zstd压缩(Content-Encoding)的请求体，
+    以及MessagePack格式(Content-Type: application/msgpack)的请求体，对处理函数透明
+    """
+
+    def get_json(self, force: bool = False, silent: bool = False, cache: bool = True):
+        encoding = self.headers.get("Content-Encoding", "").lower()
+        if encoding not in ("gzip", "zstd") and self.mimetype != "application/msgpack":
+            return super().get_json(force=force, silent=silent, cache=cache)
+        try:
+            data = self.get_data(cache=cache)
+            if encoding == "gzip":
+                data = gzip.decompress(data)
+            elif encoding == "zstd":
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+            if self.mimetype == "application/msgpack":
+                return msgpack.unpackb(data)
+            return json.loads(data)
+        except Exception:
+            if silent:
+                return None
+            raise BadRequest("Failed to decode request body.")
+
+
+class RouteMetrics:
+    """
+    记录各路由的请求数、状态码、延迟分布、请求/响应大小与并发数，并以Prometheus文本格式导出
+
+    注意：在serve()的多进程模式下，每个worker进程各自统计
+    """
+    latencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)  # 延迟直方图的桶(秒)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # {(route, status): count}
+        self.latency = {}  # {route: [bucket_counts..., +Inf count, sum]}
+        self.requestBytes = {}  # {route: total}
+        self.responseBytes = {}  # {route: total}
+        self.inFlight = {}  # {route: current}
+
+    def start(self, route: str):
+        """
+        记录一次请求开始
+        :param route: str 路由地址
+        :return: None
+        """
+        with self._lock:
+            self.inFlight[route] = self.inFlight.get(route, 0) + 1
+
+    def finish(self, route: str, status: int, seconds: float, requestSize: int, responseSize: int):
+        """
+        记录一次请求结束
+        :param route: str 路由地址
+        :param status: int HTTP状态码
+        :param seconds: float 处理耗时(秒)
+        :param requestSize: int 请求体大小(字节)
+        :param responseSize: int 响应体大小(字节)，流式响应无法提前得知大小，记为0
+        :return: None
+        """
+        with self._lock:
+            self.inFlight[route] -= 1
+            self.requests[(route, status)] = self.requests.get((route, status), 0) + 1
+            histogram = self.latency.setdefault(route, [0] * (len(self.latencyBuckets) + 1) + [0.0])
+            histogram[bisect_left(self.latencyBuckets, seconds)] += 1
+            histogram[-1] += seconds
+            self.requestBytes[route] = self.requestBytes.get(route, 0) + requestSize
+            self.responseBytes[route] = self.responseBytes.get(route, 0) + responseSize
+
+    def totalInFlight(self) -> int:
+        """
+        返回当前正在处理的请求总数
+        :return: int
+        """
+        with self._lock:
+            return sum(self.inFlight.values())
+
+    def export(self) -> str:
+        """
+        以Prometheus文本格式导出全部指标
+        :return: str
+        """
+        lines = [
+            "# HELP api_requests_total Total number of requests by route and status code.",
+            "# TYPE api_requests_total counter"
+        ]
+        with self._lock:
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append(f'api_requests_total{{route="{route}",status="{status}"}} {count}')
+            lines += [
+                "# HELP api_request_duration_seconds Request latency by route.",
+                "# TYPE api_request_duration_seconds histogram"
+            ]
+            for route, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(self.latencyBuckets + ("+Inf",), histogram[:-1]):
+                    cumulative += count
+                    lines.append(f'api_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+                lines.append(f'api_request_duration_seconds_sum{{route="{route}"}} {histogram[-1]}')
+                lines.append(f'api_request_duration_seconds_count{{route="{route}"}} {cumulative}')
+            for name, values, helpText in (
+                    ("api_request_bytes_total", self.requestBytes, "Total request body size by route."),
+                    ("api_response_bytes_total", self.responseBytes, "Total response body size by route.")
+            ):
+                lines += [f"# HELP {name} {helpText}", f"# TYPE {name} counter"]
+                lines += [f'{name}{{route="{route}"}} {value}' for route, value in sorted(values.items())]
+            lines += [
+                "# HELP api_requests_in_flight Requests currently being processed by route.",
+                "# TYPE api_requests_in_flight gauge"
+            ]
+            lines += [
+                f'api_requests_in_flight{{route="{route}"}} {value}' for route, value in sorted(self.inFlight.items())
+            ]
+        return "\n".join(lines) + "\n"
+
+
+class RouteLimiter:
+    """
+    单个路由的准入控制：限制同时处理的请求数，超出部分进入有界的等待队列，队列已满或等待超时则立即拒绝(503)
+    """
+
+    def __init__(self, maxConcurrency: int, maxQueue: int = 0, queueTimeout: float = None, retryAfter: int = 1):
+        """
+        :param maxConcurrency: int 同时处理的最大请求数
+        :param maxQueue: int 等待队列的最大长度，为0时超出并发数的请求将直接被拒绝
+        :param queueTimeout: float 在队列中等待的最长时间(秒)，为None时仅受客户端截止时间约束
+        :param retryAfter: int 拒绝请求时，通过Retry-After头建议客户端的重试间隔(秒)
+        """
+        self.maxConcurrency = maxConcurrency
+        self.maxQueue = maxQueue
+        self.queueTimeout = queueTimeout
+        self.retryAfter = retryAfter
+        self.active = 0  # 正在处理的请求数
+        self.waiting = 0  # 正在排队的请求数
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline: float = None):
+        """
+        申请处理名额，失败时抛出对应的HTTPException
+        :param deadline: float 客户端给出的截止时间(Unix时间戳)，超过后即使获得名额也没有意义
+        :return: None
+        """
+        with self._condition:
+            if self.active < self.maxConcurrency:
+                self.active += 1
+                return
+            if self.waiting >= self.maxQueue:
+                raise ServiceUnavailable("Server is overloaded, please retry later.", retry_after=self.retryAfter)
+            timeout = self.queueTimeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            self.waiting += 1
+            try:
+                acquired = self._condition.wait_for(lambda: self.active < self.maxConcurrency, timeout)
+            finally:
+                self.waiting -= 1
+            if not acquired:
+                if deadline is not None and time.time() >= deadline:
+                    raise GatewayTimeout("Request deadline exceeded while waiting in queue.")
+                raise ServiceUnavailable("Server is overloaded, please retry later.", retry_after=self.retryAfter)
+            self.active += 1
+
+    def release(self):
+        """
+        归还处理名额
+        :return: None
+        """
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class SessionCache:
+    """
+    推理端的会话历史缓存，用于支持增量历史协议：客户端仅发送会话id、已完成的轮数与本次输入，历史记录由推理端保存
+
+    会话在ttl秒内未被访问或超出maxSessions(按最近使用淘汰)时将被移除，此后客户端需重新发送完整历史记录
+    """
+
+    def __init__(self, ttl: float = 1800, maxSessions: int = 1024):
+        """
+        :param ttl: float 会话的存活时间(秒)，每次访问后重新计时
+        :param maxSessions: int 最多保存的会话数
+        """
+        self.ttl = ttl
+        self.maxSessions = maxSessions
+        self._sessions = OrderedDict()  # {session_id: (history, turn, lastAccess)}
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float):
+        while self._sessions:
+            sessionId, (_, _, lastAccess) = next(iter(self._sessions.items()))
+            if now - lastAccess <= self.ttl and len(self._sessions) <= self.maxSessions:
+                break
+            del self._sessions[sessionId]
+
+    def get(self, sessionId: str, turn: int) -> list:
+        """
+        获取会话的历史记录，会话不存在或轮数与客户端不一致时抛出Conflict(409)，提示客户端重新同步
+        :param sessionId: str 会话id
+        :param turn: int 客户端已完成的轮数
+        :return: list 历史记录
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._sessions.get(sessionId)
+            if entry is None or entry[1] != turn:
+                raise Conflict("Session history is unknown or out of sync, please resend the full history.")
+            self._sessions[sessionId] = (entry[0], turn, now)
+            self._sessions.move_to_end(sessionId)
+            return entry[0]
+
+    def put(self, sessionId: str, history: list, turn: int):
+        """
+        保存会话的历史记录
+        :param sessionId: str 会话id
+        :param history: list 历史记录(含本轮)
+        :param turn: int 已完成的轮数(含本轮)
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            self._sessions[sessionId] = (history, turn, now)
+            self._sessions.move_to_end(sessionId)
+            self._evict(now)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
 
 
 class APIWrapper:
@@ -12,7 +302,17 @@ class APIWrapper:
     使用Flask将任意后端封装为API形式，以实现远程调用
 
     若需要启用secret，请以Get参数(secret=...)的形式携带
+
+    客户端可通过请求头X-Request-Deadline(Unix时间戳，单位为秒)告知截止时间，已过期的请求将被直接丢弃(504)
+
+    客户端携带的请求id(X-Request-Id)会原样写回响应头，便于将客户端的追踪记录与推理端日志对应
+
+    支持内容协商：请求体可使用MessagePack(Content-Type)与gzip/zstd(Content-Encoding)，
+    响应会根据Accept与Accept-Encoding进行相应的编码与压缩(需安装msgpack、zstandard)
     """
+    deadlineHeader = "X-Request-Deadline"
+    requestIdHeader = "X-Request-Id"
+    compressThreshold = 1024  # 响应体超过该大小(字节)时才进行压缩
     # noinspection SqlNoDataSourceInspection
     defaultDescription = {
         "title": "It's a simple API.",
@@ -62,9 +362,15 @@ class APIWrapper:
         self.version = version
         self.host = "0.0.0.0" if listen else "127.0.0.1"
 
+        self.metrics = RouteMetrics()  # 各路由的请求统计
+        self.ready = False  # 模型是否已加载完毕，run()/serve()启动时会自动置为True
+        self.queueDepth = None  # Callable[[], int]，返回推理端内部的等待队列长度，未设置时以正在处理的请求数代替
+
         self.flaskApp = Flask(__name__)
+        self.flaskApp.request_class = NegotiatedRequest
         self._addBasicRoute()  # 添加基本的路由规则
         self._addBasicErrorHandlers()  # 添加基本的错误处理
+        self.flaskApp.after_request(self._echoRequestId)
 
     def _addBasicRoute(self):
         """
@@ -91,6 +397,25 @@ class APIWrapper:
             """
             return {"time": self.getISOTime(), "version": self.version}, 200
 
+        @self.flaskApp.route('/metrics', methods=['GET'])
+        def getMetrics():
+            """
+            以Prometheus文本格式返回各路由的请求统计
+            :return: {str, 200}
+            """
+            return Response(self.metrics.export(), mimetype="text/plain; version=0.0.4")
+
+        @self.flaskApp.route('/ready', methods=['GET'])
+        def getReadiness():
+            """
+            返回服务是否就绪(模型是否已加载)以及当前的队列长度，未就绪时返回503
+            :return: {{time: str, ready: bool, queue_depth: int}, 200 | 503}
+            """
+            queueDepth = self.queueDepth() if self.queueDepth else self.metrics.totalInFlight()
+            return {
+                "time": self.getISOTime(), "ready": self.ready, "queue_depth": queueDepth
+            }, 200 if self.ready else 503
+
         # noinspection SqlNoDataSourceInspection
         @self.flaskApp.route('/love', methods=['GET'])
         def love():
@@ -107,6 +432,17 @@ class APIWrapper:
                 ]
             }, 200
 
+    def _echoRequestId(self, response: Response) -> Response:
+        """
+        将请求id写回响应头
+        :param response: Response
+        :return: Response
+        """
+        requestId = request.headers.get(self.requestIdHeader)
+        if requestId:
+            response.headers[self.requestIdHeader] = requestId
+        return response
+
     def _addBasicErrorHandlers(self):
         @self.flaskApp.errorhandler(HTTPException)
         def error(e):
@@ -115,18 +451,74 @@ class APIWrapper:
             :param e: InternalServerError
             :return: {{time: str, content: dict}, 404}
             """
+            headers = {key: value for key, value in e.get_headers() if key.lower() != "content-type"}  # 如Retry-After
             return {
                 "time": self.getISOTime(),
                 "content": {"code": e.code, "description": e.description, "name": e.name}
-            }, e.code
+            }, e.code, headers
 
     def run(self):
         """
         运行Flask实例，启动API服务
         :return: None
         """
+        self.ready = True
         self.flaskApp.run(host=self.host, port=self.port)
 
+    def serve(
+            self,
+            workers: int = 1,
+            threads: int = 4,
+            keepAlive: int = 5,
+            timeout: int = 120,
+            gracefulTimeout: int = 30,
+            onWorkerStart=None
+    ):
+        """
+        使用生产级WSGI服务器(gunicorn)运行Flask实例，启动API服务
+
+        与run()不同，该方法支持多进程与多线程。模型应当在调用该方法之前加载完毕，gunicorn会在主进程中预加载应用(preload)
+        后再fork出各个worker，使各worker以写时复制的方式共享模型所占的内存。
+        注意：fork不会复制线程，若需要在worker中启动后台线程，请通过onWorkerStart进行。
+        :param workers: int worker进程数
+        :param threads: int 每个worker的线程数
+        :param keepAlive: int Keep-Alive连接的保持时间(秒)
+        :param timeout: int worker无响应多久后被重启(秒)，应大于单次推理的最长耗时
+        :param gracefulTimeout: int 收到退出信号后，等待正在处理的请求完成的时间(秒)
+        :param onWorkerStart: Callable[[], None] 每个worker进程启动后调用的函数
+        :return: None
+        """
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            warnings.warn("gunicorn is not installed, falling back to Flask development server.", RuntimeWarning)
+            return self.run()
+
+        self.ready = True
+        flaskApp = self.flaskApp
+        options = {
+            "bind": f"{self.host}:{self.port}",
+            "workers": workers,
+            "threads": threads,
+            "worker_class": "gthread" if threads > 1 else "sync",
+            "keepalive": keepAlive,
+            "timeout": timeout,
+            "graceful_timeout": gracefulTimeout,
+            "preload_app": True,
+        }
+        if onWorkerStart:
+            options["post_fork"] = lambda server, worker: onWorkerStart()
+
+        class _Application(BaseApplication):
+            def load_config(self):
+                for key, value in options.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return flaskApp
+
+        _Application().run()
+
     def getISOTime(self) -> str:
         """
         获取ISO格式的当前时间(服务器时间)
@@ -134,21 +526,132 @@ class APIWrapper:
         """
         return datetime.now(timezone(timedelta(hours=self.timezone))).strftime('%Y-%m-%dT%H:%M:%S%z')
 
-    def addRoute(self, route: str, methods: list = None):
+    @staticmethod
+    def wantsBinary() -> bool:
+        """
+        判断当前请求的客户端是否接受MessagePack格式的响应，处理函数可据此直接返回bytes(如音频的原始采样)而非list
+        :return: bool
+        """
+        return bool(msgpack) and request.accept_mimetypes.best_match(
+            ["application/json", "application/msgpack"]
+        ) == "application/msgpack"
+
+    @staticmethod
+    def binaryResponse(data: dict, status: int = 200) -> Response:
+        """
+        将含有bytes的数据以MessagePack格式返回，应先通过wantsBinary()确认客户端支持
+        :param data: dict 响应数据
+        :param status: int HTTP状态码
+        :return: Response
+        """
+        return Response(msgpack.packb(data), status=status, mimetype="application/msgpack")
+
+    @staticmethod
+    def audioResponse(samples, sampleRate: int, audioFormat: str = "wav", bitrate: str = None,
+                      targetRate: int = None) -> Response:
+        """
+        将音频采样编码为指定格式后直接返回(参数详见encodeAudio)，格式不受支持时返回400
+        :return: Response
+        """
+        try:
+            data = encodeAudio(samples, sampleRate, audioFormat, bitrate, targetRate)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        return Response(data, mimetype=audioMimeTypes[audioFormat])
+
+    def _negotiate(self, response: Response) -> Response:
+        """
+        根据请求头Accept与Accept-Encoding，对JSON响应进行MessagePack编码与gzip/zstd压缩
+        :param response: Response 处理函数的响应
+        :return: Response 编码后的响应
+        """
+        if response.is_streamed or response.direct_passthrough or "Content-Encoding" in response.headers:
+            return response
+        if response.mimetype in ("audio/mpeg", "audio/ogg"):  # 已压缩的音频无需再次压缩
+            return response
+        response.vary.add("Accept")
+        if response.is_json and self.wantsBinary():
+            response.set_data(msgpack.packb(response.get_json()))
+            response.mimetype = "application/msgpack"
+        data = response.get_data()
+        if len(data) < self.compressThreshold:
+            return response
+        encoding = request.accept_encodings.best_match(["zstd", "gzip"] if zstandard else ["gzip"])
+        if encoding == "zstd":
+            response.set_data(zstandard.ZstdCompressor().compress(data))
+        elif encoding == "gzip":
+            response.set_data(gzip.compress(data, compresslevel=6))
+        else:
+            return response
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+    def addRoute(
+            self,
+            route: str,
+            methods: list = None,
+            maxConcurrency: int = None,
+            maxQueue: int = 0,
+            queueTimeout: float = None
+    ):
         """
         该方法用于添加路由，可以通过装饰器的形式添加路由，也可以直接调用该方法添加路由。
         :param route: str 路由地址
         :param methods: list 允许的请求方法
+        :param maxConcurrency: int 该路由同时处理的最大请求数，默认不限制
+        :param maxQueue: int 超出并发数后允许排队的请求数，队列已满时直接返回503
+        :param queueTimeout: float 排队的最长时间(秒)，超时后返回503
         :return: None
         """
+        limiter = RouteLimiter(maxConcurrency, maxQueue, queueTimeout) if maxConcurrency else None
 
         def decorator(func):
             """
-            内部包装器
+            内部包装器，在注册路由的同时自动记录该路由的请求统计
             :param func: function 被装饰的函数
             :return: function 被装饰的函数
             """
-            self.flaskApp.add_url_rule(route, func.__name__, func, methods=methods)
+
+            @wraps(func)
+            def measured(*args, **kwargs):
+                self.metrics.start(route)
+                start, status, responseSize = time.perf_counter(), 500, 0
+                requestSize, acquired, deferred = request.content_length or 0, False, False
+                try:
+                    deadline = request.headers.get(self.deadlineHeader, type=float)
+                    if deadline is not None and time.time() >= deadline:
+                        raise GatewayTimeout("Request deadline exceeded.")
+                    if limiter:
+                        limiter.acquire(deadline)
+                        acquired = True
+                    if deadline is not None and time.time() >= deadline:  # 排队期间客户端已放弃等待
+                        raise GatewayTimeout("Request deadline exceeded while waiting in queue.")
+                    response = self._negotiate(make_response(func(*args, **kwargs)))
+                    status = response.status_code
+                    if response.is_streamed:
+                        # 流式响应的内容在返回之后才生成，待发送完毕(或客户端断开)时再释放并发名额并记录耗时，
+                        # 其大小无法提前得知(calculate_content_length会将生成器整个读入内存)，因此记为0
+                        def finishStream():
+                            if acquired:
+                                limiter.release()
+                            self.metrics.finish(route, status, time.perf_counter() - start, requestSize, 0)
+
+                        response.call_on_close(finishStream)
+                        deferred = True
+                    elif not response.direct_passthrough:
+                        responseSize = response.calculate_content_length() or 0
+                    return response
+                except HTTPException as e:
+                    status = e.code
+                    raise
+                finally:
+                    if not deferred:
+                        if acquired:
+                            limiter.release()
+                        self.metrics.finish(route, status, time.perf_counter() - start, requestSize, responseSize)
+
+            self.flaskApp.add_url_rule(route, func.__name__, measured, methods=methods)
             return func
 
         return decorator
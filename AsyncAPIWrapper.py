@@ -0,0 +1,236 @@
+"""该文件定义了一个基于ASGI(Starlette)的API封装类，在APIWrapper的基础上支持异步、流式响应与WebSocket"""
+
+import inspect
+import json
+import warnings
+from datetime import datetime, timezone, timedelta
+from http import HTTPStatus
+from typing import Literal
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.websockets import WebSocket, WebSocketState
+
+from APIWrapper import APIWrapper
+
+
+class AsyncAPIWrapper:
+    """
+    使用Starlette将任意后端封装为API形式，以实现远程调用
+
+    与APIWrapper的区别在于，被addRoute装饰的函数会接收一个starlette.requests.Request参数(而非使用flask.request)，
+    并且可以是以下任意一种：
+        * 普通函数：在线程池中执行，返回dict、(dict, int)或Response。由于无法在普通函数中await请求体，
+          请求体会被预先解析为JSON并存放于request.state.json中；
+        * 异步函数(async def)：返回值同上，可直接await request.json()；
+        * 生成器/异步生成器：每次yield一个分块，按照stream参数以SSE或分块传输(chunked)的形式流式返回。
+
+    若需要启用secret，请以Get参数(secret=...)的形式携带
+    """
+    defaultDescription = APIWrapper.defaultDescription
+
+    def __init__(
+            self,
+            secretKey: str = None,
+            description: dict = None,
+            timeZone: int = 8,
+            port: int = 5000,
+            version: str = "1.0-alpha",
+            listen: bool = True
+    ):
+        """
+        初始化AsyncAPIWrapper，参数含义与APIWrapper一致
+        :param secretKey: 加密密钥，建议设置。
+        :param description: 关于本API的描述，可以使用str(简单的一段文字描述)或dict(多字段描述)进行配置
+        :param timeZone: 时区，作者所在的时区为UTC+8
+        :param port: Starlette实例监听的端口
+        :param version: 设定版本，默认为"1.0-alpha"，表示当前API只是个最初的内部测试版
+        :param listen: 是否监听0.0.0.0，默认开启，监听后可以通过局域网IP访问，否则只能通过127.0.0.1访问
+        """
+        self.description = description if description else self.defaultDescription
+        self.secretKey = secretKey if secretKey else None
+        self.timezone = timeZone
+        if not self.secretKey:
+            warnings.warn("No valid secret set, your API is not secure!", RuntimeWarning)
+        self.port = port
+        self.version = version
+        self.host = "0.0.0.0" if listen else "127.0.0.1"
+
+        self.asgiApp = Starlette()
+        self._addBasicRoute()  # 添加基本的路由规则
+        self._addBasicErrorHandlers()  # 添加基本的错误处理
+
+    def _addBasicRoute(self):
+        """
+        初始化一些基础的地址路由
+        :return: None
+        """
+
+        @self.addRoute('/', methods=['GET'])
+        async def getDescription(request: Request):
+            """
+            返回关于本API的描述
+            :return: {{time: str, content: dict}, 200}
+            """
+            return {"time": self.getISOTime(), "content": self.description}, 200
+
+        @self.addRoute('/version', methods=['GET'])
+        async def getVersion(request: Request):
+            """
+            返回API版本
+            :return: {{time: str, version: str}, 200}
+            """
+            return {"time": self.getISOTime(), "version": self.version}, 200
+
+        @self.addRoute('/love', methods=['GET'])
+        async def love(request: Request):
+            """
+            希望你们终能找到，爱的含义。
+            :return: {{time: str, content: list[str]}, 200}
+            """
+            return {
+                "time": self.getISOTime(),
+                "content": [
+                    "The need to find another human being to share one's life with, has always puzzled me.",
+                    "Maybe because I'm so interesting all by myself.",
+                    "With that being said, may you find as much happiness with each other as I find on my own."
+                ]
+            }, 200
+
+    def _addBasicErrorHandlers(self):
+        async def error(request: Request, e: HTTPException):
+            """
+            各种网络异常处理
+            :param e: HTTPException
+            :return: {{time: str, content: dict}, e.status_code}
+            """
+            return JSONResponse({
+                "time": self.getISOTime(),
+                "content": {"code": e.status_code, "description": e.detail, "name": HTTPStatus(e.status_code).phrase}
+            }, status_code=e.status_code, headers=e.headers)
+
+        self.asgiApp.add_exception_handler(HTTPException, error)
+
+    def run(self):
+        """
+        使用uvicorn运行Starlette实例，启动API服务
+        :return: None
+        """
+        import uvicorn
+        uvicorn.run(self.asgiApp, host=self.host, port=self.port)
+
+    def getISOTime(self) -> str:
+        """
+        获取ISO格式的当前时间(服务器时间)
+        :return: str ISO格式的当前时间(服务器时间)
+        """
+        return datetime.now(timezone(timedelta(hours=self.timezone))).strftime('%Y-%m-%dT%H:%M:%S%z')
+
+    @staticmethod
+    def _toResponse(result) -> Response:
+        """
+        将处理函数的返回值转换为Response，支持dict、(dict, int)与Response
+        :param result: 处理函数的返回值
+        :return: Response
+        """
+        if isinstance(result, Response):
+            return result
+        status = 200
+        if isinstance(result, tuple):
+            result, status = result
+        return JSONResponse(result, status_code=status)
+
+    @staticmethod
+    def _encodeChunk(chunk, stream: Literal["sse", "chunked"]) -> bytes:
+        """
+        将生成器产生的单个分块编码为待发送的字节
+        :param chunk: str, bytes或可JSON序列化的对象
+        :param stream: "sse"时按照text/event-stream格式编码，"chunked"时原样发送(对象则编码为一行JSON)
+        :return: bytes
+        """
+        if stream == "sse":
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode()
+            elif not isinstance(chunk, str):
+                chunk = json.dumps(chunk, ensure_ascii=False)
+            return "".join(f"data: {line}\n" for line in chunk.split("\n")).encode() + b"\n"
+        if isinstance(chunk, bytes):
+            return chunk
+        if isinstance(chunk, str):
+            return chunk.encode()
+        return json.dumps(chunk, ensure_ascii=False).encode() + b"\n"
+
+    def addRoute(self, route: str, methods: list = None, stream: Literal["sse", "chunked"] = "sse"):
+        """
+        该方法用于添加路由，可以通过装饰器的形式添加路由，也可以直接调用该方法添加路由。
+        :param route: str 路由地址
+        :param methods: list 允许的请求方法
+        :param stream: str 生成器处理函数的流式返回方式，"sse"(text/event-stream)或"chunked"(分块传输)
+        :return: None
+        """
+
+        def decorator(func):
+            """
+            内部包装器
+            :param func: function 被装饰的函数
+            :return: function 被装饰的函数
+            """
+            mediaType = "text/event-stream" if stream == "sse" else "application/octet-stream"
+
+            async def endpoint(request: Request) -> Response:
+                if not inspect.iscoroutinefunction(func) and not inspect.isasyncgenfunction(func):
+                    body = await request.body()
+                    try:
+                        request.state.json = json.loads(body) if body else None
+                    except ValueError:
+                        request.state.json = None
+                if inspect.isasyncgenfunction(func) or inspect.isgeneratorfunction(func):
+                    chunks = func(request)
+                    if inspect.isasyncgen(chunks):
+                        async def encoded():
+                            async for chunk in chunks:
+                                yield self._encodeChunk(chunk, stream)
+                    else:
+                        def encoded():
+                            for chunk in chunks:
+                                yield self._encodeChunk(chunk, stream)
+                    return StreamingResponse(encoded(), media_type=mediaType, headers={"Cache-Control": "no-cache"})
+                if inspect.iscoroutinefunction(func):
+                    return self._toResponse(await func(request))
+                return self._toResponse(await run_in_threadpool(func, request))
+
+            self.asgiApp.add_route(route, endpoint, methods=methods, name=func.__name__)
+            return func
+
+        return decorator
+
+    def addWebSocketRoute(self, route: str):
+        """
+        该方法用于添加WebSocket路由，被装饰的函数应为异步函数，并接收一个starlette.websockets.WebSocket参数，
+        连接的accept与close由本方法负责
+        :param route: str 路由地址
+        :return: None
+        """
+
+        def decorator(func):
+            """
+            内部包装器
+            :param func: function 被装饰的异步函数
+            :return: function 被装饰的函数
+            """
+
+            async def endpoint(websocket: WebSocket):
+                await websocket.accept()
+                try:
+                    await func(websocket)
+                finally:
+                    if websocket.application_state != WebSocketState.DISCONNECTED:
+                        await websocket.close()
+
+            self.asgiApp.add_websocket_route(route, endpoint, name=func.__name__)
+            return func
+
+        return decorator
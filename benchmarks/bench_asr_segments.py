@@ -0,0 +1,64 @@
+"""
+该文件对SegmentedASR(modules/ASR.py)进行基准测试：对同一段长录音，按不同的期望分段时长切分并行识别，
+记录分段数与相对于整段识别的加速比
+
+使用进程内的FakeASR，其延迟随音频时长线性增长；测试音频为以停顿分隔的类语音信号(见benchmarks/bench_codec.py)
+
+运行方式(于项目根目录)：python -m benchmarks.bench_asr_segments [--seconds 120] [--workers 4]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from scipy.io.wavfile import write as wavwrite
+
+from benchmarks.fakes import FakeASR, LatencyModel
+from modules.ASR import SegmentedASR
+
+SAMPLE_RATE = 16000
+
+
+def makeUtterances(seconds: float, sampleRate: int = SAMPLE_RATE, seed: int = 0) -> np.ndarray:
+    """
+    生成由2~8秒的“语句”与0.4~1.2秒的停顿交替组成的录音
+    :return: np.ndarray int16音频采样
+    """
+    rng = np.random.default_rng(seed)
+    pieces, total = [], 0
+    while total < seconds * sampleRate:
+        speech = int(rng.uniform(2, 8) * sampleRate)
+        t = np.arange(speech) / sampleRate
+        phase = 2 * np.pi * np.cumsum(160 + 50 * np.sin(2 * np.pi * 0.8 * t)) / sampleRate
+        voiced = sum(np.sin(k * phase) / k for k in range(1, 8)) * np.abs(np.sin(2 * np.pi * 3 * t)) ** 0.5
+        pieces.append((voiced / np.abs(voiced).max() * 12000).astype(np.int16))
+        pause = int(rng.uniform(0.4, 1.2) * sampleRate)
+        pieces.append((rng.standard_normal(pause) * 30).astype(np.int16))  # 底噪
+        total += speech + pause
+    return np.concatenate(pieces)[:int(seconds * sampleRate)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Speed-up of segmented parallel transcription vs. segment count.")
+    parser.add_argument("--seconds", type=float, default=120)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    asr = FakeASR(LatencyModel(0.3, sigma=0, perUnit=0.03))
+    samples = makeUtterances(args.seconds)
+    path = os.path.join(os.getcwd(), "download", "benchmark-long.wav")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    wavwrite(path, SAMPLE_RATE, samples)
+
+    start = time.perf_counter()
+    asr.transcribe(path)
+    baseline = time.perf_counter() - start
+    print(f"{'segment(s)':>11}{'segments':>10}{'time(s)':>10}{'speed-up':>10}")
+    print(f"{'whole':>11}{1:>10}{baseline:>10.2f}{1:>9.1f}x")
+    for segmentSeconds in (60, 30, 15, 8, 4):
+        segmented = SegmentedASR(asr, segmentSeconds=segmentSeconds, maxWorkers=args.workers)
+        count = len(segmented.split(samples, SAMPLE_RATE))
+        start = time.perf_counter()
+        segmented.transcribe(path)
+        elapsed = time.perf_counter() - start
+        print(f"{segmentSeconds:>11}{count:>10}{elapsed:>10.2f}{baseline / elapsed:>9.1f}x")
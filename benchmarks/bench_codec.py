@@ -0,0 +1,72 @@
+"""
+该文件对比了合成结果以不同格式(modules/TTS.py中的AudioCodec)传输时的体积与可播放耗时
+
+可播放耗时 = 编码耗时 + 按给定带宽传输的耗时 + 解码耗时，其中编码在推理端进行、解码在浏览器或ffplay中进行，
+此处均在本机测量。测试音频为模拟语音包络的谐波信号，需安装pydub与ffmpeg
+
+运行方式(于项目根目录)：python -m benchmarks.bench_codec [--seconds 5] [--bandwidth 1 10]
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+from pydub import AudioSegment
+
+from modules.TTS import AudioCodec
+
+SAMPLE_RATE = 44100  # Bert-VITS2的输出采样率
+CODECS = [  # (格式, 码率, 目标采样率)
+    ("wav", None, None),
+    ("wav", None, 16000),
+    ("mp3", "64k", None),
+    ("mp3", "32k", 24000),
+    ("ogg", "32k", None),
+    ("ogg", "24k", 24000),
+    ("ogg", "16k", 16000),
+]
+
+
+def makeSpeechLikeSignal(seconds: float, sampleRate: int = SAMPLE_RATE, seed: int = 0) -> np.ndarray:
+    """
+    生成类似语音的测试信号：基频在120~240Hz间缓慢变化的谐波，叠加音节级(约4Hz)的幅度包络与少量噪声
+    :return: np.ndarray int16音频采样
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sampleRate)) / sampleRate
+    pitch = 180 + 60 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sampleRate
+    signal = sum(np.sin(k * phase) / k for k in range(1, 12))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) ** 0.5
+    signal = signal * envelope + 0.02 * rng.standard_normal(len(t))
+    return (signal / np.abs(signal).max() * 0.8 * 32767).astype(np.int16)
+
+
+def measure(codec: AudioCodec, samples: np.ndarray) -> tuple[int, float, float]:
+    """
+    :return: tuple[int, float, float] 编码后的字节数、编码耗时(秒)、解码耗时(秒)
+    """
+    start = time.perf_counter()
+    data = codec.encode(samples, SAMPLE_RATE)
+    encoded = time.perf_counter()
+    AudioSegment.from_file(io.BytesIO(data), format=codec.format).get_array_of_samples()
+    return len(data), encoded - start, time.perf_counter() - encoded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare TTS delivery size and time-to-playback per audio format.")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--bandwidth", type=float, nargs="+", default=[1, 10], help="link bandwidth in Mbit/s")
+    args = parser.parse_args()
+
+    samples = makeSpeechLikeSignal(args.seconds)
+    print(f"{'format':<20}{'size(KB)':>10}{'ratio':>8}{'encode(ms)':>12}{'decode(ms)':>12}"
+          + "".join(f"{f'ttp@{bandwidth:g}M(ms)':>16}" for bandwidth in args.bandwidth))
+    baseline = None
+    for audioFormat, bitrate, sampleRate in CODECS:
+        size, encodeTime, decodeTime = measure(AudioCodec(audioFormat, bitrate, sampleRate), samples)
+        baseline = baseline or size
+        label = f"{audioFormat}/{bitrate or '-'}/{sampleRate or SAMPLE_RATE}"
+        playback = [(encodeTime + size * 8 / (bandwidth * 1e6) + decodeTime) * 1000 for bandwidth in args.bandwidth]
+        print(f"{label:<20}{size / 1024:>10.1f}{baseline / size:>7.1f}x{encodeTime * 1000:>12.1f}"
+              f"{decodeTime * 1000:>12.1f}" + "".join(f"{value:>16.1f}" for value in playback))
@@ -0,0 +1,72 @@
+"""
+该文件对比了发送完整历史记录与启用检索式记忆(modules/memory.py)两种模式下，每轮查询发送的token数与耗时
+
+历史记录中埋入了若干条“事实”，查询时询问这些事实，以检验检索式记忆能否找回相关的早期对话(recall)
+
+运行方式(于项目根目录)：python -m benchmarks.bench_memory [--turns 20 100 500]
+"""
+import argparse
+import random
+import time
+
+from benchmarks.fakes import FakeNLG, LatencyModel
+from modules.memory import RetrievalMemory
+
+FACTS = [  # (埋入的对话, 对应的查询)
+    (["我的猫叫小白，今年三岁了", "小白这个名字真可爱！"], "我的猫叫什么名字？"),
+    (["我下周二要去昆明出差", "祝你出差顺利，记得带伞。"], "我下周要去哪里出差？"),
+    (["my favourite language is Rust", "Rust is a great choice for systems programming."], "which language do I like?"),
+]
+FILLER = ["今天天气不错", "帮我写一首诗", "解释一下量子计算", "推荐一本书", "what is a transformer model",
+          "如何学习英语", "给我讲个笑话", "周末去哪里玩", "怎么做红烧肉", "explain gradient descent"]
+
+
+def makeHistory(turns: int, seed: int = 0) -> tuple[list[list[str]], list[int]]:
+    """
+    生成包含若干事实的历史记录
+    :param turns: int 总轮数
+    :param seed: int 随机种子
+    :return: tuple[list[list[str]], list[int]] 历史记录, 各事实所在的轮次
+    """
+    rng = random.Random(seed)
+    history = [[rng.choice(FILLER), "好的，" + "这是一段较长的回复。" * rng.randint(3, 12)] for _ in range(turns)]
+    positions = sorted(rng.sample(range(turns // 2), len(FACTS)))
+    for position, (fact, _) in zip(positions, FACTS):
+        history[position] = list(fact)
+    return history, positions
+
+
+def runQueries(nlg: FakeNLG, history: list[list[str]], positions: list[int]) -> dict[str, float]:
+    """
+    依次询问每条事实，记录发送的token数、构造历史记录的耗时、端到端耗时与召回率
+    """
+    tokens, prepare, total, recalled = 0, 0.0, 0.0, 0
+    for position, (fact, query) in zip(positions, FACTS):
+        start = time.perf_counter()
+        messages = nlg.converterHistory(history, message=query)
+        prepare += time.perf_counter() - start
+        tokens += nlg.countTokens(messages, query)
+        recalled += any(item["content"] == fact[0] for item in messages)
+        start = time.perf_counter()
+        nlg.continuedQuery(query, history)
+        total += time.perf_counter() - start
+    count = len(FACTS)
+    return {"tokens": tokens / count, "prepare_ms": prepare / count * 1000, "query_s": total / count,
+            "recall": recalled / count}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full-history and retrieval-memory query modes.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[20, 100, 500])
+    args = parser.parse_args()
+
+    # 首token延迟随输入字符数线性增长，近似模拟长上下文的预填充开销
+    nlg = FakeNLG(LatencyModel(0.2, sigma=0, perUnit=0.00005), tokensPerSecond=1000, replyTokens=10)
+    print(f"{'turns':>6}{'mode':>8}{'tokens':>10}{'prepare(ms)':>13}{'query(s)':>10}{'recall':>8}")
+    for turns in args.turns:
+        history, positions = makeHistory(turns)
+        for mode, memory in (("full", None), ("memory", RetrievalMemory())):
+            nlg.memory = memory
+            result = runQueries(nlg, history, positions)
+            print(f"{turns:>6}{mode:>8}{result['tokens']:>10.0f}{result['prepare_ms']:>13.3f}"
+                  f"{result['query_s']:>10.3f}{result['recall']:>8.0%}")
@@ -0,0 +1,109 @@
+"""
+该文件对ASR→NLG→TTS的语音对话流程进行端到端基准测试，每一轮等价于gradio-app.py中autoChat的一次调用(不含ffplay播放)
+
+默认使用进程内的替身后端(benchmarks/fakes.py)；使用--remote时，将启动基于APIWrapper的替身服务器
+(benchmarks/stub_servers.py)，并通过真实的Whisper、Waltz与BertVITS2客户端进行测试。全程无需访问外部服务。
+
+运行方式(于项目根目录)：python -m benchmarks.bench_pipeline [--turns 40] [--concurrency 1 2 4 8] [--remote]
+"""
+import argparse
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeASR, FakeNLG, FakeTTS, writeSilence
+from modules.ASR import ASRBase
+from modules.NLG import NLGBase
+from modules.TTS import TTSBase
+
+STAGES = ["asr", "nlg", "ttft", "tts", "tta", "total"]  # ttft: 首token耗时；tta: 首段音频可播放的耗时
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    计算百分位数(最近秩法)
+    :param values: list[float] 样本
+    :param q: float 百分位，取值0~100
+    :return: float
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def runTurn(asr: ASRBase, nlg: NLGBase, tts: TTSBase, audio: str, history: list) -> dict[str, float]:
+    """
+    执行一轮语音对话，并记录各阶段耗时
+    :param asr: ASRBase 语音识别后端
+    :param nlg: NLGBase 语言生成后端
+    :param tts: TTSBase 语音合成后端
+    :param audio: str 用户语音文件路径
+    :param history: list 历史记录
+    :return: dict[str, float] 各阶段耗时(秒)
+    """
+    start = time.perf_counter()
+    message = asr.transcribe(audio)
+    asrDone = time.perf_counter()
+    if hasattr(nlg, "streamContinuedQuery"):
+        reply, firstToken = "", None
+        for chunk in nlg.streamContinuedQuery(message, history):
+            if firstToken is None:
+                firstToken = time.perf_counter()
+            reply += chunk
+    else:
+        reply = nlg.continuedQuery(message, history)
+        firstToken = time.perf_counter()
+    nlgDone = time.perf_counter()
+    tts.synthesize(reply)
+    ttsDone = time.perf_counter()
+    return {
+        "asr": asrDone - start,
+        "nlg": nlgDone - asrDone,
+        "ttft": firstToken - start,
+        "tts": ttsDone - nlgDone,
+        "tta": ttsDone - start,  # 当前流程需等待整段合成完毕才开始播放
+        "total": ttsDone - start
+    }
+
+
+def benchmark(asr: ASRBase, nlg: NLGBase, tts: TTSBase, audio: str, turns: int, concurrency: int) -> None:
+    """
+    以指定的并发数执行若干轮对话，并打印各阶段的p50/p95/p99
+    """
+    history = [["你好", "你好！有什么可以帮你的吗？"]] * 5
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: runTurn(asr, nlg, tts, audio, history), range(turns)))
+    elapsed = time.perf_counter() - start
+    print(f"\n== concurrency={concurrency}, turns={turns}, throughput={turns / elapsed:.2f} turns/s ==")
+    print(f"{'stage':<8}{'p50(s)':>10}{'p95(s)':>10}{'p99(s)':>10}")
+    for stage in STAGES:
+        values = [result[stage] for result in results]
+        print(f"{stage:<8}" + "".join(f"{percentile(values, q):>10.3f}" for q in (50, 95, 99)))
+
+
+def createRemoteBackends() -> tuple[ASRBase, NLGBase, TTSBase]:
+    """
+    启动替身服务器，并创建指向它们的远端后端
+    """
+    from benchmarks.stub_servers import createWhisperStub, createWaltzStub, createBertVITS2Stub, serveInBackground
+    from modules.ASR import Whisper
+    from modules.NLG import Waltz
+    from modules.TTS import BertVITS2
+    asr = Whisper({"host": serveInBackground(createWhisperStub())})
+    nlg = Waltz({"host": serveInBackground(createWaltzStub())})
+    tts = BertVITS2({"host": serveInBackground(createBertVITS2Stub())})
+    return asr, nlg, tts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end voice turn benchmark with offline stand-in backends.")
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--remote", action="store_true", help="use APIWrapper stub servers and the remote clients")
+    args = parser.parse_args()
+
+    backends = createRemoteBackends() if args.remote else (FakeASR(), FakeNLG(), FakeTTS())
+    audioPath = writeSilence(os.path.join(backends[2].save_path, "benchmark-input.wav"), 3)
+    for level in args.concurrency:
+        benchmark(*backends, audioPath, args.turns, level)
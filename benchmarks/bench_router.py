@@ -0,0 +1,70 @@
+"""
+该文件对AutoRouter(modules/NLG.py)进行基准测试：三个首token延迟不同的后端，其中最快的后端在测试中途变慢，
+比较自动选择与随机选择、固定选择的平均首片段耗时，以及自动选择在各阶段发往各后端的比例
+
+使用进程内的FakeNLG，不依赖任何外部服务
+
+运行方式(于项目根目录)：python -m benchmarks.bench_router [--turns 200]
+"""
+import argparse
+import random
+import statistics
+import time
+
+from benchmarks.fakes import FakeNLG, LatencyModel
+from modules.NLG import AutoRouter
+
+
+def firstChunkSeconds(backend, message: str) -> float:
+    """
+    :return: float 流式查询的首个片段耗时(秒)，其余片段照常读取
+    """
+    start, first = time.perf_counter(), None
+    for _ in backend.streamSingleQuery(message):
+        if first is None:
+            first = time.perf_counter() - start
+    return first
+
+
+def makeBackends() -> dict[str, FakeNLG]:
+    return {
+        "A": FakeNLG(LatencyModel(0.02, sigma=0.3, seed=1), tokensPerSecond=2000, replyTokens=10),
+        "B": FakeNLG(LatencyModel(0.05, sigma=0.3, seed=2), tokensPerSecond=2000, replyTokens=10),
+        "C": FakeNLG(LatencyModel(0.08, sigma=0.3, seed=3), tokensPerSecond=2000, replyTokens=10),
+    }
+
+
+def run(turns: int, strategy: str) -> tuple[list[float], list[dict[str, int]]]:
+    """
+    :param strategy: str "auto"、"random"或后端名称(固定选择)
+    :return: tuple[list[float], list[dict[str, int]]] 每轮的首片段耗时，以及前后两个阶段发往各后端的次数
+    """
+    backends = makeBackends()
+    router = AutoRouter(backends)
+    chooser = random.Random(0)
+    seconds, phases = [], [{}, {}]
+    for turn in range(turns):
+        if turn == turns // 2:  # 后半段A变慢
+            backends["A"].firstToken = LatencyModel(0.15, sigma=0.3, seed=4)
+        if strategy == "auto":
+            seconds.append(firstChunkSeconds(router, "你好"))
+            name = router.current
+        else:
+            name = chooser.choice(list(backends)) if strategy == "random" else strategy
+            seconds.append(firstChunkSeconds(backends[name], "你好"))
+        phase = phases[turn >= turns // 2]
+        phase[name] = phase.get(name, 0) + 1
+    return seconds, phases
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="First-chunk latency of auto routing vs. random and fixed choice.")
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'strategy':>9}{'mean(ms)':>10}{'p95(ms)':>10}  routed (first half | second half)")
+    for strategy in ("auto", "random", "A", "B"):
+        seconds, phases = run(args.turns, strategy)
+        p95 = statistics.quantiles(seconds, n=20)[-1]
+        routed = " | ".join(", ".join(f"{name}:{count}" for name, count in sorted(phase.items())) for phase in phases)
+        print(f"{strategy:>9}{statistics.mean(seconds) * 1000:>10.1f}{p95 * 1000:>10.1f}  {routed}")
@@ -0,0 +1,82 @@
+"""
+该文件对NLGBase.lenOfTokens在未安装tiktoken时的估算方法进行基准测试，并与旧版逐词切分的实现进行对照
+
+运行方式(于项目根目录)：python -m benchmarks.bench_tokens
+"""
+import random
+import re
+import time
+
+from modules.NLG import NLGBase
+from modules.utils import Message
+
+REPEAT = 20  # 每组数据重复的次数
+TOLERANCE = 1  # 与旧版实现允许的误差(token)，仅来源于浮点累加顺序的差异
+
+
+def legacyLenOfTokens(history: list[Message] = None, message: str = None, token_per_zh_char: float = None) -> int:
+    """
+    旧版实现，拷贝自重构前的NLGBase.lenOfTokens(不含tiktoken分支)
+
+    旧版中遍历历史记录的循环变量覆盖了参数message，导致传入history时必然出错，此处已将其更名为item
+    """
+    content = ""
+    if history:
+        for item in history:
+            content += item["content"]
+    if message:
+        content += message
+    token_per_en_word = 1.2
+    if not token_per_zh_char:
+        token_per_zh_char = 1.33
+    word_list = re.split("[ ,.?!';:()\\[\\]{}\t\n]", content)
+    word_list = [word for word in word_list if word != ""]
+    token_num = 0
+    for word in word_list:
+        if word.isascii():
+            token_num += token_per_en_word
+        else:
+            sub_word_list = re.split("[\u4e00-\u9fff]", word)
+            zh_char_num = sub_word_list.count("")
+            token_num += zh_char_num * token_per_zh_char
+            token_num += (len(sub_word_list) - zh_char_num) * token_per_en_word
+    return int(token_num)
+
+
+def makeHistory(chars: int, seed: int = 0) -> list[Message]:
+    """
+    生成中英混合、总长度约为chars个字符的历史记录
+    :param chars: int 目标字符数
+    :param seed: int 随机种子
+    :return: list[Message]
+    """
+    rng = random.Random(seed)
+    vocabulary = ["云南大学", "Chatbot", "语音识别", "API", "token", "你好", "GPT-4", "模型", "café", "100%"]
+    separators = [" ", "，", ",", "。", ".", "\n", "", "？"]
+    history, size = [], 0
+    while size < chars:
+        content = "".join(rng.choice(vocabulary) + rng.choice(separators) for _ in range(rng.randint(5, 40)))
+        history.append(Message(role="user" if len(history) % 2 == 0 else "assistant", content=content))
+        size += len(content)
+    return history
+
+
+def timeIt(function, history: list[Message]) -> tuple[int, float]:
+    """
+    :return: tuple[int, float] 估算结果与单次耗时(ms)
+    """
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = function(history)
+    return result, (time.perf_counter() - start) / REPEAT * 1000
+
+
+if __name__ == "__main__":
+    NLGBase.tokenEncoding = None  # 强制使用经验估算
+    print(f"{'chars':>8}{'legacy':>10}{'current':>10}{'legacy(ms)':>12}{'current(ms)':>13}{'speed-up':>10}")
+    for size in (200, 2000, 20000, 100000):
+        history = makeHistory(size)
+        legacy, legacyTime = timeIt(legacyLenOfTokens, history)
+        current, currentTime = timeIt(NLGBase.lenOfTokens, history)
+        assert abs(legacy - current) <= TOLERANCE, f"estimation mismatch: {legacy} vs {current}"
+        print(f"{size:>8}{legacy:>10}{current:>10}{legacyTime:>12.3f}{currentTime:>13.3f}{legacyTime / currentTime:>9.1f}x")
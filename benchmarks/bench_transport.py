@@ -0,0 +1,84 @@
+"""
+该文件对远端后端与APIWrapper之间的各种序列化/压缩组合进行基准测试，统计载荷大小与编解码耗时
+
+运行方式(于项目根目录)：python -m benchmarks.bench_transport
+"""
+import gzip
+import json
+import time
+
+import numpy as np
+
+from modules.utils import encodeBody, msgpack, zstandard
+
+REPEAT = 20  # 每个组合重复的次数
+
+
+def makeHistory(turns: int = 50) -> dict:
+    """
+    构造一段多轮对话的请求数据(Waltz.continuedQuery)
+    :param turns: int 对话轮数
+    :return: dict
+    """
+    history = [{"role": "system", "content": "你是一个乐于助人的助手。"}]
+    for i in range(turns):
+        history.append({"role": "user", "content": f"第{i}个问题：请介绍一下云南大学的历史与学科设置。" * 2})
+        history.append({"role": "assistant", "content": f"第{i}个回答：云南大学始建于1922年，是西南地区最早建立的综合性大学之一。" * 4})
+    return {"history": history, "message": "那么它的校训是什么？"}
+
+
+def makeAudio(seconds: float = 10, sampleRate: int = 16000, binary: bool = False) -> dict:
+    """
+    构造一段语音的请求数据(Whisper.transcribe)
+    :param seconds: float 语音时长
+    :param sampleRate: int 采样率
+    :param binary: bool 是否以原始采样的二进制形式存放音频(仅msgpack可用)
+    :return: dict
+    """
+    t = np.arange(int(seconds * sampleRate)) / sampleRate
+    raw = (np.sin(2 * np.pi * 220 * t) * 8000 + np.random.normal(0, 500, t.shape)).astype(np.int16)
+    return {"sampling_rate": sampleRate, "raw": raw.tobytes() if binary else raw.tolist(), "dtype": str(raw.dtype)}
+
+
+def decodeBody(body: bytes, headers: dict[str, str]) -> dict:
+    """
+    按照请求头解码请求体，与APIWrapper中NegotiatedRequest.get_json的逻辑一致
+    """
+    encoding = headers.get("Content-Encoding")
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    elif encoding == "zstd":
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    if headers["Content-Type"] == "application/msgpack":
+        return msgpack.unpackb(body)
+    return json.loads(body)
+
+
+def benchmark(name: str, makeData) -> None:
+    """
+    对一种载荷测试全部可用的序列化/压缩组合并打印结果
+    :param name: str 载荷名称
+    :param makeData: Callable[[bool], dict] 根据是否使用二进制生成载荷
+    """
+    serializations = ["json"] + (["msgpack"] if msgpack else [])
+    compressions = [None, "gzip"] + (["zstd"] if zstandard else [])
+    print(f"\n== {name} ==")
+    print(f"{'serialization':<14}{'compression':<12}{'size(KB)':>12}{'encode(ms)':>12}{'decode(ms)':>12}")
+    for serialization in serializations:
+        data = makeData(serialization == "msgpack")
+        for compression in compressions:
+            start = time.perf_counter()
+            for _ in range(REPEAT):
+                body, headers = encodeBody(data, serialization, compression)
+            encodeTime = (time.perf_counter() - start) / REPEAT * 1000
+            start = time.perf_counter()
+            for _ in range(REPEAT):
+                decodeBody(body, headers)
+            decodeTime = (time.perf_counter() - start) / REPEAT * 1000
+            print(f"{serialization:<14}{str(compression):<12}{len(body) / 1024:>12.1f}"
+                  f"{encodeTime:>12.2f}{decodeTime:>12.2f}")
+
+
+if __name__ == "__main__":
+    benchmark("chat history (50 turns)", lambda binary: makeHistory())
+    benchmark("audio (10 s, 16 kHz, int16)", lambda binary: makeAudio(binary=binary))
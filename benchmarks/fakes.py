@@ -0,0 +1,131 @@
+"""
+该文件定义了用于离线测试的NLG/ASR/TTS后端替身，可配置延迟分布与流式输出速率，不依赖任何外部服务
+
+所有随机量均由带种子的random.Random生成，同样的参数可得到可复现的结果
+"""
+import os
+import random
+import threading
+import time
+import wave
+from os import PathLike
+
+from modules.ASR import ASRBase
+from modules.NLG import NLGBase
+from modules.TTS import TTSBase
+from modules.utils import ASREnum, NLGEnum, TTSEnum
+
+
+class LatencyModel:
+    """
+    对数正态分布的延迟模型，median为中位数(秒)，sigma越大长尾越明显，perUnit为每单位输入(字符、音频秒等)的额外耗时
+    """
+
+    def __init__(self, median: float, sigma: float = 0.25, perUnit: float = 0.0, seed: int = 0):
+        self.median = median
+        self.sigma = sigma
+        self.perUnit = perUnit
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()  # random.Random并非线程安全
+
+    def sample(self, units: float = 0) -> float:
+        """
+        采样一次延迟
+        :param units: float 输入规模(字符数、音频秒数等)
+        :return: float 延迟(秒)
+        """
+        with self._lock:
+            factor = self._random.lognormvariate(0, self.sigma) if self.sigma > 0 else 1.0
+        return (self.median + self.perUnit * units) * factor
+
+
+def writeSilence(path: str, seconds: float, sampleRate: int = 16000) -> str:
+    """
+    写入一段静音wav文件
+    :param path: str 文件路径
+    :param seconds: float 时长
+    :param sampleRate: int 采样率
+    :return: str 文件路径
+    """
+    with wave.open(path, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sampleRate)
+        file.writeframes(b"\x00\x00" * int(seconds * sampleRate))
+    return path
+
+
+class FakeNLG(NLGBase):
+    """
+    模拟的NLG后端：先等待首token延迟，再以tokensPerSecond的速率输出回复
+    """
+
+    def __init__(
+            self,
+            firstToken: LatencyModel = None,
+            tokensPerSecond: float = 30,
+            replyTokens: int = 60,
+            prompt: str = None
+    ):
+        super().__init__(NLGEnum.Waltz, "Fake-NLG", prompt)
+        self.firstToken = firstToken if firstToken else LatencyModel(0.4)
+        self.tokensPerSecond = tokensPerSecond
+        self.replyTokens = replyTokens
+
+    def streamContinuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
+        time.sleep(self.firstToken.sample(self.lenOfMessages(self.converterHistory(history, prompt, message), message)))
+        for i in range(self.replyTokens):
+            if i:
+                time.sleep(1 / self.tokensPerSecond)
+            yield "好" if i % 10 else "。"
+
+    def streamSingleQuery(self, message: str, prompt: str = None):
+        return self.streamContinuedQuery(message, [], prompt)
+
+    def singleQuery(self, message: str, prompt: str = None) -> str:
+        return "".join(self.streamSingleQuery(message, prompt))
+
+    def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None) -> str:
+        return "".join(self.streamContinuedQuery(message, history, prompt))
+
+    def checkConnection(self):
+        pass
+
+
+class FakeASR(ASRBase):
+    """
+    模拟的ASR后端：延迟随音频时长线性增长
+    """
+
+    def __init__(self, latency: LatencyModel = None, transcript: str = "今天天气怎么样？"):
+        super().__init__(ASREnum.Whisper_Finetune, "Fake-ASR")
+        self.latency = latency if latency else LatencyModel(0.3, perUnit=0.05)
+        self.transcript = transcript
+
+    def transcribe(self, audio: PathLike) -> str:
+        with wave.open(str(audio), "rb") as file:
+            seconds = file.getnframes() / file.getframerate()
+        time.sleep(self.latency.sample(seconds))
+        return self.transcript
+
+    def checkConnection(self):
+        pass
+
+
+class FakeTTS(TTSBase):
+    """
+    模拟的TTS后端：延迟随文本长度线性增长，输出与文本长度相符的静音音频
+    """
+
+    def __init__(self, latency: LatencyModel = None, secondsPerChar: float = 0.2):
+        super().__init__(TTSEnum.Bert_VITS, "Fake-TTS", "default")
+        self.latency = latency if latency else LatencyModel(0.2, perUnit=0.02)
+        self.secondsPerChar = secondsPerChar
+
+    def synthesize(self, text: str) -> str:
+        time.sleep(self.latency.sample(len(text)))
+        path = os.path.join(self.save_path, f"fake-{threading.get_ident()}.wav").replace('\\', '/')
+        return writeSilence(path, len(text) * self.secondsPerChar)
+
+    def checkConnection(self):
+        pass
@@ -0,0 +1,121 @@
+"""
+该文件基于APIWrapper实现了Whisper、Waltz与Bert-VITS2推理端的替身服务器，接口与modules/*/下的推理端保持一致，
+但不加载任何模型，仅按照LatencyModel模拟推理耗时，以便在没有GPU服务器的情况下测试远端后端
+
+运行方式(于项目根目录)：python -m benchmarks.stub_servers
+"""
+import threading
+import time
+
+from flask import request, abort
+from werkzeug.serving import make_server
+
+from APIWrapper import APIWrapper, SessionCache
+from benchmarks.fakes import LatencyModel
+
+SAMPLE_RATE = 16000  # Bert-VITS2替身返回音频的采样率
+SECONDS_PER_CHAR = 0.2  # Bert-VITS2替身返回音频的时长(每个字符)
+
+
+def createWhisperStub(latency: LatencyModel = None, port: int = 5001) -> APIWrapper:
+    """
+    创建Whisper推理端替身，对应modules/ASR/asr_server.py
+    :param latency: LatencyModel 延迟模型，输入规模为音频秒数
+    :param port: int 监听端口
+    :return: APIWrapper
+    """
+    latency = latency if latency else LatencyModel(0.3, perUnit=0.05)
+    api_app = APIWrapper(secretKey="stub", port=port, listen=False)
+
+    @api_app.addRoute("/transcribe", methods=["POST"])
+    def transcribe():
+        audio = request.get_json()
+        raw = audio.get("raw")
+        if not raw:
+            return {"time": api_app.getISOTime(), "content": "No audio data received!"}, 400
+        samples = len(raw) // 2 if isinstance(raw, bytes) else len(raw)
+        time.sleep(latency.sample(samples / audio.get("sampling_rate", 48000)))
+        return {"time": api_app.getISOTime(), "content": "今天天气怎么样？"}, 200
+
+    return api_app
+
+
+def createWaltzStub(latency: LatencyModel = None, reply: str = "今天是晴天，适合出门散步。", port: int = 5002) -> APIWrapper:
+    """
+    创建Waltz推理端替身，对应modules/NLG/nlg_server.py
+    :param latency: LatencyModel 延迟模型，输入规模为历史记录与本次输入的总字符数
+    :param reply: str 固定的回复内容
+    :param port: int 监听端口
+    :return: APIWrapper
+    """
+    latency = latency if latency else LatencyModel(1.0, perUnit=0.0005)
+    api_app = APIWrapper(secretKey="stub", port=port, listen=False)
+    session_cache = SessionCache()
+
+    @api_app.addRoute('/singleQuery', methods=['POST'])
+    def singleQuery():
+        data = request.get_json()
+        time.sleep(latency.sample(len(data.get("message", ""))))
+        return {"time": api_app.getISOTime(), "content": reply}, 200
+
+    @api_app.addRoute('/continuedQuery', methods=['POST'])
+    def continuedQuery():
+        data = request.get_json()
+        session_id, turn, message = data.get("session_id"), data.get("turn", 0), data.get("message", "")
+        if session_id and "history" not in data:
+            history = session_cache.get(session_id, turn)
+        else:
+            history = data.get("history", [])
+        size = sum(len(item.get("content", "")) for item in history)
+        time.sleep(latency.sample(size + len(message)))
+        if session_id:
+            history = history + [{"role": "user", "content": message}, {"role": "assistant", "content": reply}]
+            session_cache.put(session_id, history, turn + 1)
+        return {"time": api_app.getISOTime(), "content": reply}, 200
+
+    return api_app
+
+
+def createBertVITS2Stub(latency: LatencyModel = None, port: int = 5003) -> APIWrapper:
+    """
+    创建Bert-VITS2推理端替身，对应modules/TTS/tts_server_bert_vits2.py，返回与文本长度相符的静音音频
+    :param latency: LatencyModel 延迟模型，输入规模为文本字符数
+    :param port: int 监听端口
+    :return: APIWrapper
+    """
+    latency = latency if latency else LatencyModel(0.2, perUnit=0.02)
+    api_app = APIWrapper(secretKey="stub", port=port, listen=False)
+
+    @api_app.addRoute('/synthesize', methods=['POST'])
+    def synthesize():
+        data = request.get_json()
+        text = data.get("text", None)
+        if text is None:
+            abort(400)
+        time.sleep(latency.sample(len(text)))
+        samples = int(len(text) * SECONDS_PER_CHAR * SAMPLE_RATE)
+        result = {"sampling_rate": SAMPLE_RATE, "dtype": "int16", "segments": []}
+        if api_app.wantsBinary():
+            return api_app.binaryResponse({**result, "raw": b"\x00\x00" * samples})
+        return {**result, "raw": [0] * samples}, 200
+
+    return api_app
+
+
+def serveInBackground(api_app: APIWrapper) -> str:
+    """
+    在后台线程中以多线程模式运行APIWrapper，并返回可供远端后端使用的host
+    :param api_app: APIWrapper
+    :return: str 形如"http://127.0.0.1:5001/"的地址
+    """
+    api_app.ready = True
+    server = make_server(api_app.host, api_app.port, api_app.flaskApp, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://{api_app.host}:{api_app.port}/"
+
+
+if __name__ == "__main__":
+    for stub in (createWhisperStub(), createWaltzStub(), createBertVITS2Stub()):
+        print(f"Stub server running at {serveInBackground(stub)}")
+    while True:
+        time.sleep(3600)
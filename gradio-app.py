@@ -1,16 +1,153 @@
 """本文件为整个项目的主文件，并使用gradio搭建界面"""
 import subprocess
 import traceback
+import uuid
 
 import gradio as gr
 from modules.NLG import *
 from modules.ASR import *
 from modules.TTS import *
 from modules import utils
+from modules.balancer import hostPools
+from modules.cancellation import TurnCancelled, TurnToken, turnRegistry, turnScope
+from modules.compaction import historyCompactor
+from modules.conversation import ConversationStore
+from modules.resilience import resilience
+from modules.timeouts import adaptiveTimeouts
+from modules.tracing import createTracer, TracedBackend
+from modules.usage import usageLedger, usageScope
+
+
+def createNLGService(service_name: str) -> NLGBase | None:
+    """
+    根据名称创建NLG后端
+    :param service_name: str NLGEnum中的名称
+    :return: NLGBase | None 未知的名称返回None
+    """
+    if service_name == NLGEnum.ChatGPT.name:
+        return ChatGPT(utils.Configs["OpenAI"])
+    elif service_name == NLGEnum.ChatGLM.name:
+        return ChatGLM(utils.Configs["ZhipuAI"])
+    elif service_name == NLGEnum.Waltz.name:
+        return Waltz(utils.Configs["Waltz"])
+    elif service_name == NLGEnum.ERNIE_Bot.name:
+        return ERNIEBot(utils.Configs["Baidu"]["nlg"])
+    elif service_name == NLGEnum.Qwen.name:
+        return Qwen(utils.Configs["Aliyun"])
+    elif service_name == NLGEnum.Gemini.name:
+        return Gemini(utils.Configs["Google"])
+    elif service_name == NLGEnum.Spark.name:
+        return Spark(utils.Configs["XFyun"])
+    elif service_name == NLGEnum.Auto.name:
+        return createAutoRouter(utils.Configs.get("AutoRouting", {}))
+    return None
+
+
+def createAutoRouter(AutoRouting_config: dict) -> AutoRouter:
+    """
+    根据配置创建AutoRouter，各后端单独包装容错层，创建失败(如网络不可用)的后端不参与选择
+    :param AutoRouting_config: dict 形如{"backends": [NLGEnum中的名称...], "latency_weight": float,
+    "first_token_weight": float, "error_weight": float, "cost_weight": float, "exploration": float, "decay": float}的配置
+    :return: AutoRouter
+    """
+    backends = {}
+    for name in AutoRouting_config.get("backends", []):
+        if name == NLGEnum.Auto.name:
+            continue
+        try:
+            backend = createNLGService(name)
+        except Exception as e:
+            print(f"Failed to create NLG backend '{name}' for auto routing: {e}")
+            continue
+        if backend is not None:
+            backends[name] = resilience.wrap(backend)
+    return AutoRouter(
+        backends,
+        AutoRouting_config.get("latency_weight", 1.0),
+        AutoRouting_config.get("first_token_weight", 0.5),
+        AutoRouting_config.get("error_weight", 5.0),
+        AutoRouting_config.get("cost_weight", 0.0),
+        AutoRouting_config.get("exploration", 0.05),
+        AutoRouting_config.get("decay", 0.2)
+    )
+
+
+tracer = createTracer(utils.Configs.get("Tracing", {}))  # 记录每轮对话中各阶段的耗时
+conversation_store = ConversationStore(utils.Configs.get("Conversation", {}).get("path", "conversations.db"))
+if historyCompactor and utils.Configs["Compaction"].get("backend"):  # 使用廉价的后端生成摘要，未指定时使用当前的后端
+    compaction_service = createNLGService(utils.Configs["Compaction"]["backend"])
+    historyCompactor.backend = resilience.wrap(compaction_service) if compaction_service else None
+# 容错层包装在最内层，分段识别与分句合成时每段单独重试
+nlg_service = TracedBackend(resilience.wrap(ChatGLM(utils.Configs["ZhipuAI"])), tracer, "nlg")
+asr_service = TracedBackend(createSegmentedASR(resilience.wrap(BaiduASR(utils.Configs["Baidu"]["asr"])),
+                                               utils.Configs.get("ASRSegmentation", {})), tracer, "asr")
+tts_service = TracedBackend(createChunkedTTS(resilience.wrap(BaiduTTS(utils.Configs["Baidu"]["tts"])),
+                                             utils.Configs.get("TTSChunking", {})), tracer, "tts")
+
+
+def warnIfUnavailable(service) -> None:
+    """
+    切换后端后，若其所在主机的熔断器处于打开状态，则提示用户(此时的调用将立即失败)
+    :param service: ASRBase | NLGBase | TTSBase
+    """
+    state = resilience.snapshot().get(resilience.keyOf(service))
+    if state and state["state"] == "open":
+        gr.Warning(f"{service.type.name}近期连续请求失败，将在{state['retry_after']:.0f}秒后重试连接")
+
+
+def resolveConversation(conversation: str, request: gr.Request, default: str = None) -> str:
+    """
+    确定请求所使用的会话id，所有读取、追加或清除会话的处理函数均应经过此函数
+
+    启用登录时只使用用户名对应的会话，忽略客户端传入的id，避免读取、修改他人的会话
+    :param conversation: str 客户端传入的会话id
+    :param request: gr.Request 由gradio自动传入
+    :param default: str 未传入会话id时使用的id，为None时使用页面的session_hash(页面尚未加载完成时的临时会话)
+    :return: str 会话id
+    """
+    if request.username:
+        return f"user:{request.username}"
+    return (conversation or "").strip() or default or request.session_hash
+
+
+def generateReply(message: str, session, turn: TurnToken) -> str:
+    """
+    生成回复，后端支持时使用流式查询，以便本轮对话被打断时及时关闭上游连接(各片段之间也会检查是否已被打断)，
+    流式查询在产生首个片段之前的瞬时故障仍会重试(详见modules.resilience.Resilience.stream)
+    :param message: str 用户输入的消息
+    :param session: Session 会话句柄
+    :param turn: TurnToken 本轮的令牌
+    :return: str 完整的回复
+    """
+    if not hasattr(nlg_service, "streamContinuedQuery"):
+        return nlg_service.continuedQuery(message, session)
+    reply, stream = "", nlg_service.streamContinuedQuery(message, session)
+    try:
+        for chunk in stream:
+            turn.check()
+            reply += chunk or ""
+    finally:
+        stream.close()  # 被打断时立即关闭，归还熔断器的探测名额
+    return reply
+
+
+def speak(text: str, turn: TurnToken) -> None:
+    """
+    合成语音并调用ffplay播放，本轮对话被打断时放弃尚未完成的合成，或终止正在进行的播放
+    :param text: str 待合成的文本
+    :param turn: TurnToken 本轮的令牌
+    """
+    try:
+        synth_audio_path = tts_service.synthesize(text)
+        turn.check()
+    except Exception:
+        if turn.cancelled:  # 回复已显示并保存，仅放弃播放
+            return
+        raise
+    with tracer.span("playback.launch"):
+        process = subprocess.Popen(["ffplay", "-noborder", "-nodisp", "-autoexit", "-i", synth_audio_path])  # 调用ffplay播放音频
+    turn.onCancel(process.terminate)
 
-nlg_service = ChatGLM(utils.Configs["ZhipuAI"])
-asr_service = BaiduASR(utils.Configs["Baidu"]["asr"])
-tts_service = BaiduTTS(utils.Configs["Baidu"]["tts"])
 
 with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css/GenshinStyle.css",
                js="./assets/js/GenshinStyle.js") as demo:
@@ -22,6 +159,8 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
                                      label="选择NLG模型", elem_id="nlgSwitch")
             tts_switch = gr.Dropdown([i.name for i in TTSEnum], value=tts_service.type.name, interactive=True,
                                      label="选择TTS模型", elem_id="ttsSwitch")
+            conversation_id = gr.Textbox(label="会话ID(输入以前的会话ID并回车可继续该会话)", max_lines=1,
+                                         elem_id="conversationId")
         with gr.Column(scale=5, elem_id="chatPanel"):
             bot_component = gr.Chatbot(label=nlg_service.type.name, avatar_images=utils.getAvatars(), elem_id="chatbot")
             with gr.Row(elem_id="inputPanel"):
@@ -32,17 +171,26 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
                 clear_button = gr.Button(value="清除", size="sm", min_width=80, elem_id="cleanButton")
 
 
-        def textChat(message: str, chat_history: list):
+        def textChat(message: str, chat_history: list, conversation: str, request: gr.Request):
             """
             与聊天机器人进行文本聊天
             :param message: str 用户输入的消息
             :param chat_history: [[str, str]...] 分别为用户输入和机器人回复(先前的)
-            :return: tuple[str, list[list[str, str]]] 空字符串(用以清空输入框), 更新的消息记录
+            :param conversation: str 会话id(详见loadConversation)
+            :param request: gr.Request 由gradio自动传入，其session_hash用于打断同一页面中正在进行的一轮对话
+            :return: tuple[str, list[list[str, str]]] 空字符串(用以清空输入框), 更新的消息记录；
+            回复生成完毕前被新的输入打断时不更新界面，也不保存本轮对话
             """
-            bot_message = nlg_service.continuedQuery(message, chat_history)
-            chat_history.append((message, bot_message))
-            synth_audio_path = tts_service.synthesize(bot_message)
-            subprocess.Popen(["ffplay", "-noborder", "-nodisp", "-autoexit", "-i", synth_audio_path])
+            turn = turnRegistry.begin(request.session_hash)
+            session = conversation_store.open(resolveConversation(conversation, request))
+            try:
+                with tracer.trace("text_turn"), usageScope(session.session_id, request.username), turnScope(turn):
+                    bot_message = generateReply(message, session, turn)
+                    session.appendExchange(message, bot_message)
+                    chat_history.append((message, bot_message))
+                    speak(bot_message, turn)
+            except TurnCancelled:
+                return gr.update(), gr.update()
             return "", chat_history
 
 
@@ -53,14 +201,17 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
             :param chat_history: [[str, str]...] 分别为用户输入和机器人回复(先前的)
             """
             this_chat = [message, ""]  # 当前的聊天记录
-            for chunk in nlg_service.streamContinuedQuery(message, chat_history):
-                this_chat[-1] += chunk
-                bot_component.value = chat_history.extend(tuple(this_chat))
-            synth_audio_path = tts_service.synthesize(this_chat[-1])
-            subprocess.Popen(["ffplay", "-noborder", "-nodisp", "-autoexit", "-i", synth_audio_path])  # 调用ffplay播放音频
+            with tracer.trace("text_turn", stream=True):
+                for chunk in nlg_service.streamContinuedQuery(message, chat_history):
+                    this_chat[-1] += chunk
+                    bot_component.value = chat_history.extend(tuple(this_chat))
+                synth_audio_path = tts_service.synthesize(this_chat[-1])
+                with tracer.span("playback.launch"):
+                    subprocess.Popen(["ffplay", "-noborder", "-nodisp", "-autoexit", "-i", synth_audio_path])  # 调用ffplay播放音频
 
 
-        def autoChat(audio: PathLike, message: str, chat_history: list) -> tuple[str, list[list[str, str]]]:
+        def autoChat(audio: PathLike, message: str, chat_history: list, conversation: str,
+                     request: gr.Request) -> tuple[str, list[list[str, str]]]:
             """
             自动根据当前前端信息，选择聊天方式进行聊天
 
@@ -68,16 +219,27 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
             :param audio: PathLike 语音文件路径
             :param message: str 用户输入的消息
             :param chat_history: [[str, str]...] 分别为用户输入和机器人回复(先前的)
-            :return: tuple[str, list[list[str, str]]] 空字符串(用以清空输入框), 更新的消息记录
+            :param conversation: str 会话id(详见loadConversation)
+            :param request: gr.Request 由gradio自动传入，其session_hash用于打断同一页面中正在进行的一轮对话
+            :return: tuple[str, list[list[str, str]]] 空字符串(用以清空输入框), 更新的消息记录；
+            回复生成完毕前被新的输入打断时不更新界面，也不保存本轮对话
             """
             if not audio and not message:
                 return "", chat_history
-            elif audio:  # 语音聊天
-                message = asr_service.transcribe(audio)  # 语音识别结果
-            bot_message = nlg_service.continuedQuery(message, chat_history)
-            chat_history.append((message, bot_message))
-            synth_audio_path = tts_service.synthesize(bot_message)
-            subprocess.Popen(["ffplay", "-noborder", "-nodisp", "-autoexit", "-i", synth_audio_path])  # 调用ffplay播放音频
+            turn = turnRegistry.begin(request.session_hash)
+            session = conversation_store.open(resolveConversation(conversation, request))
+            try:
+                with tracer.trace("voice_turn" if audio else "text_turn"), \
+                        usageScope(session.session_id, request.username), turnScope(turn):
+                    if audio:  # 语音聊天
+                        message = asr_service.transcribe(audio)  # 语音识别结果
+                        turn.check()
+                    bot_message = generateReply(message, session, turn)
+                    session.appendExchange(message, bot_message)
+                    chat_history.append((message, bot_message))
+                    speak(bot_message, turn)
+            except TurnCancelled:
+                return gr.update(), gr.update()
             return "", chat_history
 
 
@@ -94,15 +256,17 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
                 text_input.value = ""
                 bot_component.value = chat_history
                 return
-            elif audio:
-                message = asr_service.transcribe(audio)  # 语音识别结果
-            new_chat_history = chat_history.copy()
-            new_chat_history.append((message, ""))
-            for chunk in nlg_service.streamContinuedQuery(message, chat_history):
-                new_chat_history[-1][1] += chunk
-                bot_component.value = new_chat_history
-            synth_audio_path = tts_service.synthesize(new_chat_history[-1][1])
-            subprocess.Popen(["ffplay", "-noborder", "-nodisp", "-autoexit", "-i", synth_audio_path])  # 调用ffplay播放音频
+            with tracer.trace("voice_turn" if audio else "text_turn", stream=True):
+                if audio:
+                    message = asr_service.transcribe(audio)  # 语音识别结果
+                new_chat_history = chat_history.copy()
+                new_chat_history.append((message, ""))
+                for chunk in nlg_service.streamContinuedQuery(message, chat_history):
+                    new_chat_history[-1][1] += chunk
+                    bot_component.value = new_chat_history
+                synth_audio_path = tts_service.synthesize(new_chat_history[-1][1])
+                with tracer.span("playback.launch"):
+                    subprocess.Popen(["ffplay", "-noborder", "-nodisp", "-autoexit", "-i", synth_audio_path])  # 调用ffplay播放音频
 
 
         def switchNLG(select_service_name: str):
@@ -117,23 +281,15 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
                 return current_service_name
             else:  # 尝试切换模型
                 try:
-                    if select_service_name == NLGEnum.ChatGPT.name:
-                        temp_service = ChatGPT(utils.Configs["OpenAI"])
-                    elif select_service_name == NLGEnum.Waltz.name:
-                        temp_service = Waltz(utils.Configs["Waltz"])
-                    elif select_service_name == NLGEnum.ERNIE_Bot.name:
-                        temp_service = ERNIEBot(utils.Configs["Baidu"]["nlg"])
-                    elif select_service_name == NLGEnum.Qwen.name:
-                        temp_service = Qwen(utils.Configs["Aliyun"])
-                    elif select_service_name == NLGEnum.Gemini.name:
-                        temp_service = Gemini(utils.Configs["Google"])
-                    elif select_service_name == NLGEnum.Spark.name:
-                        temp_service = Spark(utils.Configs["XFyun"])
-                    else:  # 未知的模型选择，不执行切换
+                    temp_service = createNLGService(select_service_name)
+                    if temp_service is None:  # 未知的模型选择，不执行切换
                         gr.Warning(f"未知的NLG模型，将不进行切换，当前：{current_service_name}")
                         return current_service_name
-                    nlg_service = temp_service
+                    if temp_service.type != NLGEnum.Auto:  # AutoRouter中的各后端已单独包装容错层
+                        temp_service = resilience.wrap(temp_service)
+                    nlg_service = TracedBackend(temp_service, tracer, "nlg")
                     gr.Info(f"模型切换成功，当前：{nlg_service.type.name}")
+                    warnIfUnavailable(temp_service)
                     return nlg_service.type.name
                 except Exception:
                     traceback.print_exc()
@@ -162,7 +318,10 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
                     else:  # 未知的模型选择，不执行切换
                         gr.Warning(f"未知的ASR模型，将不进行切换，当前：{current_service_name}")
                         return current_service_name
-                    asr_service = temp_service
+                    warnIfUnavailable(temp_service)
+                    temp_service = createSegmentedASR(resilience.wrap(temp_service),
+                                                      utils.Configs.get("ASRSegmentation", {}))
+                    asr_service = TracedBackend(temp_service, tracer, "asr")
                     gr.Info(f"模型切换成功，当前：{asr_service.type.name}")
                     return asr_service.type.name
                 except Exception:
@@ -192,7 +351,9 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
                     else:  # 未知的模型选择，不执行切换
                         gr.Warning(f"未知的TTS模型，将不进行切换，当前：{current_service_name}")
                         return current_service_name
-                    tts_service = temp_service
+                    warnIfUnavailable(temp_service)
+                    temp_service = createChunkedTTS(resilience.wrap(temp_service), utils.Configs.get("TTSChunking", {}))
+                    tts_service = TracedBackend(temp_service, tracer, "tts")
                     gr.Info(f"模型切换成功，当前：{tts_service.type.name}")
                     return tts_service.type.name
                 except Exception:
@@ -201,18 +362,74 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
                     return current_service_name
 
 
+        def bargeIn(request: gr.Request) -> None:
+            """
+            打断本会话正在进行的一轮对话(停止生成、合成与播放)，在用户发送新消息或开始录音时立即调用
+            :param request: gr.Request 由gradio自动传入
+            """
+            turnRegistry.cancel(request.session_hash)
+
+
+        def clearChat(message: str, chat_history: list, audio_data: PathLike, conversation: str, request: gr.Request):
+            """
+            清除输入与聊天记录(同时清除会话存储中的记录)，并打断正在进行的一轮对话
+            """
+            turnRegistry.cancel(request.session_hash)
+            conversation = resolveConversation(conversation, request)
+            conversation_store.open(conversation).clear()
+            conversation_store.close(conversation)
+            return "", [], None
+
+
+        def loadConversation(conversation: str, request: gr.Request) -> tuple[str, list[list[str, str]]]:
+            """
+            确定本页面使用的会话id并恢复其聊天记录，页面刷新或程序重启后仍能继续之前的会话
+
+            优先级：登录的用户名 > 链接参数conversation > 浏览器中保存的会话id(localStorage) > 新的随机id；
+            启用登录时只使用用户名，避免读取他人的会话(详见resolveConversation)
+            :param conversation: str 浏览器中保存的会话id，或用户输入的会话id
+            :param request: gr.Request 由gradio自动传入
+            :return: tuple[str, list[list[str, str]]] 会话id, 该会话的聊天记录
+            """
+            conversation = resolveConversation(request.query_params.get("conversation") or conversation, request,
+                                               uuid.uuid4().hex)
+            return conversation, conversation_store.open(conversation).toHistory()
+
+
+        def resumeConversation(conversation: str, request: gr.Request) -> tuple[str, list[list[str, str]]]:
+            """
+            切换到用户输入的会话id(打断当前正在进行的一轮对话)
+            """
+            turnRegistry.cancel(request.session_hash)
+            conversation = resolveConversation(conversation, request, uuid.uuid4().hex)
+            return conversation, conversation_store.open(conversation).toHistory()
+
+
         # 按钮绑定事件
         clear_button.click(
-            fn=lambda message, chat_history, audio_data: ("", [], None),
-            inputs=[text_input, bot_component, audio_input],
+            fn=clearChat,
+            inputs=[text_input, bot_component, audio_input, conversation_id],
             outputs=[text_input, bot_component, audio_input]
         )
         # if "streamContinuedQuery" in dir(nlg_service):  # 优先使用流式聊天 TODO: 测试阶段，暂时关闭流式聊天
         #     submit_button.click(autoStreamChat, [audio_input, text_input, bot_component])
         #     text_input.submit(textStreamChat, [text_input, bot_component])
         # else:
-        submit_button.click(autoChat, [audio_input, text_input, bot_component], [text_input, bot_component])
-        text_input.submit(textChat, [text_input, bot_component], [text_input, bot_component])
+        # 先不经过队列立即打断上一轮，上一轮随即结束并让出队列，再开始新的一轮
+        submit_button.click(bargeIn, queue=False).then(
+            autoChat, [audio_input, text_input, bot_component, conversation_id], [text_input, bot_component]
+        )
+        text_input.submit(bargeIn, queue=False).then(
+            textChat, [text_input, bot_component, conversation_id], [text_input, bot_component]
+        )
+        audio_input.start_recording(bargeIn, queue=False)  # 用户开始说话时打断正在播放的回复
+
+        # 会话：页面加载时恢复浏览器中保存的会话，会话id变化时写回浏览器
+        demo.load(loadConversation, [conversation_id], [conversation_id, bot_component],
+                  js="(conversation) => localStorage.getItem('conversationId') || conversation")
+        conversation_id.submit(resumeConversation, [conversation_id], [conversation_id, bot_component])
+        conversation_id.change(None, [conversation_id], None,
+                               js="(conversation) => { if (conversation) localStorage.setItem('conversationId', conversation); }")
 
         # 切换模型
         nlg_switch.change(switchNLG, [nlg_switch], [nlg_switch])
@@ -220,4 +437,35 @@ with gr.Blocks(theme=gr.themes.Soft(), title="Chatbot Client", css="./assets/css
         tts_switch.change(switchTTS, [tts_switch], [tts_switch])
 
 if __name__ == "__main__":
-    demo.launch()
+    metrics_config = utils.Configs.get("ClientMetrics", {})
+    if metrics_config.get("enabled", False):  # 将界面挂载到FastAPI上，并提供/metrics接口(Prometheus文本格式)
+        import uvicorn
+        from fastapi import FastAPI
+        from fastapi.responses import PlainTextResponse
+
+        app = FastAPI()
+
+
+        @app.get("/metrics", response_class=PlainTextResponse)
+        def metrics():
+            return adaptiveTimeouts.export() + resilience.export() + hostPools.export() + \
+                (usageLedger.export() if usageLedger else "") + \
+                (nlg_service.export() if nlg_service.type == NLGEnum.Auto else "")
+
+
+        @app.get("/usage")
+        def usage(backend: str = None, model: str = None, session: str = None, user: str = None,
+                  since: float = None, until: float = None, group_by: str = "backend,model"):
+            """
+            按后端、模型、会话、用户与时间范围(Unix时间戳)汇总NLG用量，group_by为逗号分隔的分组列
+            """
+            if usageLedger is None:
+                return []
+            return usageLedger.query(backend, model, session, user, since, until,
+                                     tuple(column for column in group_by.split(",") if column))
+
+
+        app = gr.mount_gradio_app(app, demo, path="/")
+        uvicorn.run(app, host=metrics_config.get("host", "127.0.0.1"), port=metrics_config.get("port", 7860))
+    else:
+        demo.launch()
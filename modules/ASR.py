@@ -1,14 +1,22 @@
 """该文件定义了语音识别的后端类"""
+import contextvars
 import os
+import re
+import tempfile
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from os import PathLike
 from typing import Union
 from urllib.parse import urljoin
 
+import numpy as np
 import requests
-from scipy.io.wavfile import read as wavread
+from scipy.io.wavfile import read as wavread, write as wavwrite
 
-from modules.utils import ASREnum
+from modules.balancer import hostPools
+from modules.timeouts import adaptiveTimeouts
+from modules.tracing import getTraceHeaders
+from modules.utils import ASREnum, getDeadlineHeader, encodeBody, decodeResponse, checkResponse
 
 
 class ASRBase:
@@ -40,8 +48,11 @@ class Whisper(ASRBase):
         self.host, self.secret = None, None
         self.mode = Whisper_config.get("mode", "remote")
         if self.mode == "remote":
-            self.host = Whisper_config.get("host", None)
+            self.pool = hostPools.create(self.model, Whisper_config)  # host可为多个主机地址，按balancing策略分配请求
+            self.host = self.pool.hosts[0] if self.pool else None
             self.secret = Whisper_config.get("secret", None)
+            self.serialization = Whisper_config.get("serialization", "json")  # 请求/响应的序列化方式，json或msgpack
+            self.compression = Whisper_config.get("compression", None)  # 请求/响应的压缩方式，gzip、zstd或不压缩
             if not self.host:
                 raise ValueError("Whisper host is not set! Please check your 'config.json' file.")
             self.checkConnection()
@@ -58,37 +69,49 @@ class Whisper(ASRBase):
         :return: str 识别结果
         """
         sample_rate, raw = wavread(audio)
-        raw = raw.tolist()
+        body, headers = encodeBody({
+            "sampling_rate": sample_rate,
+            "raw": raw.tobytes() if self.serialization == "msgpack" else raw.tolist(),  # msgpack模式下直接发送原始采样
+            "dtype": str(raw.dtype)
+        }, self.serialization, self.compression)
+        policy = adaptiveTimeouts.get(f"{self.model}/transcribe", 20, floor=3, cap=60, unit="audio_second")
         try:
-            response = requests.post(
-                url=urljoin(self.host, 'transcribe'),
-                params={"secret": self.secret},
-                json={"sampling_rate": sample_rate, "raw": raw},
-                timeout=20
-            )
+            with self.pool.request() as host, policy.measure(len(raw) / sample_rate) as timeout:
+                response = checkResponse(requests.post(
+                    url=urljoin(host, 'transcribe'),
+                    params={"secret": self.secret},
+                    headers={**headers, **getDeadlineHeader(timeout), **getTraceHeaders()},
+                    data=body,
+                    timeout=timeout
+                ))
         except requests.exceptions.Timeout:
             raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
-        return response.json().get("content", "")
+        return decodeResponse(response).get("content", "")
 
     def checkConnection(self):
         """
         检查与远端Whisper的连接状态
         :return: bool 是否连接成功
         """
-        try:
-            request = requests.get(
-                url=self.host,
-                params={"secret": self.secret},
-                timeout=10
-            )
-            if not request.status_code == 200:
+
+        def check(host: str):
+            try:
+                request = requests.get(
+                    url=host,
+                    params={"secret": self.secret},
+                    timeout=10
+                )
+                if not request.status_code == 200:
+                    raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
+            except requests.exceptions.Timeout:
+                raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
+            except requests.exceptions.ConnectionError:
                 raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
-        except requests.exceptions.Timeout:
-            raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
+
+        try:
+            self.pool.checkAll(check)  # 配置了多个主机时，只要有一个主机可用即视为连接成功
         finally:
             print("Whisper remote mode connection check finished.")
 
@@ -194,5 +217,160 @@ class BaiduASR(ASRBase):
             raise e
 
 
+def findSilences(samples: np.ndarray, sampleRate: int, frameSeconds: float = 0.03, marginDb: float = 10.0,
+                 minSilenceSeconds: float = 0.3) -> list[tuple[float, float]]:
+    """
+    基于短时能量的静音检测(VAD)：能量低于噪声底(第10百分位)+marginDb的帧视为静音
+    :param samples: np.ndarray 音频采样，多声道时取均值
+    :param sampleRate: int 采样率
+    :param frameSeconds: float 帧长(秒)
+    :param marginDb: float 静音阈值高于噪声底的分贝数
+    :param minSilenceSeconds: float 最短静音时长(秒)，更短的停顿不作为切分点
+    :return: list[tuple[float, float]] 各段静音的起止时间(秒)
+    """
+    mono = samples.mean(axis=1) if samples.ndim > 1 else samples
+    frame = max(1, int(frameSeconds * sampleRate))
+    count = len(mono) // frame
+    if count == 0:
+        return []
+    frames = mono[:count * frame].astype(np.float64).reshape(count, frame)
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    silent = energy < np.percentile(energy, 10) + marginDb
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))  # 1为静音段起点，-1为静音段终点
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    minFrames = minSilenceSeconds / frameSeconds
+    return [(start * frameSeconds, end * frameSeconds) for start, end in zip(starts, ends) if end - start >= minFrames]
+
+
+class SegmentedASR(ASRBase):
+    """
+    对任意ASRBase的包装：将较长的录音在静音处切分为若干段，以有限的并发数同时识别，再按顺序拼接文本
+
+    找不到合适的静音时在maxSegmentSeconds处强制切分，相邻两段重叠overlapSeconds，拼接时去除重复的文字。
+    短于segmentSeconds的录音直接交由被包装的后端识别。其余属性均转发至被包装的后端
+    """
+
+    def __init__(self, backend: ASRBase, segmentSeconds: float = 15.0, maxSegmentSeconds: float = 55.0,
+                 maxWorkers: int = 4, overlapSeconds: float = 0.5, marginDb: float = 10.0,
+                 minSilenceSeconds: float = 0.3):
+        """
+        :param backend: ASRBase 被包装的后端，其transcribe应接受wav文件路径
+        :param segmentSeconds: float 期望的分段时长(秒)，切分点选在最接近该时长的静音处
+        :param maxSegmentSeconds: float 分段时长上限(秒)，如百度短语音识别的上限为60秒
+        :param maxWorkers: int 同时识别的最大分段数
+        :param overlapSeconds: float 强制切分时相邻分段的重叠时长(秒)
+        :param marginDb: float 静音检测的阈值，详见findSilences
+        :param minSilenceSeconds: float 可作为切分点的最短静音时长(秒)
+        """
+        super().__init__(backend.type, backend.model)
+        self.backend = backend
+        self.segmentSeconds = segmentSeconds
+        self.maxSegmentSeconds = maxSegmentSeconds
+        self.overlapSeconds = overlapSeconds
+        self.marginDb = marginDb
+        self.minSilenceSeconds = minSilenceSeconds
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="asr-segment")
+
+    def __getattr__(self, name: str):
+        if name == "backend":
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def split(self, samples: np.ndarray, sampleRate: int) -> list[tuple[float, float, bool]]:
+        """
+        计算分段
+        :param samples: np.ndarray 音频采样
+        :param sampleRate: int 采样率
+        :return: list[tuple[float, float, bool]] 各分段的起止时间(秒)，以及该分段的起点是否为强制切分(与上一段重叠)
+        """
+        duration = len(samples) / sampleRate
+        cuts = [(silenceStart + silenceEnd) / 2 for silenceStart, silenceEnd in
+                findSilences(samples, sampleRate, marginDb=self.marginDb, minSilenceSeconds=self.minSilenceSeconds)]
+        segments, start, forced = [], 0.0, False
+        while duration - start > self.segmentSeconds:
+            lower, upper = start + self.segmentSeconds / 2, min(start + self.maxSegmentSeconds, duration)
+            candidates = [cut for cut in cuts if lower <= cut <= upper]
+            if candidates:
+                end = min(candidates, key=lambda cut: abs(cut - start - self.segmentSeconds))
+                segments.append((start, end, forced))
+                start, forced = end, False
+            elif upper >= duration:  # 剩余部分不超过上限且没有合适的静音，不再切分
+                break
+            else:
+                segments.append((start, upper, forced))
+                start, forced = upper - self.overlapSeconds, True
+        segments.append((start, duration, forced))
+        return segments
+
+    @staticmethod
+    def stitch(texts: list[str], overlapped: list[bool], maxOverlapChars: int = 20) -> str:
+        """
+        按顺序拼接各分段的识别结果，对于重叠的分段，去除与上一段末尾重复的文字
+        :param texts: list[str] 各分段的识别结果
+        :param overlapped: list[bool] 各分段是否与上一段重叠
+        :param maxOverlapChars: int 去重时比较的最大字符数
+        :return: str
+        """
+        result = ""
+        for text, overlap in zip(texts, overlapped):
+            text = text.strip()
+            if not text:
+                continue
+            merged = False  # 去重后剩余的文字直接接续上一段(可能处于同一个单词中间)
+            if overlap and result:
+                for size in range(min(maxOverlapChars, len(result), len(text)), 0, -1):
+                    if result.endswith(text[:size]):
+                        text, merged = text[size:], True
+                        break
+            if not merged and result and text and re.match(r"\w", result[-1], re.ASCII) and re.match(r"\w", text[0], re.ASCII):
+                result += " "  # 英文单词之间保留空格
+            result += text
+        return result
+
+    def transcribe(self, audio: PathLike) -> str:
+        """
+        语音识别
+
+        录音较短时直接调用被包装的后端，否则分段并行识别后拼接
+        :param audio: PathLike wav文件路径
+        :return: str 识别结果
+        """
+        sample_rate, raw = wavread(audio)
+        if len(raw) / sample_rate <= self.segmentSeconds:
+            return self.backend.transcribe(audio)
+        segments = self.split(raw, sample_rate)
+        if len(segments) == 1:
+            return self.backend.transcribe(audio)
+        with tempfile.TemporaryDirectory(prefix="asr-segments-") as directory:
+            paths = []
+            for index, (start, end, _) in enumerate(segments):
+                path = os.path.join(directory, f"segment-{index}.wav")
+                wavwrite(path, sample_rate, raw[int(start * sample_rate):int(end * sample_rate)])
+                paths.append(path)
+            # 线程池中的线程不继承contextvars，每段复制一份当前的上下文(追踪的请求id、本轮对话的令牌等)
+            futures = [self.executor.submit(contextvars.copy_context().run, self.backend.transcribe, path)
+                       for path in paths]
+            texts = [future.result() for future in futures]
+        return self.stitch(texts, [forced for _, _, forced in segments])
+
+
+def createSegmentedASR(backend: ASRBase, Segmentation_config: dict) -> ASRBase:
+    """
+    根据配置为后端包装SegmentedASR
+    :param backend: ASRBase 被包装的后端
+    :param Segmentation_config: dict 形如{"enabled": bool, "segment_seconds": float, "max_segment_seconds": float,
+    "max_workers": int, "overlap_seconds": float}的配置
+    :return: ASRBase 未启用时原样返回backend
+    """
+    if not Segmentation_config.get("enabled", False):
+        return backend
+    return SegmentedASR(
+        backend,
+        segmentSeconds=Segmentation_config.get("segment_seconds", 15.0),
+        maxSegmentSeconds=Segmentation_config.get("max_segment_seconds", 55.0),
+        maxWorkers=Segmentation_config.get("max_workers", 4),
+        overlapSeconds=Segmentation_config.get("overlap_seconds", 0.5)
+    )
+
 if __name__ == '__main__':
     raise NotImplementedError("This module is not runnable!")
@@ -13,7 +13,7 @@ if __name__ == "__main__":
         generate_kwargs={"task": "transcribe", "num_beams": 1, "language": "chinese"},
     )
 
-    @api_app.addRoute("/transcribe", methods=["POST"])  # 定义一个路由，用于处理语音识别任务
+    @api_app.addRoute("/transcribe", methods=["POST"], maxConcurrency=1, maxQueue=4)  # 定义一个路由，用于处理语音识别任务
     def transcribe():
         """
         处理语音识别任务
@@ -27,7 +27,10 @@ if __name__ == "__main__":
                 "time": api_app.getISOTime(),
                 "content": "No audio data received!",
             }, 400
-        y = np.array(y)  # 将list的数据重新转换为np.array
+        if isinstance(y, bytes):  # 以MessagePack传输时，音频为原始采样的二进制数据
+            y = np.frombuffer(y, dtype=audio.get("dtype", "int16"))
+        else:
+            y = np.array(y)  # 将list的数据重新转换为np.array
         y = y.astype(np.float32)
         y /= np.max(np.abs(y))
         result = transcriber({"sampling_rate": sr, "raw": y})["text"]
@@ -4,9 +4,13 @@ import hashlib
 import hmac
 import json
 import re
+import threading
+import time
 from abc import abstractmethod
 from base64 import b64encode
-from random import randint
+from collections import OrderedDict
+from contextlib import contextmanager
+from random import randint, random as randomFloat, choice as randomChoice
 from ssl import CERT_NONE as SSL_CERT_NONE
 from urllib.parse import urljoin, urlparse, urlencode
 
@@ -14,7 +18,17 @@ import google.api_core.exceptions
 import requests
 from websocket import WebSocketApp
 
-from modules.utils import NLGEnum, Configs, Message, getRFC1123, getMacAddress
+from modules.balancer import hostPools
+from modules.cancellation import checkCancelled, closeOnCancel
+from modules.compaction import historyCompactor
+from modules.conversation import Session, getSessionKey
+from modules.memory import retrievalMemory
+from modules.timeouts import adaptiveTimeouts
+from modules.tokenizer import tokenizerRegistry, estimateTokens
+from modules.tracing import getTraceHeaders, getCurrentSpan
+from modules.usage import usageLedger
+from modules.utils import NLGEnum, Configs, Message, getRFC1123, getMacAddress, getDeadlineHeader, encodeBody, \
+    decodeResponse, checkResponse, statusError
 
 
 class NLGBase:
@@ -29,6 +43,9 @@ class NLGBase:
         self.type = nlg_type  # 机器人类型
         self.model = model  # 机器人模型
         self.prompt = prompt  # 默认提示语(用于指定机器人的身份，有助于提高针对特定领域问题的效果)，优先级低于查询时传入的prompt
+        self.memory = retrievalMemory  # 检索式记忆(详见modules.memory)，为None时发送完整的历史记录
+        self.compactor = historyCompactor  # 滚动摘要压缩(详见modules.compaction)，为None时不压缩
+        self.usage = usageLedger  # 用量记账(详见modules.usage)，为None时不记录
 
     @abstractmethod
     def singleQuery(self, message: str, prompt: str = None) -> str:
@@ -42,7 +59,7 @@ class NLGBase:
         """
 
     @abstractmethod
-    def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
+    def continuedQuery(self, message: str, history: list[list[str, str]] | Session, prompt: str = None):
         """
         进行带有历史记录的查询
 
@@ -51,7 +68,8 @@ class NLGBase:
         大多数API要求历史记录(含prompt)的格式应当为[{"role": "user", "content": ""}, {"role": "assistant", "message":
         ""}...]，而大多数前端的历史记录格式为[[str, str]...]，因此需要在调用前进行转换。可借助historyConverter方法进行转换。
         :param message: str 本次用户输入
-        :param history: List[List[str, str]...] 分别为用户输入和机器人回复(先前的)
+        :param history: List[List[str, str]...] | Session 分别为用户输入和机器人回复(先前的)，或由
+        modules.conversation.ConversationStore打开的会话句柄(调用方负责在得到回复后调用Session.appendExchange)
         :param prompt: str 提示语(用于指定机器人的身份，有助于提高针对特定领域问题的效果)
         """
 
@@ -62,16 +80,42 @@ class NLGBase:
         对于多数未设计检查连接状态的API，可参考OpenAI的做法：直接让后端回复一句简单的话，若回复成功则自然连接成功。
         """
 
-    def converterHistory(self, history: [[str, str]], prompt: str = None) -> list[Message]:
+    def converterHistory(self, history: list[list[str, str]] | Session, prompt: str = None,
+                         message: str = None) -> list[Message]:
         """
         将[[str, str]...]形式的历史记录转换为[{"role": "user", "content": ""}, {"role": "assistant", "content": ""}...]的格式，
         使用场景是将gradio的Chatbot聊天记录格式转换为ChatGPT/ChatGLM3的聊天记录格式
-        :param history: [[str, str]...] 分别为用户输入和机器人回复(先前的)
+
+        若传入的是modules.conversation.Session，则直接使用其增量维护的消息列表，无需逐条转换
+
+        若启用了滚动摘要压缩(self.compactor)且传入的是Session，已并入摘要的较早对话将由摘要代替(摘要附加在提示语之后)，
+        [[str, str]...]形式的历史记录无法可靠地区分会话，不进行压缩
+
+        若启用了检索式记忆(self.memory)并传入了message，则只保留最近的若干轮与同message最相关的若干轮对话
+        :param history: [[str, str]...] | Session 分别为用户输入和机器人回复(先前的)，或会话句柄
         :param prompt: str 提示语(用于指定机器人的身份，有助于提高针对特定领域问题的效果，允许为空)
+        :param message: str 本次用户输入，仅用于检索相关的历史对话
         :return: [{"role": "user", "content": ""}, {"role": "assistant", "content": ""}...]的格式的历史记录，注意，该结果不包括
         本次的用户输入，仅转换了历史记录
         """
         sessionPrompt = prompt if prompt else self.prompt
+        exchanges, covered = None, 0
+        if self.compactor and isinstance(history, Session) and len(history):
+            exchanges = history.toHistory()
+            summary, covered = self.compactor.compact(history, exchanges, self)
+            if covered:
+                sessionPrompt = self.compactor.mergePrompt(sessionPrompt, summary)
+        if self.memory and message:
+            if exchanges is None:
+                exchanges = history.toHistory() if isinstance(history, Session) else history
+            # 传入原始的history与全部对话，使检索索引始终对应同一会话，仅从未并入摘要的对话中挑选
+            selected = self.memory.select(history, exchanges, message, start=covered)
+            if covered or len(selected) < len(exchanges):
+                history = [exchanges[i] for i in selected]
+        elif covered:
+            history = exchanges[covered:]
+        if isinstance(history, Session):
+            return history.messages(sessionPrompt)
         sessionHistory = [Message(role="system", content=sessionPrompt)] if sessionPrompt else []
         for chat in history:
             sessionHistory.append(Message(role="user", content=chat[0]))
@@ -105,12 +149,7 @@ class NLGBase:
         :param token_per_zh_char: float 每个中文字符的token数，根据经验，单个汉字的token数大概为1/2~4/3。在使用tiktoken库时，该参数无效
         :return: int 估算的token数。由于不同的API的tokenize方法不同，因此该结果仅供参考
         """
-        content = ""
-        if history:
-            for message in history:
-                content += message["content"]
-        if message:
-            content += message
+        content = "".join([message["content"] for message in history] if history else []) + (message or "")
         if NLGBase.tokenEncoding:
             return len(NLGBase.tokenEncoding.encode(content))
         else:  # 未安装tiktoken库，则只能根据经验进行估算
@@ -119,18 +158,59 @@ class NLGBase:
             token_per_en_word = 1.2  # 英文单词的token数
             if not token_per_zh_char:
                 token_per_zh_char = 1.33  # 取1:1.5
-            word_list = re.split("[ ,.?!';:()\[\]{}\t\n]", content)  # 分词
-            word_list = [word for word in word_list if word != ""]  # 去除空字符串
-            token_num = 0
-            for word in word_list:
-                if word.isascii():
-                    token_num += token_per_en_word
-                else:  # 此时为英文与其他语言混合的情况
-                    sub_word_list = re.split("[\u4e00-\u9fff]", word)  # 根据中文字符分词
-                    zh_char_num = sub_word_list.count("")  # 空字符串的数量即为中文字符的数量
-                    token_num += zh_char_num * token_per_zh_char
-                    token_num += (len(sub_word_list) - zh_char_num) * token_per_en_word  # 英文单词的数量
-            return int(token_num)
+            return int(estimateTokens(content, token_per_zh_char, token_per_en_word))
+
+    def countTokens(self, history: list[Message] | Session = None, message: str = None) -> int:
+        """
+        使用与本后端匹配的分词器计算token数(详见modules.tokenizer.TokenizerRegistry)
+
+        与lenOfTokens不同，该方法逐条消息计数并缓存结果，多轮对话中重复出现的历史消息不会被重复计算
+        :param history: list[Message] | Session 历史记录，或会话句柄(其token数缓存于每条消息中，并随会话持久化)
+        :param message: str 本次用户输入
+        :return: int token数
+        """
+        tokenizer = tokenizerRegistry.get(self.type, self.model)
+        if isinstance(history, Session):
+            count = history.countTokens(tokenizer)
+        else:
+            count = sum(tokenizer.count(item["content"]) for item in history) if history else 0
+        return count + (tokenizer.count(message) if message else 0)
+
+    def recordUsage(self, messages: list[Message], reply: str, start: float, usage=None, history=None,
+                    firstToken: float = None) -> None:
+        """
+        记录一次查询的用量(详见modules.usage.UsageLedger)，服务商未返回用量时使用countTokens估算
+        :param messages: list[Message] 本次发送的消息(含本次用户输入)，仅用于估算
+        :param reply: str 回复内容，仅用于估算
+        :param start: float 查询开始的时刻(time.perf_counter)
+        :param usage: tuple[int, int] | None 服务商返回的(输入token数, 输出token数)
+        :param history: list[list[str, str]] | Session 历史记录，用于在未指定usageScope时区分会话
+        :param firstToken: float 流式查询的首个片段时刻(time.perf_counter)
+        """
+        if self.usage is None:
+            return
+        latency = time.perf_counter() - start
+        estimated = usage is None
+        if estimated:
+            usage = (self.countTokens(messages), self.countTokens(message=reply) if reply else 0)
+        self.usage.record(self.type.name, self.model, usage[0], usage[1], latency,
+                          firstToken - start if firstToken is not None else None, estimated,
+                          (getSessionKey(history) or None) if history is not None else None)
+
+    @staticmethod
+    def usageOf(usage, promptField: str = "prompt_tokens", completionField: str = "completion_tokens"):
+        """
+        从服务商返回的用量字段(对象或dict)中取出token数
+        :param usage: 服务商返回的用量，允许为None
+        :param promptField: str 输入token数的字段名
+        :param completionField: str 输出token数的字段名
+        :return: tuple[int, int] | None (输入token数, 输出token数)，无法取得时返回None
+        """
+        if not usage:
+            return None
+        get = usage.get if isinstance(usage, dict) else lambda name: getattr(usage, name, None)
+        prompt, completion = get(promptField), get(completionField)
+        return (int(prompt), int(completion)) if prompt is not None and completion is not None else None
 
 
 class Waltz(NLGBase):
@@ -147,8 +227,13 @@ class Waltz(NLGBase):
         self.host, self.secret = None, None
         self.mode = Waltz_config.get("mode", "remote")
         if self.mode == "remote":
-            self.host = Waltz_config.get("host", None)
+            self.pool = hostPools.create(self.model, Waltz_config)  # host可为多个主机地址，按balancing策略分配请求
+            self.host = self.pool.hosts[0] if self.pool else None
             self.secret = Waltz_config.get("secret", None)
+            self.serialization = Waltz_config.get("serialization", "json")  # 请求/响应的序列化方式，json或msgpack
+            self.compression = Waltz_config.get("compression", None)  # 请求/响应的压缩方式，gzip、zstd或不压缩
+            self.sessionProtocol = Waltz_config.get("session_protocol", False)  # 是否启用增量历史协议(需传入Session)
+            self.affinity = Waltz_config.get("affinity", False)  # 同一会话是否固定发往同一主机(以命中推理端的缓存)
             if not self.host:
                 raise ValueError("Waltz host is not set! Please check your 'config.json' file.")
             self.checkConnection()
@@ -157,33 +242,74 @@ class Waltz(NLGBase):
 
     def singleQuery(self, message: str, prompt: str = None) -> str:
         session_prompt = prompt if prompt else self.prompt
+        body, headers = encodeBody({"prompt": session_prompt, "message": message}, self.serialization, self.compression)
+        policy = adaptiveTimeouts.get(f"{self.model}/singleQuery", 20, floor=5, cap=60, unit="char")
+        start = time.perf_counter()
         try:
-            response = requests.post(
-                url=urljoin(self.host, 'singleQuery'),
-                params={"secret": self.secret},
-                json={"prompt": session_prompt, "message": message},
-                timeout=20
-            )
+            with self.pool.request() as host, policy.measure(len(message) + len(session_prompt or "")) as timeout:
+                response = checkResponse(requests.post(
+                    url=urljoin(host, 'singleQuery'),
+                    params={"secret": self.secret},
+                    headers={**headers, **getDeadlineHeader(timeout), **getTraceHeaders()},
+                    data=body,
+                    timeout=timeout
+                ))
         except requests.exceptions.Timeout:
             raise TimeoutError("Connect to Waltz timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError("Connect to Waltz failed, please check your host and secret.")
-        return response.json().get("content", "")
+        reply = decodeResponse(response).get("content", "")
+        session_message = [Message(role="system", content=session_prompt)] if session_prompt else []
+        self.recordUsage([*session_message, Message(role="user", content=message)], reply, start)  # Waltz不返回用量
+        return reply
 
-    def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None) -> str:
-        session_history = self.converterHistory(history, prompt)
+    def continuedQuery(self, message: str, history: list[list[str, str]] | Session, prompt: str = None) -> str:
+        """
+        进行带有历史记录的查询
+
+        启用增量历史协议(session_protocol)且传入Session时，仅发送会话id、已完成的轮数与本次输入，历史记录由推理端保存；
+        会话的第一轮推理端必然尚无记录，直接发送完整的历史记录(仅提示语)；此后推理端不认识该会话(如已过期或重启)时返回409，
+        此时重新发送一次完整的历史记录
+
+        配置了多个主机且启用affinity时，同一会话的请求固定发往同一主机(该主机被剔除时改发其他主机，并触发上述的重新同步)
+        """
+        key = (getSessionKey(history) or None) if self.affinity else None
+        start = time.perf_counter()
+        if self.sessionProtocol and isinstance(history, Session):
+            session_history = history.messages(prompt or self.prompt)  # 推理端仍需处理完整的历史记录
+            size = self.lenOfMessages(session_history, message)
+            payload = {"session_id": history.session_id, "turn": len(history), "message": message}
+            if not len(history):  # 新会话，省去一次409与重发
+                payload["history"] = session_history
+            response = self._postContinuedQuery(payload, size, key)
+            if response.status_code == 409:
+                payload["history"] = self.converterHistory(history, prompt)  # 完整重新同步(推理端保存完整的历史记录)
+                response = self._postContinuedQuery(payload, size, key)
+        else:
+            session_history = self.converterHistory(history, prompt, message)
+            payload = {"history": session_history, "message": message}
+            size = self.lenOfMessages(session_history, message)
+            response = self._postContinuedQuery(payload, size, key)
+        reply = decodeResponse(response).get("content", "")
+        self.recordUsage([*session_history, Message(role="user", content=message)], reply, start, history=history)
+        return reply
+
+    def _postContinuedQuery(self, payload: dict, size: int, key: str = None) -> requests.Response:
+        body, headers = encodeBody(payload, self.serialization, self.compression)
+        policy = adaptiveTimeouts.get(f"{self.model}/continuedQuery", 50, floor=5, cap=120, unit="char")
         try:
-            response = requests.post(
-                url=urljoin(self.host, 'continuedQuery'),
-                params={"secret": self.secret},
-                json={"history": session_history, "message": message},
-                timeout=50
-            )
+            with self.pool.request(key) as host, policy.measure(size) as timeout:
+                return checkResponse(requests.post(
+                    url=urljoin(host, 'continuedQuery'),
+                    params={"secret": self.secret},
+                    headers={**headers, **getDeadlineHeader(timeout), **getTraceHeaders()},
+                    data=body,
+                    timeout=timeout
+                ), allowed=(409,))  # 409由continuedQuery重新同步历史记录
         except requests.exceptions.Timeout:
             raise TimeoutError("Connect to Waltz timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError("Connect to Waltz failed, please check your host and secret.")
-        return response.json().get("content", "")
 
     def checkConnection(self):
         """
@@ -192,18 +318,23 @@ class Waltz(NLGBase):
         在设计阶段，我们的ChatGLM项目便在API层面增添了一个用于检查状态的接口，同时便于扩展，以支持更多功能。
         :return: bool 是否连接成功
         """
-        try:
-            response = requests.get(
-                url=self.host,
-                params={"secret": self.secret},
-                timeout=10
-            )
-            if response.status_code != 200:
+
+        def check(host: str):
+            try:
+                response = requests.get(
+                    url=host,
+                    params={"secret": self.secret},
+                    timeout=10
+                )
+                if response.status_code != 200:
+                    raise ConnectionError(f"Connect to {self.model} failed, please check your host and secret.")
+            except requests.exceptions.Timeout:
+                raise TimeoutError(f"Connect to {self.model} timed out, please check your network status.")
+            except requests.exceptions.ConnectionError:
                 raise ConnectionError(f"Connect to {self.model} failed, please check your host and secret.")
-        except requests.exceptions.Timeout:
-            raise TimeoutError(f"Connect to {self.model} timed out, please check your network status.")
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError(f"Connect to {self.model} failed, please check your host and secret.")
+
+        try:
+            self.pool.checkAll(check)  # 配置了多个主机时，只要有一个主机可用即视为连接成功
         finally:
             print("Waltz remote mode connection check finished.")
 
@@ -232,20 +363,26 @@ class ChatGPT(NLGBase):
         ] if session_prompt else [
             Message(role="user", content=message)
         ]
+        start = time.perf_counter()
         session = self.host.chat.completions.create(
             model=self.model,
             messages=session_message
         )
-        return session.choices[0].message.content
+        reply = session.choices[0].message.content
+        self.recordUsage(session_message, reply, start, self.usageOf(session.usage))
+        return reply
 
     def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
-        session_history = self.converterHistory(history, prompt)
+        session_history = self.converterHistory(history, prompt, message)
         session_history.append(Message(role="user", content=message))
+        start = time.perf_counter()
         session = self.host.chat.completions.create(
             model=self.model,
             messages=session_history
         )
-        return session.choices[0].message.content
+        reply = session.choices[0].message.content
+        self.recordUsage(session_history, reply, start, self.usageOf(session.usage), history)
+        return reply
 
     def checkConnection(self):
         """
@@ -298,8 +435,22 @@ class ChatGLM(NLGBase):
         self.host = ZhipuAI(api_key=self.api_key)
         self.checkConnection()
 
+    @contextmanager
+    def _translateErrors(self):
+        """
+        将SDK的异常转换为内置异常：鉴权失败与参数错误不属于瞬时故障，不应被重试或计入熔断器(详见modules.utils.statusError)
+        """
+        from zhipuai import APIStatusError, APITimeoutError, ZhipuAIError
+        try:
+            yield
+        except APITimeoutError:
+            raise TimeoutError(f"Connect to {self.model} timed out, please check your network status.")
+        except APIStatusError as e:
+            raise statusError(e.status_code, f"Request to {self.model} failed with {e.status_code}, {e}")
+        except ZhipuAIError as e:
+            raise ConnectionError(f"Connect to {self.model} failed, {e}")
+
     def singleQuery(self, message: str, prompt: str = None) -> str:
-        from zhipuai import ZhipuAIError
         session_prompt = prompt if prompt else self.prompt
         session_message = [
             Message(role="system", content=session_prompt),
@@ -307,17 +458,17 @@ class ChatGLM(NLGBase):
         ] if session_prompt else [
             Message(role="user", content=message)
         ]
-        try:
+        start = time.perf_counter()
+        with self._translateErrors():
             response = self.host.chat.completions.create(
                 model=self.model,
                 messages=session_message
             )
-            return response.choices[0].message.content
-        except ZhipuAIError as e:
-            raise ConnectionError(f"Connect to {self.model} failed, {e}")
+            reply = response.choices[0].message.content
+        self.recordUsage(session_message, reply, start, self.usageOf(response.usage))
+        return reply
 
     def streamSingleQuery(self, message: str, prompt: str = None) -> str:
-        from zhipuai import ZhipuAIError
         session_prompt = prompt if prompt else self.prompt
         session_message = [
             Message(role="system", content=session_prompt),
@@ -325,55 +476,65 @@ class ChatGLM(NLGBase):
         ] if session_prompt else [
             Message(role="user", content=message)
         ]
-        try:
+        start, first_token, reply, usage = time.perf_counter(), None, "", None
+        with self._translateErrors():
             response = self.host.chat.completions.create(
                 model=self.model,
                 messages=session_message,
                 stream=True
             )
-            for chunk in response:
-                yield chunk.choices[0].delta.content
-        except ZhipuAIError as e:
-            raise ConnectionError(f"Connect to {self.model} failed, {e}")
+            with closeOnCancel(response):  # 本轮被打断时关闭连接，使服务端停止生成
+                for chunk in response:
+                    first_token = first_token or time.perf_counter()
+                    usage = self.usageOf(getattr(chunk, "usage", None)) or usage  # 最后一个片段附带本次的用量
+                    reply += chunk.choices[0].delta.content or ""
+                    yield chunk.choices[0].delta.content
+        self.recordUsage(session_message, reply, start, usage, firstToken=first_token)
 
     def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
-        from zhipuai import ZhipuAIError
-        session_history = self.converterHistory(history, prompt)
+        session_history = self.converterHistory(history, prompt, message)
         session_history.append(Message(role="user", content=message))
-        try:
+        start = time.perf_counter()
+        with self._translateErrors():
             response = self.host.chat.completions.create(
                 model=self.model,
                 messages=session_history
             )
-            return response.choices[0].message.content
-        except ZhipuAIError as e:
-            raise ConnectionError(f"Connect to {self.model} failed, {e}")
+            reply = response.choices[0].message.content
+        self.recordUsage(session_history, reply, start, self.usageOf(response.usage), history)
+        return reply
 
     def streamContinuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
-        from zhipuai import ZhipuAIError
-        session_history = self.converterHistory(history, prompt)
+        session_history = self.converterHistory(history, prompt, message)
         session_history.append(Message(role="user", content=message))
-        try:
+        start, first_token, reply, usage = time.perf_counter(), None, "", None
+        with self._translateErrors():
             response = self.host.chat.completions.create(
                 model=self.model,
                 messages=session_history,
                 stream=True
             )
-            for chunk in response:
-                yield chunk.choices[0].delta.content
-        except ZhipuAIError as e:
-            raise ConnectionError(f"Connect to {self.model} failed, {e}")
+            with closeOnCancel(response):  # 本轮被打断时关闭连接，使服务端停止生成
+                for chunk in response:
+                    first_token = first_token or time.perf_counter()
+                    usage = self.usageOf(getattr(chunk, "usage", None)) or usage  # 最后一个片段附带本次的用量
+                    reply += chunk.choices[0].delta.content or ""
+                    yield chunk.choices[0].delta.content
+        self.recordUsage(session_history, reply, start, usage, history, first_token)
 
     def checkConnection(self):
         try:
-            response = self.host.chat.completions.create(
-                model=self.model,
-                messages=[Message(role="user", content="说“你好！”")]
-            )
+            with self._translateErrors():
+                response = self.host.chat.completions.create(
+                    model=self.model,
+                    messages=[Message(role="user", content="说“你好！”")]
+                )
             if re.match(".*你好.*", response.choices[0].message.content):
                 print("ChatGLM connection check finished.")
             else:
                 raise ConnectionError("Connect to ChatGLM failed, please check your network status and API config.")
+        except (ConnectionRefusedError, ValueError):
+            raise
         except Exception as e:
             raise ConnectionError(f"Connect to ChatGLM failed, {e}")
 
@@ -421,7 +582,8 @@ class ERNIEBot(NLGBase):
                 "client_id": self.api_key,
                 "client_secret": self.secret_key,
                 "grant_type": "client_credentials"
-            }
+            },
+            timeout=10
         )
         access_token = response.json().get("access_token")
         Configs["Baidu"]["nlg"]["access_token"] = access_token
@@ -436,36 +598,44 @@ class ERNIEBot(NLGBase):
         ] if session_prompt else [
             Message(role="user", content=message)
         ]
+        policy = adaptiveTimeouts.get(f"{self.model}/query", 20, floor=5, cap=60, unit="char")
+        start = time.perf_counter()
         try:
-            response = requests.post(
-                url=self.query_url[self.model],
-                headers={'Content-Type': 'application/json'},
-                params={"access_token": self.access_token},
-                data=json.dumps({"messages": session_message}),
-                timeout=20
-            )
+            with policy.measure(self.lenOfMessages(session_message)) as timeout:
+                response = requests.post(
+                    url=self.query_url[self.model],
+                    headers={'Content-Type': 'application/json'},
+                    params={"access_token": self.access_token},
+                    data=json.dumps({"messages": session_message}),
+                    timeout=timeout
+                )
             response_json = json.loads(response.text)
             if response_json.get("error_code") == 110:  # 根据百度API文档，110为access_token过期，重新请求即可
                 self.OAuth()
                 return self.singleQuery(message, prompt)
             else:
-                return response_json.get("result")
+                reply = response_json.get("result")
+                self.recordUsage(session_message, reply, start, self.usageOf(response_json.get("usage")))
+                return reply
         except requests.exceptions.Timeout:
             raise TimeoutError("Connect to 'aip.baidubce.com' timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError("Connect to 'aip.baidubce.com' failed, please check your network status.")
 
     def continuedQuery(self, message, history: [[str, str]], prompt: str = None):
-        session_history = self.converterHistory(history, prompt)
+        session_history = self.converterHistory(history, prompt, message)
         session_history.append(Message(role="user", content=message))
+        policy = adaptiveTimeouts.get(f"{self.model}/query", 20, floor=5, cap=60, unit="char")
+        start = time.perf_counter()
         try:
-            response = requests.post(
-                url=self.query_url[self.model],
-                headers={'Content-Type': 'application/json'},
-                params={"access_token": self.access_token},
-                data=json.dumps({"messages": session_history}),
-                timeout=20
-            )
+            with policy.measure(self.lenOfMessages(session_history)) as timeout:
+                response = requests.post(
+                    url=self.query_url[self.model],
+                    headers={'Content-Type': 'application/json'},
+                    params={"access_token": self.access_token},
+                    data=json.dumps({"messages": session_history}),
+                    timeout=timeout
+                )
             response_json = json.loads(response.text)
             if response_json.get("error_code") == 110:  # 根据百度API文档，110为access_token过期，重新请求即可
                 self.OAuth()
@@ -474,7 +644,9 @@ class ERNIEBot(NLGBase):
             raise TimeoutError("Connect to 'aip.baidubce.com' timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError("Connect to 'aip.baidubce.com' failed, please check your network status.")
-        return response_json.get("result")
+        reply = response_json.get("result")
+        self.recordUsage(session_history, reply, start, self.usageOf(response_json.get("usage")), history)
+        return reply
 
     def checkConnection(self):
         """
@@ -524,6 +696,21 @@ class Qwen(NLGBase):
             raise ValueError(f"Unsupported Qwen model: '{self.model}', please check your 'config.json' file.")
         self.checkConnection()
 
+    def _checkResponse(self, response) -> None:
+        """
+        检查DashScope的响应，失败时按状态码抛出对应的异常(详见modules.utils.statusError)
+        """
+        if response.status_code != requests.codes.ok:
+            raise statusError(
+                response.status_code,
+                f"""Connect to {self.model} failed, please check your network and API status.
+                Error Info:
+                    Request id:    {response.request_id}
+                    Status code:   {response.status_code}
+                    Error code:    {response.code}
+                    Error message: {response.message}"""
+            )
+
     def singleQuery(self, message: str, prompt: str = None) -> str:
         from dashscope import Generation
         from dashscope.api_entities.dashscope_response import Role
@@ -534,6 +721,7 @@ class Qwen(NLGBase):
         ] if session_prompt else [
             Message(role=Role.USER, content=message)
         ]
+        start = time.perf_counter()
         response = Generation.call(
             model=self.model_dict[self.model],
             api_key=self.api_key,
@@ -541,22 +729,17 @@ class Qwen(NLGBase):
             seed=randint(0, 10000),
             result_format='message'
         )
-        if response.status_code != requests.codes.ok:
-            raise ConnectionError(
-                f"""Connect to {self.model} failed, please check your network and API status.
-                Error Info:
-                    Request id:    {response.request_id}
-                    Status code:   {response.status_code}
-                    Error code:    {response.code}
-                    Error message: {response.message}"""
-            )
-        return response.output.choices[0].message.content
+        self._checkResponse(response)
+        reply = response.output.choices[0].message.content
+        self.recordUsage(session_message, reply, start, self.usageOf(response.usage, "input_tokens", "output_tokens"))
+        return reply
 
     def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
         from dashscope import Generation
         from dashscope.api_entities.dashscope_response import Role
-        session_history = self.converterHistory(history, prompt)
+        session_history = self.converterHistory(history, prompt, message)
         session_history.append(Message(role=Role.USER, content=message))
+        start = time.perf_counter()
         response = Generation.call(
             model=self.model_dict[self.model],
             api_key=self.api_key,
@@ -564,16 +747,11 @@ class Qwen(NLGBase):
             seed=randint(0, 10000),
             result_format='message'
         )
-        if response.status_code != requests.codes.ok:
-            raise ConnectionError(
-                f"""Connect to {self.model} failed, please check your network and API status.
-                Error Info:
-                    Request id:    {response.request_id}
-                    Status code:   {response.status_code}
-                    Error code:    {response.code}
-                    Error message: {response.message}"""
-            )
-        return response.output.choices[0].message.content
+        self._checkResponse(response)
+        reply = response.output.choices[0].message.content
+        self.recordUsage(session_history, reply, start, self.usageOf(response.usage, "input_tokens", "output_tokens"),
+                         history)
+        return reply
 
     def checkConnection(self):
         """
@@ -588,15 +766,7 @@ class Qwen(NLGBase):
             messages=session_message,
             result_format='message'
         )
-        if response.status_code != requests.codes.ok:
-            raise ConnectionError(
-                f"""Connect to {self.model} failed, please check your network and API status.
-                Error Info:
-                    Request id:    {response.request_id}
-                    Status code:   {response.status_code}
-                    Error code:    {response.code}
-                    Error message: {response.message}"""
-            )
+        self._checkResponse(response)
         print("Qwen connection check finished.")
 
 
@@ -605,9 +775,14 @@ class Gemini(NLGBase):
     通过API调用Gemini进行问答
 
     API文档参考：https://ai.google.dev/tutorials/python_quickstart
+
+    GenerativeModel按(模型, 系统提示语)缓存复用；多轮对话基于ChatSession，每个会话的历史记录只在首次查询(或与缓存不一致)
+    时转换一次，此后每轮只发送本次输入。Gemini 1.0(如默认的gemini-pro)不支持系统提示语，此时将其并入第一条用户输入
     """
     import google.generativeai as genai
     host = genai  # 根据官方demo，似乎genai应为单例对象，因此此处将其设计为类变量
+    maxModels = 16  # 最多缓存的GenerativeModel数
+    maxChats = 256  # 最多缓存的ChatSession数(按最近使用淘汰)
 
     def __init__(self, Google_config: dict, prompt: str = None):
         super().__init__(NLGEnum.Gemini, Google_config.get("nlg_model", "gemini-pro"), prompt)
@@ -615,19 +790,49 @@ class Gemini(NLGBase):
         if not self.api_key:
             raise ValueError("Gemini api_key is not set! Please check your 'config.json' file.")
         self.host.configure(api_key=self.api_key)
+        self._models: OrderedDict[tuple[str, str], object] = OrderedDict()
+        self._chats: OrderedDict[str, tuple[object, int, tuple]] = OrderedDict()  # 会话标识: (ChatSession, 轮数, 末轮对话)
+        self._lock = threading.Lock()
         self.checkConnection()
 
-    def singleQuery(self, message: str, prompt: str = None) -> str:
+    @property
+    def supportsSystemInstruction(self) -> bool:
+        """
+        :return: bool 模型是否支持系统提示语(Gemini 1.0会以InvalidArgument拒绝请求)
+        """
+        name = self.model.removeprefix("models/")
+        return not (name.startswith("gemini-pro") or name.startswith("gemini-1.0"))
+
+    @staticmethod
+    def foldPrompt(prompt: str | None, message: str) -> str:
         """
-        看起来Genimi的API并不支持单独提供prompt，实际上prompt参数并未使用
+        将提示语并入用户输入，用于不支持系统提示语的模型
+        :return: str
         """
+        return f"{prompt}\n\n{message}" if prompt else message
+
+    def getModel(self, prompt: str = None):
+        """
+        获取(或创建)指定系统提示语的GenerativeModel
+        :param prompt: str 系统提示语，允许为空；模型不支持系统提示语时被忽略(由调用方并入用户输入)
+        :return: google.generativeai.GenerativeModel
+        """
+        prompt = prompt if self.supportsSystemInstruction else None
+        key = (self.model, prompt or "")
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self.host.GenerativeModel(self.model, system_instruction=prompt or None)
+                self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > self.maxModels:
+                self._models.popitem(last=False)
+            return model
+
+    @contextmanager
+    def _translateErrors(self):
         try:
-            model = self.host.GenerativeModel(self.model)
-            response = model.generate_content(
-                contents=[message],
-            )
-            print(response.candidates)
-            return response.text
+            yield
         except google.api_core.exceptions.Unauthenticated:
             raise ConnectionRefusedError("Connect to Gemini failed due to unauthenticated, please check your API key.")
         except google.api_core.exceptions.RetryError:
@@ -635,12 +840,116 @@ class Gemini(NLGBase):
                 "Connect to Gemini timed out, please check your network status and make sure Gemini is available in your region.")
         except google.api_core.exceptions.ServiceUnavailable:
             raise ConnectionError("Connect to Gemini failed, please check your network status.")
+        except google.api_core.exceptions.InvalidArgument as e:
+            raise ValueError(f"Gemini rejected the request as invalid: {e.message}")
 
-    def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
-        pass
+    def _getChat(self, history: list[list[str, str]] | Session, prompt: str = None, message: str = None):
+        """
+        获取会话对应的ChatSession，缓存中的ChatSession与传入的历史记录不一致时(轮数或末轮对话不同)重新创建
+
+        启用了检索式记忆或滚动摘要压缩时，每轮发送的历史记录各不相同，因此每轮均重新创建。
+        模型不支持系统提示语时，提示语并入历史记录中的第一条用户输入；没有历史记录时并入本次输入
+        :return: tuple[google.generativeai.ChatSession, str] ChatSession与本次实际发送的输入
+        """
+        exchanges = history.toHistory() if isinstance(history, Session) else history
+        key = getSessionKey(history) if not (self.memory or self.compactor) else None
+        if key:
+            with self._lock:
+                cached = self._chats.pop(key, None)  # 取出后由_putChat放回，避免同一ChatSession被并发使用
+            if cached is not None:
+                chat, turns, last = cached
+                if turns == len(exchanges) and (not turns or last == tuple(exchanges[-1])):
+                    return chat, message
+        session_history = self.converterHistory(history, prompt, message)
+        system_prompt = session_history.pop(0)["content"] if session_history and \
+            session_history[0]["role"] == "system" else None
+        contents = [{"role": "model" if item["role"] == "assistant" else "user", "parts": [item["content"]]}
+                    for item in session_history]
+        if system_prompt and not self.supportsSystemInstruction:
+            if not contents:
+                message = self.foldPrompt(system_prompt, message)
+            elif contents[0]["role"] == "user":
+                contents[0]["parts"] = [self.foldPrompt(system_prompt, contents[0]["parts"][0])]
+            else:
+                contents.insert(0, {"role": "user", "parts": [system_prompt]})
+        return self.getModel(system_prompt).start_chat(history=contents), message
+
+    def _putChat(self, history: list[list[str, str]] | Session, chat, message: str, reply: str) -> None:
+        if self.memory or self.compactor:
+            return
+        exchanges = history.toHistory() if isinstance(history, Session) else history
+        key = history.session_id if isinstance(history, Session) else getSessionKey([*exchanges, [message, reply]])
+        with self._lock:
+            self._chats[key] = (chat, len(exchanges) + 1, (message, reply))
+            while len(self._chats) > self.maxChats:
+                self._chats.popitem(last=False)
+
+    @staticmethod
+    def usageOf(usage, promptField: str = "prompt_token_count", completionField: str = "candidates_token_count"):
+        return NLGBase.usageOf(usage, promptField, completionField)  # Gemini的用量字段名与OpenAI不同
+
+    def singleQuery(self, message: str, prompt: str = None) -> str:
+        session_prompt = prompt if prompt else self.prompt
+        start = time.perf_counter()
+        with self._translateErrors():
+            model = self.getModel(session_prompt)
+            contents = [message if self.supportsSystemInstruction else self.foldPrompt(session_prompt, message)]
+            response = model.generate_content(contents=contents)
+            reply = response.text
+        self.recordUsage([Message(role="user", content=message)], reply, start,
+                         self.usageOf(getattr(response, "usage_metadata", None)))
+        return reply
+
+    def streamSingleQuery(self, message: str, prompt: str = None) -> str:
+        session_prompt = prompt if prompt else self.prompt
+        start, first_token, reply, usage = time.perf_counter(), None, "", None
+        with self._translateErrors():
+            model = self.getModel(session_prompt)
+            contents = [message if self.supportsSystemInstruction else self.foldPrompt(session_prompt, message)]
+            for chunk in model.generate_content(contents=contents, stream=True):
+                checkCancelled()  # 流式响应无法从外部关闭，在片段之间检查本轮是否已被打断
+                first_token = first_token or time.perf_counter()
+                usage = self.usageOf(getattr(chunk, "usage_metadata", None)) or usage
+                reply += chunk.text
+                yield chunk.text
+        self.recordUsage([Message(role="user", content=message)], reply, start, usage, firstToken=first_token)
+
+    def continuedQuery(self, message: str, history: list[list[str, str]] | Session, prompt: str = None):
+        """
+        Gemini总会返回usage_metadata，记录用量时仅在缺失时按本次输入估算(不再为此转换历史记录)
+        """
+        chat, content = self._getChat(history, prompt, message)
+        start = time.perf_counter()
+        with self._translateErrors():
+            response = chat.send_message(content)
+            reply = response.text
+        self._putChat(history, chat, message, reply)
+        self.recordUsage([Message(role="user", content=message)], reply, start,
+                         self.usageOf(getattr(response, "usage_metadata", None)), history)
+        return reply
+
+    def streamContinuedQuery(self, message: str, history: list[list[str, str]] | Session, prompt: str = None):
+        """
+        流式的continuedQuery，中途出错或被中断时不缓存该ChatSession(其历史记录可能不完整)
+        """
+        chat, content = self._getChat(history, prompt, message)
+        start, first_token, reply, usage = time.perf_counter(), None, "", None
+        with self._translateErrors():
+            for chunk in chat.send_message(content, stream=True):
+                checkCancelled()  # 流式响应无法从外部关闭，在片段之间检查本轮是否已被打断
+                first_token = first_token or time.perf_counter()
+                usage = self.usageOf(getattr(chunk, "usage_metadata", None)) or usage
+                reply += chunk.text
+                yield chunk.text
+        self._putChat(history, chat, message, reply)
+        self.recordUsage([Message(role="user", content=message)], reply, start, usage, history, first_token)
 
     def checkConnection(self):
-        pass
+        """
+        获取模型信息以检查连接状态(不消耗token)
+        """
+        with self._translateErrors():
+            self.host.get_model(self.model if self.model.startswith("models/") else f"models/{self.model}")
 
 
 class Spark(NLGBase):
@@ -712,6 +1021,7 @@ class Spark(NLGBase):
             content = choices["text"][0]["content"]
             ws.response_content += content
             if status == 2:
+                ws.usage = data["payload"].get("usage", {}).get("text")  # 最后一帧附带本次的用量
                 ws.close()
 
     def _onError(self, ws, error):  # 收到websocket错误的处理
@@ -757,15 +1067,18 @@ class Spark(NLGBase):
             on_error=self._onError,
             on_open=self._onOpen
         )
-        if self.lenOfTokens(message=message) > self.max_token:
+        if self.countTokens(message=message) > self.max_token:
             raise ValueError(f"Message length exceeds the maximum token limit: {self.max_token}")
         ws.session_message = session_message
-        ws.response_content = ""
-        ws.run_forever(sslopt={"cert_reqs": SSL_CERT_NONE})
+        ws.response_content, ws.usage = "", None
+        start = time.perf_counter()
+        with closeOnCancel(ws):  # 本轮被打断时关闭WebSocket，run_forever随即返回
+            ws.run_forever(sslopt={"cert_reqs": SSL_CERT_NONE})
+        self.recordUsage(session_message, ws.response_content, start, self.usageOf(ws.usage))
         return ws.response_content
 
     def continuedQuery(self, message: str, history: list[list[str, str]], prompt: str = None):
-        session_history = self.converterHistory(history, prompt)
+        session_history = self.converterHistory(history, prompt, message)
         session_history.append(Message(role="user", content=message))
         ws = WebSocketApp(
             url=self.getQueryURL(),
@@ -773,11 +1086,14 @@ class Spark(NLGBase):
             on_error=self._onError,
             on_open=self._onOpen
         )
-        while self.lenOfTokens(session_history) > self.max_token:
+        while self.countTokens(session_history) > self.max_token:
             session_history.pop(0)  # 保证总的token数不超过最大限制
         ws.session_message = session_history
-        ws.response_content = ""
-        ws.run_forever(sslopt={"cert_reqs": SSL_CERT_NONE})
+        ws.response_content, ws.usage = "", None
+        start = time.perf_counter()
+        with closeOnCancel(ws):  # 本轮被打断时关闭WebSocket，run_forever随即返回
+            ws.run_forever(sslopt={"cert_reqs": SSL_CERT_NONE})
+        self.recordUsage(session_history, ws.response_content, start, self.usageOf(ws.usage), history)
         return ws.response_content
 
     def checkConnection(self):
@@ -789,5 +1105,216 @@ class Spark(NLGBase):
             raise e
 
 
+class RouteStats:
+    """AutoRouter中单个后端的滚动统计(指数加权移动平均)"""
+    __slots__ = ("latency", "firstToken", "errorRate", "samples", "errors")
+
+    def __init__(self):
+        self.latency = None  # 成功查询的耗时(秒)
+        self.firstToken = None  # 流式查询的首个片段耗时(秒)
+        self.errorRate = 0.0
+        self.samples = 0
+        self.errors = 0
+
+
+class AutoRouter(NLGBase):
+    """
+    自动选择NLG后端：对每个后端维护耗时、首个片段耗时与错误率的EWMA，每轮发送给当前得分最低(最优)的后端
+
+    得分 = latencyWeight × 耗时 / 最低耗时 + firstTokenWeight × 首片段耗时 / 最低首片段耗时
+         + costWeight × 单价 / 最低单价 + errorWeight × 错误率
+    尚无成功样本的后端优先尝试；以exploration的概率改为随机尝试其他后端，以保持统计数据的时效性。
+    后端连接失败或超时时，本轮依次改发得分次优的后端(流式查询仅在尚未输出任何内容时改发)
+    """
+    failover = (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def __init__(self, backends: dict[str, NLGBase], latencyWeight: float = 1.0, firstTokenWeight: float = 0.5,
+                 errorWeight: float = 5.0, costWeight: float = 0.0, exploration: float = 0.05, decay: float = 0.2,
+                 prompt: str = None):
+        """
+        :param backends: dict[str, NLGBase] 参与选择的后端，键为名称(通常为NLGEnum中的名称)
+        :param latencyWeight: float 耗时的权重
+        :param firstTokenWeight: float 首个片段耗时的权重(仅有非流式样本时以耗时代替)
+        :param errorWeight: float 错误率的权重
+        :param costWeight: float 单价的权重，单价取自用量记账的prices(详见modules.usage)
+        :param exploration: float 随机尝试其他后端的概率
+        :param decay: float EWMA中新样本的权重
+        :param prompt: str 默认提示语，未在查询时指定prompt时传给被选中的后端
+        """
+        if not backends:
+            raise ValueError("AutoRouter requires at least one backend.")
+        super().__init__(NLGEnum.Auto, "Auto", prompt)
+        self.backends = backends
+        self.latencyWeight = latencyWeight
+        self.firstTokenWeight = firstTokenWeight
+        self.errorWeight = errorWeight
+        self.costWeight = costWeight
+        self.exploration = exploration
+        self.decay = decay
+        self.stats = {name: RouteStats() for name in backends}
+        self.current = None  # 最近一次被选中的后端名称
+        self._lock = threading.Lock()
+
+    def unitCost(self, name: str) -> float:
+        """
+        :return: float 后端每千token的平均单价，未配置单价时为0
+        """
+        price = self.usage.prices.get(self.backends[name].model) if self.usage else None
+        return (price.get("prompt", 0) + price.get("completion", 0)) / 2 if price else 0.0
+
+    def scores(self) -> dict[str, float]:
+        """
+        :return: dict[str, float] 各后端当前的得分(越低越好)，从未尝试过的后端为-inf；
+        只失败过的后端按 2 × 最高耗时 计算耗时，使其排在其他后端之后(仍会通过exploration被重新尝试)
+        """
+        with self._lock:
+            stats = {name: (item.samples, item.latency, item.firstToken or item.latency, item.errorRate)
+                     for name, item in self.stats.items()}
+        costs = {name: self.unitCost(name) for name in self.backends}
+        measured = [value for value in stats.values() if value[1] is not None]
+        bestLatency = min((value[1] for value in measured), default=1.0) or 1e-6
+        bestFirstToken = min((value[2] for value in measured), default=1.0) or 1e-6
+        penaltyLatency = 2 * max((value[1] for value in measured), default=1.0)
+        penaltyFirstToken = 2 * max((value[2] for value in measured), default=1.0)
+        bestCost = min((cost for cost in costs.values() if cost > 0), default=1.0)
+        scores = {}
+        for name, (samples, latency, firstToken, errorRate) in stats.items():
+            if samples == 0:
+                scores[name] = float("-inf")
+                continue
+            if latency is None:
+                latency, firstToken = penaltyLatency, penaltyFirstToken
+            scores[name] = self.latencyWeight * latency / bestLatency + \
+                self.firstTokenWeight * firstToken / bestFirstToken + \
+                self.costWeight * costs[name] / bestCost + self.errorWeight * errorRate
+        return scores
+
+    def rank(self) -> list[str]:
+        """
+        :return: list[str] 本轮尝试后端的顺序
+        """
+        scores = self.scores()
+        order = sorted(scores, key=lambda name: scores[name])
+        if len(order) > 1 and scores[order[0]] != float("-inf") and randomFloat() < self.exploration:
+            order.insert(0, order.pop(randomChoice(range(1, len(order)))))
+        return order
+
+    def _update(self, name: str, latency: float = None, firstToken: float = None, failed: bool = False) -> None:
+        with self._lock:
+            stats = self.stats[name]
+            stats.samples += 1
+            stats.errors += failed
+            stats.errorRate = (1 - self.decay) * stats.errorRate + self.decay * failed
+            if latency is not None:
+                stats.latency = latency if stats.latency is None else \
+                    (1 - self.decay) * stats.latency + self.decay * latency
+            if firstToken is not None:
+                stats.firstToken = firstToken if stats.firstToken is None else \
+                    (1 - self.decay) * stats.firstToken + self.decay * firstToken
+
+    def _select(self, name: str) -> NLGBase:
+        self.current = name
+        span = getCurrentSpan()
+        if span is not None:
+            span.set("routed_to", name)
+        return self.backends[name]
+
+    def _route(self, method: str, *args):
+        error = None
+        for name in self.rank():
+            backend = self._select(name)
+            start = time.perf_counter()
+            try:
+                result = getattr(backend, method)(*args)
+            except self.failover as e:  # 改发下一个后端
+                checkCancelled()  # 因本轮被打断而关闭的连接不计入错误率
+                self._update(name, failed=True)
+                error = e
+                continue
+            self._update(name, time.perf_counter() - start)
+            return result
+        raise error
+
+    def _routeStream(self, method: str, fallback: str, *args):
+        error = None
+        for name in self.rank():
+            backend = self._select(name)
+            start, first = time.perf_counter(), None
+            try:
+                stream = getattr(backend, method)(*args) if hasattr(backend, method) else \
+                    iter((getattr(backend, fallback)(*args),))
+                for chunk in stream:
+                    if first is None:
+                        first = time.perf_counter() - start
+                    yield chunk
+            except self.failover as e:
+                checkCancelled()
+                self._update(name, failed=True)
+                if first is not None:  # 已输出的内容无法撤回，不再改发
+                    raise
+                error = e
+                continue
+            self._update(name, time.perf_counter() - start, first)
+            return
+        raise error
+
+    def singleQuery(self, message: str, prompt: str = None) -> str:
+        return self._route("singleQuery", message, prompt or self.prompt)
+
+    def continuedQuery(self, message: str, history: list[list[str, str]] | Session, prompt: str = None):
+        return self._route("continuedQuery", message, history, prompt or self.prompt)
+
+    def streamSingleQuery(self, message: str, prompt: str = None):
+        """
+        被选中的后端不支持流式查询时，以其singleQuery的结果作为唯一的片段
+        """
+        yield from self._routeStream("streamSingleQuery", "singleQuery", message, prompt or self.prompt)
+
+    def streamContinuedQuery(self, message: str, history: list[list[str, str]] | Session, prompt: str = None):
+        yield from self._routeStream("streamContinuedQuery", "continuedQuery", message, history, prompt or self.prompt)
+
+    def checkConnection(self):
+        """
+        各后端在创建时已检查过连接，此处只要有一个后端可用即视为连接成功；
+        检查请求的耗时不代表查询的耗时，因此直接调用各后端，不计入统计数据
+        """
+        error = None
+        for backend in self.backends.values():
+            try:
+                return backend.checkConnection()
+            except self.failover as e:
+                error = e
+        raise error
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        :return: dict[str, dict] 各后端的统计数据与得分
+        """
+        scores = self.scores()
+        with self._lock:
+            return {name: {"latency": stats.latency, "first_token": stats.firstToken, "error_rate": stats.errorRate,
+                           "samples": stats.samples, "errors": stats.errors, "score": scores[name]}
+                    for name, stats in self.stats.items()}
+
+    def export(self) -> str:
+        """
+        以Prometheus文本格式导出各后端的统计数据与得分
+        :return: str
+        """
+        rows = [(name, item) for name, item in self.snapshot().items() if item["samples"]]
+        metrics = [
+            ("client_route_latency_seconds", "EWMA latency of successful queries per backend.", "latency"),
+            ("client_route_first_token_seconds", "EWMA time to first chunk per backend.", "first_token"),
+            ("client_route_error_rate", "EWMA error rate per backend.", "error_rate"),
+            ("client_route_score", "Current routing score per backend (lower is preferred).", "score"),
+        ]
+        lines = []
+        for metric, description, field in metrics:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+            lines += [f'{metric}{{backend="{name}"}} {item[field]:g}' for name, item in rows
+                      if item[field] is not None]
+        return "\n".join(lines) + "\n"
+
+
 if __name__ == '__main__':
     raise RuntimeError("This module is not executable!")
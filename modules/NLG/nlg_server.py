@@ -1,5 +1,5 @@
 """此文件以ChatGLM为例，展示了如何将一个AI模型包装为API，并允许远程调用"""
-from APIWrapper import APIWrapper
+from APIWrapper import APIWrapper, SessionCache
 from transformers import AutoTokenizer, AutoModel
 from flask import request
 
@@ -8,9 +8,10 @@ if __name__ == "__main__":
     tokenizer = AutoTokenizer.from_pretrained("THUDM/chatglm3-6b", trust_remote_code=True)  # 创建tokenizer
     model = AutoModel.from_pretrained("THUDM/chatglm3-6b", trust_remote_code=True, device='cuda')  # 创建model
     model = model.eval()
+    session_cache = SessionCache(ttl=1800, maxSessions=1024)  # 增量历史协议下各会话的历史记录
 
 
-    @api_app.addRoute('/singleQuery', methods=['POST'])  # 定义一个路由，用于处理单次聊天(不带历史记录)
+    @api_app.addRoute('/singleQuery', methods=['POST'], maxConcurrency=1, maxQueue=4)  # 定义一个路由，用于处理单次聊天(不带历史记录)
     def singleQuery():
         """
         处理单次查询时的请求
@@ -22,15 +23,24 @@ if __name__ == "__main__":
         return {"time": api_app.getISOTime(), "content": response}, 200
 
 
-    @api_app.addRoute('/continuedQuery', methods=['POST'])  # 定义一个路由，用于处理带有历史记录的聊天
+    @api_app.addRoute('/continuedQuery', methods=['POST'], maxConcurrency=1, maxQueue=4)  # 定义一个路由，用于处理带有历史记录的聊天
     def continuedQuery():
         """
         处理带有历史记录的查询时的请求
+
+        若请求中带有session_id，则使用增量历史协议：未携带history时从session_cache中读取历史记录(不存在时返回409，
+        由客户端重新发送完整历史记录)，并在回复后保存更新的历史记录
         """
         secret = request.values.get('secret')  # 暂且不使用secret
         data = request.get_json()
-        history, message = data.get("history", []), data.get("message", "")
-        response, _ = model.chat(tokenizer, message, history=history)
+        session_id, turn, message = data.get("session_id"), data.get("turn", 0), data.get("message", "")
+        if session_id and "history" not in data:
+            history = list(session_cache.get(session_id, turn))
+        else:
+            history = data.get("history", [])
+        response, new_history = model.chat(tokenizer, message, history=history)
+        if session_id:
+            session_cache.put(session_id, new_history, turn + 1)
         return {"time": api_app.getISOTime(), "content": response}, 200
 
 
@@ -1,14 +1,145 @@
 """该文件定义了语音合成的后端类"""
+import contextvars
+import io
 import os
+import re
+import threading
+import uuid
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from os import PathLike
 from urllib.parse import urlencode, urljoin
 
 import numpy as np
 import requests
-from scipy.io.wavfile import write as wavwrite
+from scipy.io.wavfile import read as wavread, write as wavwrite
+from scipy.signal import resample_poly
 
-from modules.utils import TTSEnum, Configs, getMacAddress
+from modules.balancer import hostPools
+from modules.cancellation import TurnCancelled, checkCancelled, getCurrentTurn
+from modules.timeouts import adaptiveTimeouts
+from modules.tracing import getTraceHeaders
+from modules.utils import TTSEnum, Configs, getMacAddress, getDeadlineHeader, encodeBody, decodeResponse, \
+    checkResponse
+
+_outputName = threading.local()  # 当前线程中TTSBase.saveAudio使用的文件名，未设置时为"synthesize"
+
+
+class AudioCodec:
+    """
+    合成结果的编码设置，决定推理端返回以及保存至download/的音频格式
+
+    mp3与ogg(opus)的编解码依赖pydub与ffmpeg，wav则无需额外依赖
+    """
+    mimeTypes = {"wav": "audio/wav", "mp3": "audio/mpeg", "ogg": "audio/ogg"}
+
+    def __init__(self, audioFormat: str = "wav", bitrate: str = None, sampleRate: int = None):
+        """
+        :param audioFormat: str "wav"、"mp3"或"ogg"(opus编码)
+        :param bitrate: str 目标码率，如"32k"，仅对mp3与ogg有效
+        :param sampleRate: int 目标采样率，为None时保持原采样率
+        """
+        if audioFormat not in self.mimeTypes:
+            raise ValueError(f"Unsupported audio format: {audioFormat}")
+        self.format = audioFormat
+        self.bitrate = bitrate
+        self.sampleRate = sampleRate
+
+    @classmethod
+    def fromConfig(cls, TTS_config: dict, defaultFormat: str = "wav") -> "AudioCodec":
+        """
+        根据配置创建AudioCodec
+        :param TTS_config: dict 含有"format"、"bitrate"与"sample_rate"(均可省略)的配置
+        :param defaultFormat: str 未配置format时使用的格式
+        :return: AudioCodec
+        """
+        return cls(TTS_config.get("format") or defaultFormat, TTS_config.get("bitrate") or None,
+                   TTS_config.get("sample_rate") or None)
+
+    @property
+    def isPlainWav(self) -> bool:
+        """是否为保持原采样率的wav(即无需编码)"""
+        return self.format == "wav" and not self.sampleRate
+
+    def requestParams(self) -> dict:
+        """
+        发送给自部署推理端的编码参数
+        :return: dict
+        """
+        return {"format": self.format, "bitrate": self.bitrate, "sample_rate": self.sampleRate}
+
+    def _export(self, segment) -> bytes:
+        buffer = io.BytesIO()
+        parameters = ["-ar", str(self.sampleRate)] if self.sampleRate else []
+        if self.format == "ogg":
+            segment.export(buffer, format="ogg", codec="libopus", bitrate=self.bitrate, parameters=parameters)
+        else:
+            segment.export(buffer, format=self.format, bitrate=self.bitrate, parameters=parameters)
+        return buffer.getvalue()
+
+    def encode(self, samples: np.ndarray, sampleRate: int) -> bytes:
+        """
+        将单声道的音频采样编码为本设置的格式
+        :param samples: np.ndarray int16音频采样
+        :param sampleRate: int 采样率
+        :return: bytes 音频文件内容
+        """
+        if self.isPlainWav:
+            buffer = io.BytesIO()
+            wavwrite(buffer, sampleRate, samples)
+            return buffer.getvalue()
+        from pydub import AudioSegment
+        samples = samples.astype("<i2")
+        return self._export(AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=sampleRate, channels=1))
+
+    def transcode(self, data: bytes, sourceFormat: str) -> bytes:
+        """
+        将其他格式的音频文件转换为本设置的格式，格式相同且未指定码率与采样率时原样返回
+        :param data: bytes 音频文件内容
+        :param sourceFormat: str 原格式，如"wav"、"mp3"
+        :return: bytes 音频文件内容
+        """
+        if sourceFormat == self.format and not self.bitrate and not self.sampleRate:
+            return data
+        from pydub import AudioSegment
+        return self._export(AudioSegment.from_file(io.BytesIO(data), format=sourceFormat))
+
+    @staticmethod
+    def decode(path: str) -> tuple[int, np.ndarray]:
+        """
+        读取音频文件，并转换为单声道的int16采样
+        :param path: str 音频文件路径(wav、mp3或ogg)
+        :return: tuple[int, np.ndarray] 采样率, 音频采样
+        """
+        if path.endswith(".wav"):
+            sample_rate, samples = wavread(path)
+            if samples.ndim > 1:
+                samples = samples.mean(axis=1)
+            if samples.dtype.kind == "f":
+                samples = samples.clip(-1, 1) * 32767
+            elif samples.dtype == np.int32:
+                samples = samples / 65536
+            elif samples.dtype == np.uint8:
+                samples = (samples.astype(np.int16) - 128) * 256
+            return sample_rate, samples.astype(np.int16)
+        from pydub import AudioSegment
+        segment = AudioSegment.from_file(path).set_sample_width(2)
+        samples = np.array(segment.get_array_of_samples(), dtype=np.int16)
+        if segment.channels > 1:
+            samples = samples.reshape(-1, segment.channels).mean(axis=1).astype(np.int16)
+        return segment.frame_rate, samples
+
+    @classmethod
+    def formatOf(cls, contentType: str) -> str | None:
+        """
+        根据Content-Type判断音频格式
+        :param contentType: str 响应头中的Content-Type
+        :return: str | None 音频格式，非音频时返回None
+        """
+        mimetype = contentType.split(";")[0].strip()
+        if mimetype in ("audio/x-wav", "audio/wave"):
+            return "wav"
+        return next((key for key, value in cls.mimeTypes.items() if value == mimetype), None)
 
 
 class TTSBase:
@@ -21,6 +152,21 @@ class TTSBase:
         self.save_path = os.path.join(os.getcwd(), 'download').replace('\\', '/')  # 默认文件下载路径
         if not os.path.exists(self.save_path):
             os.mkdir(self.save_path)
+        self.codec = AudioCodec()  # 合成结果的编码设置，由子类根据配置覆盖
+
+    def saveAudio(self, data: bytes) -> str:
+        """
+        将编码后的音频保存至download/，扩展名与self.codec的格式一致
+
+        文件名默认为synthesize，并行合成时(见ChunkedTTS)各线程使用各自的文件名，互不覆盖
+        :param data: bytes 音频文件内容
+        :return: str 音频文件路径
+        """
+        name = getattr(_outputName, "name", "synthesize")
+        file_path = os.path.join(self.save_path, f"{name}.{self.codec.format}").replace('\\', '/')
+        with open(file_path, "wb") as file:
+            file.write(data)
+        return file_path
 
     @abstractmethod
     def synthesize(self, text) -> PathLike:
@@ -54,8 +200,12 @@ class BertVITS2(TTSBase):
         self.host, self.secret = None, None
         self.mode = BertVITS2_config.get("mode", "remote")
         if self.mode == "remote":
-            self.host = BertVITS2_config.get("host", None)
+            self.pool = hostPools.create(self.model, BertVITS2_config)  # host可为多个主机地址，按balancing策略分配请求
+            self.host = self.pool.hosts[0] if self.pool else None
             self.secret = BertVITS2_config.get("secret", None)
+            self.serialization = BertVITS2_config.get("serialization", "json")  # 请求/响应的序列化方式，json或msgpack
+            self.compression = BertVITS2_config.get("compression", None)  # 请求/响应的压缩方式，gzip、zstd或不压缩
+            self.codec = AudioCodec.fromConfig(BertVITS2_config)
             if not self.host:
                 raise ValueError("Bert-VITS2 host is not set! Please check your 'config.json' file.")
             self.checkConnection()
@@ -71,41 +221,57 @@ class BertVITS2(TTSBase):
         :param text: str 待合成的文本
         :return: tuple[int, np.array] 语音数据，分别为采样率和以np.array形式存储的采样数据
         """
+        policy = adaptiveTimeouts.get(f"{self.model}/synthesize", 5, perUnit=0.6, floor=5, cap=120, unit="char")
+        payload = {"text": text, "speaker": self.voice}
+        if not self.codec.isPlainWav:  # 由推理端直接编码为目标格式，避免传输未压缩的采样
+            payload.update(self.codec.requestParams())
+        body, headers = encodeBody(payload, self.serialization, self.compression)
         try:
-            response = requests.post(
-                url=urljoin(self.host, 'synthesize'),
-                params={"secret": self.secret},
-                json={"text": text, "speaker": self.voice},
-                timeout=int(len(text) * 0.6)
-            )
-            data = response.json()
+            with self.pool.request() as host, policy.measure(len(text)) as timeout:
+                response = checkResponse(requests.post(
+                    url=urljoin(host, 'synthesize'),
+                    params={"secret": self.secret},
+                    headers={**headers, **getDeadlineHeader(timeout), **getTraceHeaders()},
+                    data=body,
+                    timeout=timeout
+                ))
+            if AudioCodec.formatOf(response.headers.get("Content-Type", "")) == self.codec.format:
+                return self.saveAudio(response.content)
+            data = decodeResponse(response)  # 推理端返回原始采样(未指定格式，或推理端不支持编码)
             sample_rate = data['sampling_rate']
             audio_data = data['raw']
-            audio_data = np.array(audio_data, dtype=np.int16)
-            wavwrite(os.path.join(self.save_path, "synthesize.wav"), sample_rate, audio_data)
+            if isinstance(audio_data, bytes):  # 以MessagePack传输时，音频为原始采样的二进制数据
+                audio_data = np.frombuffer(audio_data, dtype=data.get("dtype", "int16"))
+            else:
+                audio_data = np.array(audio_data, dtype=np.int16)
         except requests.exceptions.Timeout:
             raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
-        return os.path.join(self.save_path, "synthesize.wav").replace('\\', '/')
+        return self.saveAudio(self.codec.encode(audio_data, sample_rate))
 
     def checkConnection(self):
         """
         检查与远端Bert-VITS2的连接状态
         :return: bool 是否连接成功
         """
-        try:
-            response = requests.get(
-                url=self.host,
-                params={"secret": self.secret},
-                timeout=10
-            )
-            if not response.status_code == 200:
+
+        def check(host: str):
+            try:
+                response = requests.get(
+                    url=host,
+                    params={"secret": self.secret},
+                    timeout=10
+                )
+                if not response.status_code == 200:
+                    raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
+            except requests.exceptions.Timeout:
+                raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
+            except requests.exceptions.ConnectionError:
                 raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
-        except requests.exceptions.Timeout:
-            raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
+
+        try:
+            self.pool.checkAll(check)  # 配置了多个主机时，只要有一个主机可用即视为连接成功
         finally:
             print("Bert-VITS2 remote mode connection check finished.")
 
@@ -122,8 +288,10 @@ class FastSpeech(TTSBase):
         self.host, self.secret = None, None
         self.mode = FastSpeech_config.get("mode", "remote")
         if self.mode == "remote":
-            self.host = FastSpeech_config.get("host", None)
+            self.pool = hostPools.create(self.model, FastSpeech_config)  # host可为多个主机地址，按balancing策略分配请求
+            self.host = self.pool.hosts[0] if self.pool else None
             self.secret = FastSpeech_config.get("secret", None)
+            self.codec = AudioCodec.fromConfig(FastSpeech_config)
             if not self.host:
                 raise ValueError("FastSpeech host is not set! Please check your 'config.json' file.")
             self.checkConnection()
@@ -139,39 +307,48 @@ class FastSpeech(TTSBase):
         :param text: str 待合成的文本
         :return: str 合成后语音文件的绝对路径
         """
+        payload = {"text": text} if self.codec.isPlainWav else {"text": text, **self.codec.requestParams()}
+        policy = adaptiveTimeouts.get(f"{self.model}/synthesize", 20, floor=3, cap=60, unit="char")
         try:
-            response = requests.post(
-                url=urljoin(self.host, 'synthesize'),
-                params={"secret": self.secret},
-                json={"text": text},
-                timeout=20
-            )
-            file_data = response.content
-            with open(os.path.join(self.save_path, "synthesize.wav"), "wb") as file:
-                file.write(file_data)
+            with self.pool.request() as host, policy.measure(len(text)) as timeout:
+                response = checkResponse(requests.post(
+                    url=urljoin(host, 'synthesize'),
+                    params={"secret": self.secret},
+                    headers={**getDeadlineHeader(timeout), **getTraceHeaders()},
+                    json=payload,
+                    timeout=timeout
+                ))
         except requests.exceptions.Timeout:
             raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
-        return os.path.join(self.save_path, "synthesize.wav").replace('\\', '/')
+        source_format = AudioCodec.formatOf(response.headers.get("Content-Type", "")) or "wav"
+        if source_format == self.codec.format:
+            return self.saveAudio(response.content)
+        return self.saveAudio(self.codec.transcode(response.content, source_format))  # 推理端不支持编码时，于本地转换
 
     def checkConnection(self):
         """
         检查与远端FastSpeech的连接状态
         :return: bool 是否连接成功
         """
-        try:
-            request = requests.get(
-                url=self.host,
-                params={"secret": self.secret},
-                timeout=10
-            )
-            if not request.status_code == 200:
+
+        def check(host: str):
+            try:
+                request = requests.get(
+                    url=host,
+                    params={"secret": self.secret},
+                    timeout=10
+                )
+                if not request.status_code == 200:
+                    raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
+            except requests.exceptions.Timeout:
+                raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
+            except requests.exceptions.ConnectionError:
                 raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
-        except requests.exceptions.Timeout:
-            raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
-        except requests.exceptions.ConnectionError:
-            raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
+
+        try:
+            self.pool.checkAll(check)  # 配置了多个主机时，只要有一个主机可用即视为连接成功
         finally:
             print("FastSpeech remote mode connection check finished.")
 
@@ -191,6 +368,8 @@ class OpenAITTS(TTSBase):
         if not self.api_key:
             raise ValueError("OpenAI api_key is not set! Please check your 'config.json' file.")
         self.voice = OpenAI_config.get("tts_voice", "nova")
+        self.codec = AudioCodec(OpenAI_config.get("tts_format") or "mp3", OpenAI_config.get("tts_bitrate") or None,
+                                OpenAI_config.get("tts_sample_rate") or None)
         self.host = OpenAI(api_key=self.api_key)
 
     def synthesize(self, text) -> str:
@@ -201,17 +380,17 @@ class OpenAITTS(TTSBase):
         :param text: str 待合成的文本
         :return: str 合成后语音文件的绝对路径
         """
-        file_path = os.path.join(self.save_path, "synthesize.wav").replace('\\', '/')
+        response_format = {"wav": "wav", "mp3": "mp3", "ogg": "opus"}[self.codec.format]  # OpenAI的opus以ogg封装
         try:
             synthesize = self.host.audio.speech.create(
                 model=self.model,
                 voice=self.voice,
-                input=text
+                input=text,
+                response_format=response_format
             )
-            synthesize.stream_to_file(file_path)
         except Exception as e:
             raise e
-        return file_path
+        return self.saveAudio(self.codec.transcode(synthesize.content, self.codec.format))
 
     def checkConnection(self):
         """
@@ -262,6 +441,7 @@ class BaiduTTS(TTSBase):
         if not self.api_key or not self.secret_key:
             raise ValueError("Baidu TTS api_key or secret_key is not set! Please check your 'config.json' file.")
         self.host = "https://tsn.baidu.com/text2audio"
+        self.codec = AudioCodec.fromConfig(Baidu_config, "mp3")
         if not self.access_token:
             self.OAuth()
 
@@ -294,13 +474,17 @@ class BaiduTTS(TTSBase):
         :return: str 合成
         """
         params = {'tok': self.access_token, 'tex': text, 'cuid': getMacAddress(),
-                  'lan': 'zh', 'ctp': 1, 'per': self.voice_dict[self.voice]}  # 相关参数
+                  'lan': 'zh', 'ctp': 1, 'per': self.voice_dict[self.voice],
+                  'aue': 3 if self.codec.format == "mp3" else 6}  # 相关参数，aue为3时返回mp3，为6时返回wav
+        policy = adaptiveTimeouts.get(f"{self.model}/synthesize", 10, perUnit=0.05, floor=3, cap=60, unit="char")
         try:
-            response = requests.post(
-                url="https://tsn.baidu.com/text2audio",
-                headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': '*/*'},
-                data=urlencode(params).encode()
-            )
+            with policy.measure(len(text)) as timeout:
+                response = requests.post(
+                    url="https://tsn.baidu.com/text2audio",
+                    headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': '*/*'},
+                    data=urlencode(params).encode(),
+                    timeout=timeout
+                )
             if not response.status_code == 200:
                 raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
             if 'content-type' not in response.headers.keys() or response.headers['content-type'].find('audio/') < 0:
@@ -309,9 +493,8 @@ class BaiduTTS(TTSBase):
             raise TimeoutError(f"Connection to {self.model} timed out, please check your network status.")
         except requests.exceptions.ConnectionError:
             raise ConnectionError(f"Connection to {self.model} failed, please check your host and secret.")
-        with open(os.path.join(self.save_path, "synthesize.mp3"), "wb") as file:
-            file.write(response.content)
-        return os.path.join(self.save_path, "synthesize.mp3").replace('\\', '/')
+        source_format = "mp3" if params['aue'] == 3 else "wav"
+        return self.saveAudio(self.codec.transcode(response.content, source_format))
 
     def checkConnection(self):
         """
@@ -328,5 +511,135 @@ class BaiduTTS(TTSBase):
             print("BaiduTTS connection check finished.")
 
 
+def splitText(text: str, maxChars: int) -> list[str]:
+    """
+    将文本按句切分，并将较短的相邻句子合并，使每段不超过maxChars个字符；超长的句子依次按逗号等停顿与字数强制切分
+    :param text: str 待切分的文本
+    :param maxChars: int 每段的最大字符数
+    :return: list[str] 分段列表
+    """
+    pieces = []
+    for sentence in re.findall(r"[^。！？!?；;\n]+[。！？!?；;\n]*", text):
+        sentence = sentence.strip()
+        while len(sentence) > maxChars:
+            cut = max(sentence.rfind(mark, 0, maxChars) for mark in "，,、：: ")
+            cut = cut + 1 if cut > 0 else maxChars
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            pieces.append(sentence)
+    chunks = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + len(piece) <= maxChars:
+            chunks[-1] += piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+class ChunkedTTS(TTSBase):
+    """
+    对任意TTSBase的包装：将较长的文本按句切分为不超过maxChars个字符的若干段，并行合成后按顺序拼接
+
+    同一类型的后端(如全部BaiduTTS实例)共享providerLimits中的并发上限；各段的采样率不一致时统一重采样至最高的采样率。
+    不超过maxChars个字符的文本直接交由被包装的后端合成。其余属性均转发至被包装的后端
+    """
+    providerLimits = {  # 各类后端同时进行的最大合成请求数
+        TTSEnum.Baidu_TTS: 3,
+        TTSEnum.OpenAI_TTS: 4,
+        TTSEnum.Bert_VITS: 2,
+        TTSEnum.FastSpeech_Finetune: 2,
+    }
+    providerMaxChars = {TTSEnum.Baidu_TTS: 500}  # 各类后端单次请求的文本长度上限(百度为1024字节GBK编码)
+    _semaphores: dict[TTSEnum, threading.BoundedSemaphore] = {}
+    _semaphoresLock = threading.Lock()
+
+    def __init__(self, backend: TTSBase, maxChars: int = 120, maxWorkers: int = 4, pause: float = 0.15):
+        """
+        :param backend: TTSBase 被包装的后端
+        :param maxChars: int 每段的最大字符数，不超过该后端的文本长度上限
+        :param maxWorkers: int 本实例同时合成的最大分段数(仍受providerLimits约束)
+        :param pause: float 分段之间插入的静音时长(秒)
+        """
+        super().__init__(backend.type, backend.model, backend.voice)
+        self.backend = backend
+        self.codec = backend.codec
+        self.maxChars = min(maxChars, self.providerMaxChars.get(backend.type, maxChars))
+        self.pause = pause
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="tts-chunk")
+        with self._semaphoresLock:
+            if backend.type not in self._semaphores:
+                self._semaphores[backend.type] = threading.BoundedSemaphore(self.providerLimits.get(backend.type, 2))
+        self.semaphore = self._semaphores[backend.type]
+
+    def __getattr__(self, name: str):
+        if name == "backend":
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def _synthesizeChunk(self, text: str) -> tuple[int, np.ndarray]:
+        _outputName.name = f"chunk-{uuid.uuid4().hex}"
+        try:
+            with self.semaphore:
+                checkCancelled()  # 等待期间本轮对话已被打断时，不再发送请求
+                path = self.backend.synthesize(text)
+            result = AudioCodec.decode(str(path))
+            os.remove(path)
+            return result
+        finally:
+            del _outputName.name
+
+    def synthesize(self, text: str) -> str:
+        """
+        语音合成
+
+        文本较短时直接调用被包装的后端，否则分段并行合成后拼接；当前的一轮对话被打断时放弃尚未开始合成的分段
+        :param text: str 待合成的文本
+        :return: str 合成后语音文件的路径
+        """
+        chunks = splitText(text, self.maxChars)
+        if len(chunks) <= 1:
+            return self.backend.synthesize(text)
+        turn = getCurrentTurn()
+        # 线程池中的线程不继承contextvars，每段复制一份当前的上下文(追踪的请求id、本轮对话的令牌等)
+        futures = [self.executor.submit(contextvars.copy_context().run, self._synthesizeChunk, chunk)
+                   for chunk in chunks]
+        remove = turn.onCancel(lambda: [future.cancel() for future in futures]) if turn else lambda: None
+        try:
+            results = [future.result() for future in futures]
+        except Exception as e:
+            if turn is not None and turn.cancelled:
+                raise TurnCancelled(turn.session) from e
+            raise
+        finally:
+            remove()
+        sample_rate = max(rate for rate, _ in results)
+        segments = []
+        for rate, samples in results:
+            if rate != sample_rate:
+                divisor = np.gcd(rate, sample_rate)
+                samples = resample_poly(samples, sample_rate // divisor, rate // divisor).clip(-32768, 32767)
+            if segments and self.pause > 0:
+                segments.append(np.zeros(int(sample_rate * self.pause), dtype=np.int16))
+            segments.append(samples.astype(np.int16))
+        return self.backend.saveAudio(self.codec.encode(np.concatenate(segments), sample_rate))
+
+
+def createChunkedTTS(backend: TTSBase, Chunking_config: dict) -> TTSBase:
+    """
+    根据配置为后端包装ChunkedTTS
+    :param backend: TTSBase 被包装的后端
+    :param Chunking_config: dict 形如{"enabled": bool, "max_chars": int, "max_workers": int, "pause": float}的配置
+    :return: TTSBase 未启用时原样返回backend
+    """
+    if not Chunking_config.get("enabled", False):
+        return backend
+    return ChunkedTTS(
+        backend,
+        maxChars=Chunking_config.get("max_chars", 120),
+        maxWorkers=Chunking_config.get("max_workers", 4),
+        pause=Chunking_config.get("pause", 0.15)
+    )
+
 if __name__ == '__main__':
     raise NotImplementedError("This module is not runnable!")
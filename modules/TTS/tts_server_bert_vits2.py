@@ -1,7 +1,14 @@
 """此文件以Bert-VITS2为例，展示了如何将一个AI模型包装为API，并允许远程调用"""
+import json
+import math
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import request, abort, jsonify
+import numpy as np
+from flask import request, abort, jsonify, Response, stream_with_context
+from werkzeug.exceptions import BadRequest
 
 from APIWrapper import APIWrapper
 from webui import format_utils, tts_fn
@@ -21,6 +28,50 @@ param = {
     'style_text': '',
     'style_weight': 0.7
 }
+MAX_WORKERS = 4  # 并行合成的分句数
+DEFAULT_PAUSE = 0.2  # 分句之间插入的静音时长(秒)，可通过请求中的pause字段覆盖
+MAX_PAUSE = 5.0  # 请求中pause字段允许的最大值(秒)
+SENTENCE_PATTERN = re.compile(r"[^。！？!?；;\n]+[。！？!?；;\n]*")  # 按句末标点分句，标点保留在句尾
+
+
+def splitSentences(text: str) -> list[str]:
+    """
+    将文本按句末标点拆分为若干分句，忽略空白分句
+    :param text: str 待拆分的文本
+    :return: list[str] 分句列表
+    """
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.findall(text) if sentence.strip()]
+
+
+def parsePause(value) -> float:
+    """
+    解析请求中的pause字段
+    :param value: 请求中的pause字段，为None时使用DEFAULT_PAUSE
+    :return: float 分句之间插入的静音时长(秒)
+    :raises BadRequest: pause不是数字，或不在[0, MAX_PAUSE]范围内
+    """
+    if value is None:
+        return DEFAULT_PAUSE
+    try:
+        pause = float(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"'pause' must be a number, got {value!r}.")
+    if not math.isfinite(pause) or not 0 <= pause <= MAX_PAUSE:
+        raise BadRequest(f"'pause' must be between 0 and {MAX_PAUSE} seconds, got {value!r}.")
+    return pause
+
+
+def synthesizeSentence(sentence: str, speaker: str) -> tuple[int, np.ndarray, float]:
+    """
+    合成单个分句
+    :param sentence: str 分句文本
+    :param speaker: str 说话人
+    :return: tuple[int, np.ndarray, float] 采样率、音频数据以及本分句的合成耗时(秒)
+    """
+    start = time.perf_counter()
+    _, formatted = format_utils(sentence, speaker)  # 组织后的文本内容
+    _, (sample_rate, audio) = tts_fn(formatted, speaker, **param)  # 生成音频
+    return sample_rate, audio, time.perf_counter() - start
 
 
 if __name__ == "__main__":
@@ -33,24 +84,53 @@ if __name__ == "__main__":
     net_g = get_net_g(
         model_path=config.webui_config.model, version=version, device=device, hps=hps
     )
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
 
-    @api_app.addRoute('/synthesize', methods=['POST'])  # 定义一个路由，用于处理文字转语音任务(不带历史记录)
+    @api_app.addRoute('/synthesize', methods=['POST'], maxConcurrency=2, maxQueue=4)  # 定义一个路由，用于处理文字转语音任务(不带历史记录)
     def synthesize():
         """
         将文本转换为音频文件，并发送
+
+        文本会先被拆分为分句并行合成，再按原顺序拼接，分句之间插入pause秒的静音。
+        若请求中stream为真，则以NDJSON的形式逐句返回，每合成完一句(且其之前的分句均已返回)即发送一行。
+        若请求中指定了format("wav"、"mp3"或"ogg")，则将整段音频按bitrate与sample_rate编码后以音频文件的形式返回。
         """
         secret = request.values.get("secret", None)
         data = request.get_json()
         text = data.get("text", None)
         speaker = data.get("speaker", '刻晴')
+        pause = parsePause(data.get("pause"))
         if text is None:
             abort(400)
-        _, text = format_utils(text, speaker)  # 组织后的文本内容
-        _, audio = tts_fn(text, speaker, **param)  # 生成音频
-        sampleRate, audio = audio
-        audio = audio.tolist()
-        return jsonify({"sampling_rate": sampleRate, "raw": audio})
+        sentences = splitSentences(text) or [text]
+        futures = [executor.submit(synthesizeSentence, sentence, speaker) for sentence in sentences]
+
+        if data.get("stream", False):
+            def generate():
+                for index, (sentence, future) in enumerate(zip(sentences, futures)):
+                    sample_rate, audio, seconds = future.result()
+                    yield json.dumps({
+                        "index": index, "text": sentence, "sampling_rate": sample_rate,
+                        "raw": audio.tolist(), "seconds": seconds
+                    }, ensure_ascii=False) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        segments, timings, sampleRate = [], [], None
+        for sentence, future in zip(sentences, futures):
+            sampleRate, audio, seconds = future.result()
+            if segments and pause > 0:
+                segments.append(np.zeros(int(sampleRate * pause), dtype=audio.dtype))
+            segments.append(audio)
+            timings.append({"text": sentence, "seconds": seconds, "duration": len(audio) / sampleRate})
+        audio = np.concatenate(segments)
+        if data.get("format"):
+            return api_app.audioResponse(audio, sampleRate, data["format"], data.get("bitrate"), data.get("sample_rate"))
+        result = {"sampling_rate": sampleRate, "dtype": str(audio.dtype), "segments": timings}
+        if api_app.wantsBinary():  # 客户端接受MessagePack时直接发送原始采样
+            return api_app.binaryResponse({**result, "raw": audio.tobytes()})
+        return jsonify({**result, "raw": audio.tolist()})
 
 
-    api_app.run()
\ No newline at end of file
+    api_app.run()
@@ -1,29 +1,110 @@
 """此文件以FastSpeech2为例，展示了如何将一个AI模型包装为API，并允许远程调用"""
-from APIWrapper import APIWrapper
-from flask import request, send_file, abort
-import re
-import argparse
-from string import punctuation
+import queue
+import threading
+import time
 from types import SimpleNamespace
-from synthesize import preprocess_mandarin, synthesize
+
+import numpy as np
 import torch
 import yaml
-import numpy as np
-from torch.utils.data import DataLoader
-from g2p_en import G2p
-from pypinyin import pinyin, Style
-from utils.model import get_model, get_vocoder
-from utils.tools import to_device, synth_samples
+from flask import request, abort
+
+from APIWrapper import APIWrapper
 from dataset import TextDataset
-from text import text_to_sequence
+from synthesize import preprocess_mandarin
+from utils.model import get_model, get_vocoder, vocoder_infer
+from utils.tools import to_device
+
+BATCH_SIZE = 8  # 单批次最多合并的请求数，与synthesize.py中batch模式的DataLoader保持一致
+BATCH_WAIT = 0.05  # 收到第一个请求后，等待其他并发请求加入同一批次的最长时间(秒)
+REQUEST_TIMEOUT = 60  # 单个请求等待合成结果的最长时间(秒)
+
+
+class SynthesisJob:
+    """一次合成请求，由请求线程创建，由合成线程填充结果"""
+
+    def __init__(self, text: str, deadline: float = None):
+        """
+        :param text: str 待合成的文本
+        :param deadline: float 请求方放弃等待的时刻(time.time())，默认为REQUEST_TIMEOUT秒后
+        """
+        self.text = text
+        self.deadline = deadline if deadline is not None else time.time() + REQUEST_TIMEOUT
+        self.done = threading.Event()
+        self.wav = None  # np.ndarray[int16]，合成得到的音频
+        self.error = None  # 合成过程中出现的异常
+
+
+def synthesizeBatch(jobs: list[SynthesisJob]) -> list[np.ndarray]:
+    """
+    将若干请求组织为一个batch并进行合成
+
+    batch直接由synthesize.py中batch模式所用的TextDataset.collate_fn组织(该方法只处理传入的样本，不依赖数据集本身)
+    :param jobs: list[SynthesisJob] 待合成的请求
+    :return: list[np.ndarray] 与jobs一一对应的音频数据
+    """
+    samples = [
+        (job.text[:100], args.speaker_id, np.array(preprocess_mandarin(job.text, preprocess_config)), job.text[:100])
+        for job in jobs
+    ]  # 与TextDataset.__getitem__相同的(basename, speaker_id, phone, raw_text)
+    batch = to_device(TextDataset.collate_fn(None, samples), device)
+    with torch.no_grad():
+        output = model(
+            *(batch[2:]),
+            p_control=args.pitch_control,
+            e_control=args.energy_control,
+            d_control=args.duration_control
+        )
+        mel_predictions = output[1].transpose(1, 2)
+        lengths = output[9] * preprocess_config["preprocessing"]["stft"]["hop_length"]
+        return vocoder_infer(mel_predictions, vocoder, model_config, preprocess_config, lengths=lengths)
+
+
+def runJobs(jobs: list[SynthesisJob]) -> None:
+    """
+    合成并填充各请求的结果；整批合成失败时逐个重新合成，使个别无法处理的文本只影响其自身的请求
+    :param jobs: list[SynthesisJob] 待合成的请求
+    """
+    try:
+        for job, wav in zip(jobs, synthesizeBatch(jobs)):
+            job.wav = wav
+        return
+    except Exception as e:
+        if len(jobs) == 1:
+            jobs[0].error = e
+            return
+    for job in jobs:
+        runJobs([job])
+
+
+def batchWorker():
+    """
+    合成线程：从队列中取出请求，在BATCH_WAIT时间内尽可能多地合并并发请求后统一合成，请求方已放弃等待的请求直接丢弃
+    """
+    while True:
+        jobs = [job_queue.get()]
+        try:
+            while len(jobs) < BATCH_SIZE:
+                jobs.append(job_queue.get(timeout=BATCH_WAIT))
+        except queue.Empty:
+            pass
+        now = time.time()
+        for job in jobs:
+            if job.deadline <= now:
+                job.error = TimeoutError("Synthesis request expired before it was processed.")
+        try:
+            pending = [job for job in jobs if job.error is None]
+            if pending:
+                runJobs(pending)
+        finally:
+            for job in jobs:
+                job.done.set()
+
 
 if __name__ == "__main__":
     api_app = APIWrapper()  # 创建一个api_app对象
-    args = {
+    args = SimpleNamespace(**{
         'restore_step': 600000,
-        'mode': 'single',
-        'source': None,
-        'text': None,
         'speaker_id': 44,
         'preprocess_config': 'config/AISHELL3/preprocess.yaml',
         'model_config': 'config/AISHELL3/model.yaml',
@@ -31,67 +112,57 @@ if __name__ == "__main__":
         'pitch_control': 1.0,
         'energy_control': 1.0,
         'duration_control': 1.0
-    }
+    })
     device = "cpu"
 
+    # 配置、模型与声码器仅在启动时加载一次，所有请求共享
+    with open(args.preprocess_config, "r") as f:
+        preprocess_config = yaml.load(f, Loader=yaml.FullLoader)
+    with open(args.model_config, "r") as f:
+        model_config = yaml.load(f, Loader=yaml.FullLoader)
+    with open(args.train_config, "r") as f:
+        train_config = yaml.load(f, Loader=yaml.FullLoader)
+    configs = (preprocess_config, model_config, train_config)
+    model = get_model(args, configs, device, train=False)
+    vocoder = get_vocoder(model_config, device)
+    sampling_rate = preprocess_config["preprocessing"]["audio"]["sampling_rate"]
 
-    @api_app.addRoute('/transcribe', methods=['POST'])  # 定义一个路由，用于处理文字转语音任务(不带历史记录)
-    def transcribe():
+    synthesizeBatch([SynthesisJob("你好")])  # 预热，避免首个请求承担初始化开销
+    job_queue = queue.Queue()
+    threading.Thread(target=batchWorker, daemon=True).start()
+    api_app.queueDepth = job_queue.qsize  # 通过/ready报告等待合成的请求数
+
+
+    @api_app.addRoute('/synthesize', methods=['POST'])  # 定义一个路由，用于处理文字转语音任务(不带历史记录)
+    def synthesize():
         """
         将文本转换为音频文件，并发送
+
+        音频在内存中编码后直接返回，不同请求之间不共享输出文件。编码格式由请求中的format("wav"、"mp3"或"ogg")、
+        bitrate(如"32k")与sample_rate(目标采样率)指定，默认为原采样率的wav
         """
         secret = request.values.get("secret", None)
         data = request.get_json()
         text = data.get("text", None)
-        if text is None:
+        if not text:
             abort(400)
-        global args
-        args["text"] = text
-        args = SimpleNamespace(**args)
+        deadline = request.headers.get(api_app.deadlineHeader, type=float)  # 客户端的截止时间(详见APIWrapper)
+        job = SynthesisJob(text, min(deadline, time.time() + REQUEST_TIMEOUT) if deadline else None)
+        job_queue.put(job)
+        if not job.done.wait(max(job.deadline - time.time(), 0)):
+            abort(504)
+        if job.error is not None:
+            abort(500)
+        return api_app.audioResponse(job.wav, sampling_rate, data.get("format", "wav"), data.get("bitrate"),
+                                     data.get("sample_rate"))
 
-        # 以下执行部分拷贝自synthesize.py
 
-        # Check source texts
-        if args.mode == "batch":
-            assert args.source is not None and args.text is None
-        if args.mode == "single":
-            assert args.source is None and args.text is not None
-
-        # Read Config
-        preprocess_config = yaml.load(
-            open(args.preprocess_config, "r"), Loader=yaml.FullLoader
-        )
-        model_config = yaml.load(open(args.model_config, "r"), Loader=yaml.FullLoader)
-        train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
-        configs = (preprocess_config, model_config, train_config)
-
-        # Get model
-        model = get_model(args, configs, device, train=False)
-
-        # Load vocoder
-        vocoder = get_vocoder(model_config, device)
-
-        # Preprocess texts
-        if args.mode == "batch":
-            # Get dataset
-            dataset = TextDataset(args.source, preprocess_config)
-            batchs = DataLoader(
-                dataset,
-                batch_size=8,
-                collate_fn=dataset.collate_fn,
-            )
-        if args.mode == "single":
-            ids = raw_texts = [args.text[:100]]
-            speakers = np.array([args.speaker_id])
-            texts = np.array([preprocess_mandarin(args.text, preprocess_config)])
-            text_lens = np.array([len(texts[0])])
-            batchs = [(ids, raw_texts, speakers, texts, text_lens, max(text_lens))]
-
-        control_values = args.pitch_control, args.energy_control, args.duration_control
-
-        synthesize(model, args.restore_step, configs, vocoder, batchs, control_values)
-        file = open('output/result/AISHELL3/output.wav', 'rb')
-        return send_file(file, mimetype="audio/wav")
+    @api_app.addRoute('/transcribe', methods=['POST'])  # 兼容旧版本的路由名称
+    def transcribe():
+        """
+        同synthesize
+        """
+        return synthesize()
 
 
     api_app.run()
@@ -0,0 +1,224 @@
+"""该文件定义了自部署推理端(Whisper、Waltz、Bert-VITS2、FastSpeech)的多主机负载均衡"""
+import hashlib
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+
+class HostStats:
+    """单个主机的状态与统计数据"""
+    __slots__ = ("host", "outstanding", "ewma", "requests", "failures", "consecutive", "ejectedUntil", "ejected")
+
+    def __init__(self, host: str):
+        self.host = host
+        self.outstanding = 0  # 正在进行的请求数
+        self.ewma = 0.0  # 耗时的指数加权移动平均(秒)，为0时表示尚无样本
+        self.requests = 0
+        self.failures = 0
+        self.consecutive = 0  # 连续失败次数
+        self.ejectedUntil = 0.0  # 被剔除至该时刻(time.monotonic)
+        self.ejected = 0  # 被剔除的总次数
+
+    def toDict(self) -> dict:
+        return {"outstanding": self.outstanding, "ewma_seconds": self.ewma, "requests": self.requests,
+                "failures": self.failures, "ejected": self.ejected,
+                "healthy": self.ejectedUntil <= time.monotonic()}
+
+
+class HostPool:
+    """
+    多主机负载均衡
+
+    strategy为"least_outstanding"时选择正在进行的请求最少的主机；为"ewma"时选择 EWMA耗时 × (正在进行的请求数 + 1)
+    最小的主机(尚无样本的主机优先)。连续失败ejectAfter次(连接失败或超时)的主机被剔除ejectSeconds秒，
+    到期后重新参与选择，再次失败则立即被剔除；全部主机均被剔除时仍在其中选择，而不是直接失败。
+    传入affinity键时，使用最高随机权重哈希(rendezvous hashing)将同一键固定到同一主机，以命中推理端的会话缓存
+    """
+    strategies = ("least_outstanding", "ewma")
+
+    def __init__(self, hosts: list[str], strategy: str = "least_outstanding", decay: float = 0.3,
+                 ejectAfter: int = 3, ejectSeconds: float = 30.0):
+        """
+        :param hosts: list[str] 主机地址，如["http://10.0.0.1:8000/", "http://10.0.0.2:8000/"]
+        :param strategy: str 选择策略，"least_outstanding"或"ewma"
+        :param decay: float EWMA中新样本的权重
+        :param ejectAfter: int 剔除主机所需的连续失败次数
+        :param ejectSeconds: float 剔除时长(秒)
+        """
+        if not hosts:
+            raise ValueError("HostPool requires at least one host.")
+        if strategy not in self.strategies:
+            raise ValueError(f"Unsupported balancing strategy: '{strategy}', currently only support {self.strategies}")
+        self.hosts = list(hosts)
+        self.strategy = strategy
+        self.decay = decay
+        self.ejectAfter = ejectAfter
+        self.ejectSeconds = ejectSeconds
+        self.stats = {host: HostStats(host) for host in self.hosts}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromConfig(cls, config: dict) -> "HostPool | None":
+        """
+        根据推理端的配置创建HostPool
+        :param config: dict 含"host"(str或list[str])，以及可选的"balancing"、"eject_after"、"eject_seconds"的配置
+        :return: HostPool | None 未设置host时返回None
+        """
+        hosts = config.get("host", None)
+        hosts = [hosts] if isinstance(hosts, str) else hosts
+        hosts = [host for host in hosts or [] if host]
+        if not hosts:
+            return None
+        return cls(hosts, config.get("balancing", "least_outstanding"),
+                   ejectAfter=config.get("eject_after", 3), ejectSeconds=config.get("eject_seconds", 30))
+
+    def _cost(self, stats: HostStats) -> float:
+        if self.strategy == "ewma":
+            return stats.ewma * (stats.outstanding + 1)
+        return stats.outstanding
+
+    def pick(self, key: str = None) -> str:
+        """
+        选择一个主机(不计入正在进行的请求，通常应使用request)
+        :param key: str 会话亲和的键，为None时不考虑亲和
+        :return: str 主机地址
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [stats for stats in self.stats.values() if stats.ejectedUntil <= now]
+            candidates = candidates or list(self.stats.values())
+            if len(candidates) == 1:
+                return candidates[0].host
+            if key is not None:
+                return max(candidates,
+                           key=lambda stats: hashlib.md5(f"{key}|{stats.host}".encode("utf-8")).digest()).host
+            lowest = min(self._cost(stats) for stats in candidates)
+            return random.choice([stats for stats in candidates if self._cost(stats) == lowest]).host
+
+    @contextmanager
+    def track(self, host: str):
+        """
+        记录对指定主机的一次请求，用法：
+            with pool.track(host):
+                requests.post(urljoin(host, ...), ...)
+        连接失败或超时计入该主机的连续失败次数，其余异常(包括鉴权失败引发的ConnectionRefusedError，
+        详见modules.utils.checkResponse)不影响主机的健康状态
+        :param host: str 主机地址
+        """
+        stats = self.stats[host]
+        with self._lock:
+            stats.outstanding += 1
+            stats.requests += 1
+        start = time.perf_counter()
+        try:
+            yield host
+        except ConnectionRefusedError:  # 鉴权失败与主机是否健康无关
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError, TimeoutError):
+            with self._lock:
+                stats.failures += 1
+                stats.consecutive += 1
+                if stats.consecutive >= self.ejectAfter:
+                    stats.ejected += stats.ejectedUntil <= time.monotonic()
+                    stats.ejectedUntil = time.monotonic() + self.ejectSeconds
+            raise
+        finally:
+            with self._lock:
+                stats.outstanding -= 1
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats.consecutive = 0
+            stats.ejectedUntil = 0.0
+            stats.ewma = elapsed if stats.ewma == 0 else (1 - self.decay) * stats.ewma + self.decay * elapsed
+
+    @contextmanager
+    def request(self, key: str = None):
+        """
+        选择主机并记录本次请求，用法：
+            with pool.request() as host:
+                requests.post(urljoin(host, ...), ...)
+        :param key: str 会话亲和的键，为None时按strategy选择
+        """
+        with self.track(self.pick(key)) as host:
+            yield host
+
+    def checkAll(self, check) -> None:
+        """
+        逐一检查全部主机，检查失败的主机将被剔除；只有全部主机均失败时才抛出异常
+        :param check: Callable[[str], None] 检查单个主机的函数，失败时抛出异常
+        """
+        error = None
+        for host in self.hosts:
+            try:
+                with self.track(host):
+                    check(host)
+            except (ConnectionError, TimeoutError) as e:
+                stats = self.stats[host]
+                with self._lock:
+                    stats.ejected += stats.ejectedUntil <= time.monotonic()
+                    stats.ejectedUntil = time.monotonic() + self.ejectSeconds
+                print(f"Host '{host}' is unavailable and ejected for {self.ejectSeconds}s: {e}")
+                error = e
+        if error is not None and all(stats.ejectedUntil > time.monotonic() for stats in self.stats.values()):
+            raise error
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        :return: dict[str, dict] 各主机的状态与统计数据
+        """
+        with self._lock:
+            return {host: stats.toDict() for host, stats in self.stats.items()}
+
+
+class HostPools:
+    """全部HostPool的注册表，用于汇总各推理端的主机统计数据"""
+
+    def __init__(self):
+        self.pools: dict[str, HostPool] = {}
+
+    def create(self, name: str, config: dict) -> HostPool | None:
+        """
+        根据配置创建HostPool并登记
+        :param name: str 推理端名称(通常为模型名称)，同名的HostPool将被替换
+        :param config: dict 详见HostPool.fromConfig
+        :return: HostPool | None 未设置host时返回None
+        """
+        pool = HostPool.fromConfig(config)
+        if pool is not None:
+            self.pools[name] = pool
+        return pool
+
+    def snapshot(self) -> dict[str, dict[str, dict]]:
+        """
+        :return: dict[str, dict[str, dict]] 形如{推理端: {主机: {"outstanding": int, ...}}}
+        """
+        return {name: pool.snapshot() for name, pool in list(self.pools.items())}
+
+    def export(self) -> str:
+        """
+        以Prometheus文本格式导出各主机的统计数据
+        :return: str
+        """
+        rows = [(name, host, stats) for name, hosts in self.snapshot().items() for host, stats in hosts.items()]
+        metrics = [
+            ("client_host_outstanding", "gauge", "In-flight requests per host.", "outstanding"),
+            ("client_host_latency_ewma_seconds", "gauge", "EWMA of request latency per host.", "ewma_seconds"),
+            ("client_host_requests_total", "counter", "Requests sent per host.", "requests"),
+            ("client_host_failures_total", "counter", "Connection failures and timeouts per host.", "failures"),
+            ("client_host_ejections_total", "counter", "Times a host was ejected as unhealthy.", "ejected"),
+            ("client_host_healthy", "gauge", "Whether a host currently receives traffic.", "healthy"),
+        ]
+        lines = []
+        for metric, metricType, description, field in metrics:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {metricType}"]
+            lines += [f'{metric}{{backend="{name}",host="{host}"}} {float(stats[field]):g}' for name, host, stats in rows]
+        return "\n".join(lines) + "\n"
+
+
+hostPools = HostPools()  # 全局单例
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
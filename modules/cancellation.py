@@ -0,0 +1,200 @@
+"""该文件定义了可打断的对话轮次：每个会话同时只有一轮有效的对话，新的输入会取消上一轮尚未完成的生成、合成与播放"""
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+_currentTurn: ContextVar["TurnToken"] = ContextVar("currentTurn", default=None)
+
+
+class TurnCancelled(Exception):
+    """本轮对话已被新的输入打断"""
+
+    def __init__(self, session: str = None):
+        super().__init__(f"Turn of session '{session}' was cancelled by a newer input.")
+        self.session = session
+
+
+class TurnToken:
+    """
+    一轮对话的取消令牌
+
+    正在进行的调用通过onCancel登记取消时的回调(关闭上游的HTTP/WebSocket连接、终止播放进程等)，
+    cancel()由打断本轮的线程调用，依次执行这些回调，使阻塞在网络读取上的调用尽快返回
+    """
+
+    def __init__(self, session: str = None):
+        """
+        :param session: str 会话id
+        """
+        self.session = session
+        self._event = threading.Event()
+        self._callbacks: dict[int, Callable[[], None]] = {}
+        self._nextId = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """
+        取消本轮对话并执行已登记的回调(回调中的异常将被忽略)，重复调用无效果
+        """
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = list(self._callbacks.values()), {}
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Failed to cancel part of the turn: {e}")
+
+    def check(self) -> None:
+        """
+        本轮已被取消时抛出TurnCancelled
+        """
+        if self._event.is_set():
+            raise TurnCancelled(self.session)
+
+    def onCancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        登记取消时的回调，本轮已被取消时立即执行
+        :param callback: Callable[[], None] 回调函数
+        :return: Callable[[], None] 撤销登记的函数
+        """
+        with self._lock:
+            if not self._event.is_set():
+                callbackId, self._nextId = self._nextId, self._nextId + 1
+                self._callbacks[callbackId] = callback
+                return lambda: self._removeCallback(callbackId)
+        callback()
+        return lambda: None
+
+    def _removeCallback(self, callbackId: int) -> None:
+        with self._lock:
+            self._callbacks.pop(callbackId, None)
+
+
+class TurnRegistry:
+    """各会话当前一轮对话的令牌"""
+
+    def __init__(self):
+        self.turns: dict[str, TurnToken] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, session: str) -> TurnToken:
+        """
+        开始新的一轮对话，同时取消该会话的上一轮(包括仍在播放的回复)
+        :param session: str 会话id
+        :return: TurnToken 新一轮的令牌
+        """
+        token = TurnToken(session)
+        with self._lock:
+            previous, self.turns[session] = self.turns.get(session), token
+        if previous is not None:
+            previous.cancel()
+        return token
+
+    def cancel(self, session: str) -> bool:
+        """
+        取消该会话当前的一轮对话
+        :param session: str 会话id
+        :return: bool 是否存在尚未取消的一轮
+        """
+        with self._lock:
+            token = self.turns.pop(session, None)
+        if token is None or token.cancelled:
+            return False
+        token.cancel()
+        return True
+
+
+@contextmanager
+def turnScope(token: TurnToken):
+    """
+    指定此范围内的调用所属的一轮对话，用法：
+        with turnScope(turnRegistry.begin(request.session_hash)):
+            nlg_service.continuedQuery(...)
+    本轮被取消后，范围内抛出的异常(多为连接被关闭所致)均转换为TurnCancelled
+    :param token: TurnToken 本轮的令牌
+    """
+    reset = _currentTurn.set(token)
+    try:
+        yield token
+    except TurnCancelled:
+        raise
+    except Exception as e:
+        if token.cancelled:
+            raise TurnCancelled(token.session) from e
+        raise
+    finally:
+        _currentTurn.reset(reset)
+
+
+def getCurrentTurn() -> TurnToken | None:
+    """
+    :return: TurnToken | None 当前所属的一轮对话，不在turnScope中时为None
+    """
+    return _currentTurn.get()
+
+
+def checkCancelled() -> None:
+    """
+    当前的一轮对话已被取消时抛出TurnCancelled
+    """
+    turn = _currentTurn.get()
+    if turn is not None:
+        turn.check()
+
+
+def closeQuietly(stream) -> None:
+    """
+    关闭上游的流式响应(requests.Response、SDK的流对象或WebSocketApp等)，忽略关闭时的异常
+    :param stream: 具有close方法(或其response属性具有close方法)的对象
+    """
+    for target in (stream, getattr(stream, "response", None)):
+        close = getattr(target, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception:
+                pass
+            return
+
+
+@contextmanager
+def closeOnCancel(stream):
+    """
+    当前的一轮对话被取消时立即关闭stream，用法：
+        response = requests.post(..., stream=True)
+        with closeOnCancel(response):
+            for line in response.iter_lines():
+                ...
+    关闭后范围内抛出的异常转换为TurnCancelled；读取因连接关闭而正常结束时，离开范围时同样抛出TurnCancelled
+    :param stream: 详见closeQuietly
+    """
+    turn = _currentTurn.get()
+    if turn is None:
+        yield stream
+        return
+    remove = turn.onCancel(lambda: closeQuietly(stream))
+    try:
+        yield stream
+    except TurnCancelled:
+        raise
+    except Exception as e:
+        if turn.cancelled:
+            raise TurnCancelled(turn.session) from e
+        raise
+    finally:
+        remove()
+    turn.check()
+
+
+turnRegistry = TurnRegistry()  # 全局单例
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
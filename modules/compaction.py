@@ -0,0 +1,130 @@
+"""该文件定义了历史记录的滚动摘要压缩：token数超过阈值时，较早的对话由后台生成的摘要代替"""
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.conversation import getSessionKey
+from modules.utils import Configs
+
+
+class SummaryState:
+    """单个会话的摘要状态，covered为已并入摘要的对话轮数"""
+    __slots__ = ("summary", "covered", "pending")
+
+    def __init__(self):
+        self.summary = ""
+        self.covered = 0
+        self.pending = False  # 是否有摘要任务正在后台执行
+
+
+class HistoryCompactor:
+    """
+    滚动摘要压缩器
+
+    每次查询时，若摘要与尚未并入摘要的对话的token数之和超过threshold，则在后台线程中将除最近keepTurns轮之外的对话
+    增量地并入摘要(只处理新增的部分，不重新生成)；查询本身只使用当前已有的摘要，从不等待摘要完成
+    """
+    summaryPrompt = "你是一个对话摘要助手。请将新增的对话内容合并进已有摘要，保留人名、数字、偏好、约定等关键事实，" \
+                    "删除寒暄与重复内容，只输出更新后的摘要，不超过{limit}字。"
+
+    def __init__(self, backend=None, threshold: int = 3000, keepTurns: int = 4, batchTokens: int = 2000,
+                 summaryLimit: int = 500, maxSessions: int = 256):
+        """
+        :param backend: NLGBase 用于生成摘要的后端(建议使用廉价、快速的模型)，为None时使用发起查询的后端
+        :param threshold: int 触发压缩的token数阈值
+        :param keepTurns: int 始终原样保留的最近轮数
+        :param batchTokens: int 单次摘要请求中新增对话的最大token数，过多的对话将分批并入
+        :param summaryLimit: int 摘要的字数上限(写入摘要提示语)
+        :param maxSessions: int 最多缓存摘要的会话数(按最近使用淘汰)
+        """
+        self.backend = backend
+        self.threshold = threshold
+        self.keepTurns = keepTurns
+        self.batchTokens = batchTokens
+        self.summaryLimit = summaryLimit
+        self.maxSessions = maxSessions
+        self._states: OrderedDict[str, SummaryState] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+
+    def compact(self, history, exchanges: list[list[str, str]], caller) -> tuple[str, int]:
+        """
+        获取会话当前的摘要，并在需要时安排后台压缩
+        :param history: Session 会话句柄，用于区分会话([[str, str]...]形式的历史记录以首轮对话区分，开场白相同的会话
+        将共用同一份摘要，因此不应传入)
+        :param exchanges: list[list[str, str]] 全部对话(用户输入, 机器人回复)
+        :param caller: NLGBase 发起查询的后端，用于计算token数，未指定backend时也用于生成摘要
+        :return: tuple[str, int] 摘要, 已并入摘要的轮数(为0时表示尚无摘要)
+        """
+        key = getSessionKey(history)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None or state.covered > len(exchanges):  # 新会话，或会话被清除后重新开始
+                state = SummaryState()
+                self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.maxSessions:
+                self._states.popitem(last=False)
+            summary, covered = state.summary, state.covered
+            target = len(exchanges) - self.keepTurns
+            if state.pending or target <= covered:
+                return summary, covered
+            tokens = caller.countTokens(message=summary) if summary else 0
+            tokens += sum(caller.countTokens(message=user + assistant) for user, assistant in exchanges[covered:])
+            if tokens > self.threshold:
+                state.pending = True
+                self._executor.submit(self._summarize, state, list(exchanges[covered:target]), caller)
+        return summary, covered
+
+    def _summarize(self, state: SummaryState, exchanges: list[list[str, str]], caller):
+        backend = self.backend if self.backend else caller
+        try:
+            while exchanges:
+                batch, tokens = [], 0
+                while exchanges and (not batch or tokens < self.batchTokens):
+                    user, assistant = exchanges.pop(0)
+                    batch.append(f"用户：{user}\n助手：{assistant}")
+                    tokens += caller.countTokens(message=user + assistant)
+                message = f"已有摘要：\n{state.summary or '(无)'}\n\n新增对话：\n" + "\n".join(batch)
+                summary = backend.singleQuery(message, self.summaryPrompt.format(limit=self.summaryLimit))
+                with self._lock:
+                    state.summary, state.covered = summary.strip(), state.covered + len(batch)
+        except Exception:
+            traceback.print_exc()  # 摘要失败不影响对话，下一轮查询时将重新尝试
+        finally:
+            state.pending = False
+
+    @staticmethod
+    def mergePrompt(prompt: str, summary: str) -> str:
+        """
+        将摘要并入提示语(部分API不支持多条system消息)
+        :param prompt: str 原提示语，允许为空
+        :param summary: str 摘要
+        :return: str
+        """
+        summaryPrompt = f"以下是此前对话的摘要，请在回答时参考：\n{summary}"
+        return f"{prompt}\n\n{summaryPrompt}" if prompt else summaryPrompt
+
+
+def createCompactor(Compaction_config: dict) -> HistoryCompactor | None:
+    """
+    根据配置创建HistoryCompactor，摘要后端需另行指定(见HistoryCompactor.backend)
+    :param Compaction_config: dict 形如{"enabled": bool, "threshold": int, "keep_turns": int, "batch_tokens": int,
+    "summary_limit": int}的配置
+    :return: HistoryCompactor | None 未启用时返回None
+    """
+    if not Compaction_config.get("enabled", False):
+        return None
+    return HistoryCompactor(
+        threshold=Compaction_config.get("threshold", 3000),
+        keepTurns=Compaction_config.get("keep_turns", 4),
+        batchTokens=Compaction_config.get("batch_tokens", 2000),
+        summaryLimit=Compaction_config.get("summary_limit", 500)
+    )
+
+
+historyCompactor = createCompactor(Configs.get("Compaction", {}))  # 全局单例，未启用时为None
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
@@ -0,0 +1,219 @@
+"""该文件定义了持久化的会话存储，以会话id为键保存聊天记录，并增量维护转换后的消息列表与token数"""
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from modules.utils import Message
+
+
+class Turn:
+    """单条消息的紧凑表示，tokens为持久化的token数(由tokenizer计算，None表示尚未计算)"""
+    __slots__ = ("role", "content", "tokens", "tokenizer", "counts")
+
+    def __init__(self, role: str, content: str, tokens: int = None, tokenizer: str = None):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+        self.tokenizer = tokenizer  # 计算tokens时使用的分词器名称
+        self.counts = {tokenizer: tokens} if tokens is not None and tokenizer else {}  # 各分词器的token数(仅内存中)
+
+
+class Session:
+    """
+    一个会话的聊天记录，可直接作为history传入NLGBase.continuedQuery，代替[[str, str]...]形式的历史记录
+
+    转换后的Message列表随append增量维护，无需每轮重新构建
+    """
+
+    def __init__(self, session_id: str, store: "ConversationStore" = None, turns: list[Turn] = None):
+        self.session_id = session_id
+        self.store = store
+        self.turns = turns if turns else []
+        self._messages = [Message(role=turn.role, content=turn.content) for turn in self.turns]
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.turns) // 2
+
+    def append(self, role: str, content: str) -> Turn:
+        """
+        追加一条消息，并写入存储
+        :param role: str "user"或"assistant"
+        :param content: str 消息内容
+        :return: Turn
+        """
+        with self.lock:
+            turn = Turn(role, content)
+            self.turns.append(turn)
+            self._messages.append(Message(role=role, content=content))
+            if self.store:
+                self.store.write(self.session_id, len(self.turns) - 1, turn)
+            return turn
+
+    def appendExchange(self, message: str, reply: str) -> None:
+        """
+        追加一轮对话(用户输入与机器人回复)
+        :param message: str 用户输入
+        :param reply: str 机器人回复
+        """
+        with self.lock:
+            self.append("user", message)
+            self.append("assistant", reply)
+
+    def messages(self, prompt: str = None) -> list[Message]:
+        """
+        返回[{"role": "user", "content": ""}, {"role": "assistant", "content": ""}...]格式的历史记录(浅拷贝，可直接修改)
+        :param prompt: str 提示语，非空时置于列表首位
+        :return: list[Message]
+        """
+        with self.lock:
+            return ([Message(role="system", content=prompt)] if prompt else []) + self._messages
+
+    def toHistory(self) -> list[list[str]]:
+        """
+        返回[[str, str]...]格式的历史记录，用于gradio的Chatbot组件
+        :return: list[list[str]]
+        """
+        with self.lock:
+            return [[self.turns[i].content, self.turns[i + 1].content] for i in range(0, len(self.turns) - 1, 2)]
+
+    def countTokens(self, tokenizer) -> int:
+        """
+        使用指定的分词器统计全部消息的token数，每条消息的结果按分词器名称缓存，切换后端后无需重新计算；
+        新计算的结果在同一事务中持久化
+        :param tokenizer: modules.tokenizer.TokenizerBase 分词器
+        :return: int token数
+        """
+        total, counted = 0, []
+        with self.lock:
+            for index, turn in enumerate(self.turns):
+                tokens = turn.counts.get(tokenizer.name)
+                if tokens is None:
+                    tokens = turn.counts[tokenizer.name] = tokenizer.count(turn.content)
+                    turn.tokens, turn.tokenizer = tokens, tokenizer.name
+                    counted.append((index, turn))
+                total += tokens
+            if counted and self.store:
+                self.store.writeMany(self.session_id, counted)
+        return total
+
+    def clear(self) -> None:
+        """
+        清空本会话的全部记录
+        """
+        with self.lock:
+            self.turns.clear()
+            self._messages.clear()
+            if self.store:
+                self.store.delete(self.session_id)
+
+
+def getSessionKey(history: list[list[str, str]] | Session) -> str:
+    """
+    获取历史记录所属会话的标识：Session取其session_id，[[str, str]...]形式的历史记录则以首轮对话的内容作为标识
+    :param history: list[list[str, str]] | Session 历史记录
+    :return: str 会话标识，历史记录为空时返回空字符串
+    """
+    if isinstance(history, Session):
+        return history.session_id
+    if not history:
+        return ""
+    user, assistant = history[0][0], history[0][1]
+    return f"{zlib.crc32(user.encode('utf-8'))}-{zlib.crc32(assistant.encode('utf-8'))}"
+
+
+class ConversationStore:
+    """
+    基于SQLite的会话存储，每条消息一行，追加写入；最近打开的maxSessions个会话常驻内存，其余按最近使用淘汰
+    (记录仍保留在数据库中，再次打开时重新读取)
+    """
+
+    def __init__(self, path: str = "conversations.db", maxSessions: int = 256):
+        """
+        :param path: str 数据库文件路径，为":memory:"时不落盘
+        :param maxSessions: int 最多常驻内存的会话数
+        """
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, "
+            "tokens INTEGER, tokenizer TEXT, created REAL NOT NULL, PRIMARY KEY (session_id, seq))"
+        )
+        self.connection.commit()
+        self._lock = threading.Lock()
+        self.maxSessions = maxSessions
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+
+    def open(self, session_id: str) -> Session:
+        """
+        打开会话，若不存在则新建
+        :param session_id: str 会话id
+        :return: Session
+        """
+        with self._lock:
+            if session_id not in self._sessions:
+                rows = self.connection.execute(
+                    "SELECT role, content, tokens, tokenizer FROM messages WHERE session_id = ? ORDER BY seq",
+                    (session_id,)
+                ).fetchall()
+                self._sessions[session_id] = Session(session_id, self, [Turn(*row) for row in rows])
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.maxSessions:
+                self._sessions.popitem(last=False)
+            return self._sessions[session_id]
+
+    def close(self, session_id: str) -> None:
+        """
+        将会话移出内存(记录仍保留在数据库中)
+        :param session_id: str 会话id
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def write(self, session_id: str, seq: int, turn: Turn) -> None:
+        """
+        写入(或更新)一条消息
+        """
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, seq, turn.role, turn.content, turn.tokens, turn.tokenizer, time.time())
+            )
+            self.connection.commit()
+
+    def writeMany(self, session_id: str, turns: list[tuple[int, Turn]]) -> None:
+        """
+        在同一事务中写入(或更新)多条消息
+        :param turns: list[tuple[int, Turn]] (序号, 消息)的列表
+        """
+        now = time.time()
+        with self._lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(session_id, seq, turn.role, turn.content, turn.tokens, turn.tokenizer, now) for seq, turn in turns]
+            )
+            self.connection.commit()
+
+    def delete(self, session_id: str) -> None:
+        """
+        删除会话的全部记录
+        """
+        with self._lock:
+            self.connection.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.connection.commit()
+
+    def sessions(self) -> list[str]:
+        """
+        返回全部会话id
+        """
+        with self._lock:
+            return [row[0] for row in self.connection.execute("SELECT DISTINCT session_id FROM messages")]
+
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
@@ -0,0 +1,193 @@
+"""该文件定义了基于检索的长期记忆：为历史对话建立本地向量索引，每次查询只发送最近的若干轮与最相关的若干轮"""
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from modules.conversation import getSessionKey
+from modules.utils import Configs
+
+
+class EmbedderBase:
+    """文本向量化基类，可继承该类以接入其他向量模型(如sentence-transformers或各家的Embedding API)"""
+    dim = 0  # 向量维度
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """
+        将文本转换为向量
+        :param texts: list[str] 文本
+        :return: np.ndarray 形状为(len(texts), dim)的float32矩阵，每行应已归一化(L2范数为1)
+        """
+        raise NotImplementedError
+
+
+class HashingEmbedder(EmbedderBase):
+    """
+    基于字符n-gram特征哈希的向量化方法，无需任何模型，对中文(无需分词)与英文均适用
+
+    每个n-gram经crc32哈希后映射到dim个桶之一，并按哈希值的最高位决定符号，以减小哈希冲突带来的偏差
+    """
+
+    def __init__(self, dim: int = 512, minN: int = 1, maxN: int = 3):
+        """
+        :param dim: int 向量维度
+        :param minN: int n-gram的最小长度
+        :param maxN: int n-gram的最大长度
+        """
+        self.dim = dim
+        self.minN = minN
+        self.maxN = maxN
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = " ".join(text.lower().split())
+            hashes = [
+                zlib.crc32(text[i:i + n].encode("utf-8"))
+                for n in range(self.minN, self.maxN + 1) for i in range(len(text) - n + 1)
+            ]
+            if not hashes:
+                continue
+            hashes = np.array(hashes, dtype=np.uint32)
+            signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+            np.add.at(matrix[row], hashes % self.dim, signs)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+
+class VectorIndex:
+    """按行追加的稠密向量索引，容量不足时倍增，使用内积(向量已归一化，即余弦相似度)进行检索"""
+
+    def __init__(self, dim: int, capacity: int = 64):
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.size = 0
+
+    def add(self, vectors: np.ndarray) -> None:
+        """
+        追加向量
+        :param vectors: np.ndarray 形状为(n, dim)的矩阵
+        """
+        required = self.size + len(vectors)
+        if required > len(self._vectors):
+            grown = np.zeros((max(required, 2 * len(self._vectors)), self._vectors.shape[1]), dtype=np.float32)
+            grown[:self.size] = self._vectors[:self.size]
+            self._vectors = grown
+        self._vectors[self.size:required] = vectors
+        self.size = required
+
+    def search(self, query: np.ndarray, topK: int, limit: int = None, minScore: float = None,
+               start: int = 0) -> list[int]:
+        """
+        检索与query最相似的向量
+        :param query: np.ndarray 形状为(dim,)的查询向量
+        :param topK: int 返回的数量
+        :param limit: int 仅在前limit个向量中检索，为None时检索全部
+        :param minScore: float 最低相似度，低于该值的结果将被丢弃
+        :param start: int 跳过前start个向量
+        :return: list[int] 按相似度降序排列的行号
+        """
+        limit = self.size if limit is None else min(limit, self.size)
+        start = max(start, 0)
+        if topK <= 0 or limit <= start:
+            return []
+        scores = self._vectors[start:limit] @ query
+        if topK < limit - start:
+            candidates = np.argpartition(-scores, topK)[:topK]
+        else:
+            candidates = np.arange(limit - start)
+        candidates = candidates[np.argsort(-scores[candidates])]
+        if minScore is not None:
+            candidates = candidates[scores[candidates] >= minScore]
+        return (candidates + start).tolist()
+
+
+class RetrievalMemory:
+    """
+    检索式记忆：每次查询只保留最近的recentTurns轮对话，并从更早的对话中检索与本次输入最相关的relevantTurns轮
+
+    每个会话维护一个VectorIndex，新增的对话只需增量向量化。会话以Session.session_id区分，
+    对于[[str, str]...]形式的历史记录，则以首轮对话的内容作为会话的标识；开场白相同的不同会话标识相同，
+    因此复用索引前会核对已索引对话的校验值，不一致时重新建立索引
+    """
+
+    def __init__(self, embedder: EmbedderBase = None, recentTurns: int = 4, relevantTurns: int = 3,
+                 minScore: float = None, maxSessions: int = 256):
+        """
+        :param embedder: EmbedderBase 向量化方法，默认为HashingEmbedder
+        :param recentTurns: int 始终保留的最近轮数
+        :param relevantTurns: int 从更早的对话中检索的轮数
+        :param minScore: float 检索结果的最低相似度，为None时不限制
+        :param maxSessions: int 最多缓存索引的会话数(按最近使用淘汰)
+        """
+        self.embedder = embedder if embedder else HashingEmbedder()
+        self.recentTurns = recentTurns
+        self.relevantTurns = relevantTurns
+        self.minScore = minScore
+        self.maxSessions = maxSessions
+        self._indexes: OrderedDict[str, tuple[VectorIndex, int]] = OrderedDict()  # 会话标识: (索引, 已索引对话的校验值)
+
+    @staticmethod
+    def checksum(exchanges: list[tuple[str, str]], value: int = 0) -> int:
+        """
+        :param exchanges: list[tuple[str, str]] 对话(用户输入, 机器人回复)
+        :param value: int 此前对话的校验值，用于增量计算
+        :return: int 全部对话内容的crc32校验值
+        """
+        for user, assistant in exchanges:
+            value = zlib.crc32(f"{user}\0{assistant}\0".encode("utf-8"), value)
+        return value
+
+    def _getIndex(self, key: str, exchanges: list[tuple[str, str]]) -> VectorIndex:
+        index, checksum = self._indexes.get(key, (None, 0))
+        # 新会话、会话被清除后重新开始，或开场白相同的另一会话(内容与已索引的对话不一致)
+        if index is None or index.size > len(exchanges) or self.checksum(exchanges[:index.size]) != checksum:
+            index, checksum = VectorIndex(self.embedder.dim), 0
+        if index.size < len(exchanges):
+            added = exchanges[index.size:]
+            index.add(self.embedder.embed([f"{user}\n{assistant}" for user, assistant in added]))
+            checksum = self.checksum(added, checksum)
+        self._indexes[key] = (index, checksum)
+        self._indexes.move_to_end(key)
+        while len(self._indexes) > self.maxSessions:
+            self._indexes.popitem(last=False)
+        return index
+
+    def select(self, history, exchanges: list[tuple[str, str]], message: str, start: int = 0) -> list[int]:
+        """
+        挑选本次查询需要发送的对话
+        :param history: list[list[str, str]] | Session 原始的历史记录，用于区分会话
+        :param exchanges: list[tuple[str, str]] 全部对话(用户输入, 机器人回复)
+        :param message: str 本次用户输入，用作检索的查询
+        :param start: int 仅从第start轮起挑选(之前的对话已并入摘要)，索引仍按全部对话维护
+        :return: list[int] 按时间顺序排列的对话下标(对应exchanges)
+        """
+        if len(exchanges) - start <= self.recentTurns + self.relevantTurns or not message:
+            return list(range(start, len(exchanges)))
+        older = len(exchanges) - self.recentTurns
+        index = self._getIndex(getSessionKey(history), exchanges)
+        query = self.embedder.embed([message])[0]
+        relevant = index.search(query, self.relevantTurns, limit=older, minScore=self.minScore, start=start)
+        return sorted(relevant) + list(range(older, len(exchanges)))
+
+
+def createMemory(Memory_config: dict) -> RetrievalMemory | None:
+    """
+    根据配置创建RetrievalMemory
+    :param Memory_config: dict 形如{"enabled": bool, "recent_turns": int, "relevant_turns": int, "dim": int,
+    "min_score": float}的配置
+    :return: RetrievalMemory | None 未启用时返回None
+    """
+    if not Memory_config.get("enabled", False):
+        return None
+    return RetrievalMemory(
+        HashingEmbedder(Memory_config.get("dim", 512)),
+        Memory_config.get("recent_turns", 4),
+        Memory_config.get("relevant_turns", 3),
+        Memory_config.get("min_score", None)
+    )
+
+
+retrievalMemory = createMemory(Configs.get("Memory", {}))  # 全局单例，未启用时为None
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
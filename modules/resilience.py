@@ -0,0 +1,438 @@
+"""该文件定义了各后端共用的容错层：对幂等调用进行指数退避重试(受重试预算限制)，并为每个主机维护熔断器"""
+import functools
+import inspect
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+
+from modules.cancellation import getCurrentTurn
+from modules.tracing import getCurrentSpan
+from modules.utils import Configs
+
+
+class CircuitOpenError(ConnectionError):
+    """熔断器处于打开状态时立即抛出，不会向后端发出请求"""
+
+    def __init__(self, key: str, retryAfter: float):
+        super().__init__(f"Circuit for '{key}' is open after repeated failures, retry in {retryAfter:.1f}s.")
+        self.key = key
+        self.retryAfter = retryAfter
+
+
+class CircuitBreaker:
+    """
+    单个主机的熔断器
+
+    连续失败failureThreshold次后打开，resetTimeout秒内的调用均立即失败；此后进入半开状态，
+    最多放行halfOpenProbes个探测请求，探测成功则关闭，失败则重新打开
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, key: str, failureThreshold: int = 5, resetTimeout: float = 30.0, halfOpenProbes: int = 1):
+        """
+        :param key: str 主机名(或后端名称)
+        :param failureThreshold: int 打开熔断器所需的连续失败次数
+        :param resetTimeout: float 打开后进入半开状态前等待的时间(秒)
+        :param halfOpenProbes: int 半开状态下允许同时进行的探测请求数
+        """
+        self.key = key
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.halfOpenProbes = halfOpenProbes
+        self.state = self.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.openedAt = 0.0
+        self.opened = 0  # 打开的总次数
+        self.rejected = 0  # 被立即拒绝的调用数
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        """
+        在发出请求前调用，熔断器打开(或半开且探测名额已满)时抛出CircuitOpenError
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                elapsed = time.monotonic() - self.openedAt
+                if elapsed < self.resetTimeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.key, self.resetTimeout - elapsed)
+                self.state, self._probes = self.HALF_OPEN, 0
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.halfOpenProbes:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.key, 0.0)
+                self._probes += 1
+
+    def success(self) -> None:
+        with self._lock:
+            self.state, self.failures, self._probes = self.CLOSED, 0, 0
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failureThreshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state, self.openedAt, self._probes = self.OPEN, time.monotonic(), 0
+
+    def release(self) -> None:
+        """
+        调用既未成功也未失败(如因参数错误而抛出异常)时归还半开状态下的探测名额
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    @property
+    def available(self) -> bool:
+        """
+        :return: bool 当前是否会放行请求(不占用探测名额)
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self.openedAt >= self.resetTimeout
+            return self.state == self.CLOSED or self._probes < self.halfOpenProbes
+
+    def snapshot(self) -> dict:
+        """
+        :return: dict 当前状态与统计数据
+        """
+        with self._lock:
+            retryAfter = max(self.resetTimeout - (time.monotonic() - self.openedAt), 0.0) \
+                if self.state == self.OPEN else 0.0
+            return {"state": self.state, "failures": self.failures, "opened": self.opened,
+                    "rejected": self.rejected, "retry_after": retryAfter}
+
+
+class RetryBudget:
+    """
+    重试预算：最近window秒内的重试次数不超过 minPerSecond × window + ratio × 请求数，
+    避免后端过载时重试成倍放大请求量
+    """
+
+    def __init__(self, ratio: float = 0.2, minPerSecond: float = 1.0, window: float = 10.0):
+        """
+        :param ratio: float 允许的重试次数与请求次数之比
+        :param minPerSecond: float 请求量很少时，每秒至少允许的重试次数
+        :param window: float 统计窗口(秒)
+        """
+        self.ratio = ratio
+        self.minPerSecond = minPerSecond
+        self.window = window
+        self.exhausted = 0  # 因预算耗尽而放弃的重试次数
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def request(self) -> None:
+        """
+        记录一次(首次)请求
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._requests.append(now)
+
+    def tryRetry(self) -> bool:
+        """
+        尝试取得一次重试的名额
+        :return: bool 是否允许重试
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if len(self._retries) >= self.minPerSecond * self.window + self.ratio * len(self._requests):
+                self.exhausted += 1
+                return False
+            self._retries.append(now)
+            return True
+
+
+class Resilience:
+    """
+    容错层：按主机管理熔断器，并对幂等调用进行带抖动的指数退避重试(全部主机共享同一重试预算)
+
+    只有瞬时故障(连接失败、超时)会被重试并计入熔断器；认证失败(ConnectionRefusedError)、参数错误等直接抛出
+    """
+
+    def __init__(self, maxAttempts: int = 3, baseDelay: float = 0.2, maxDelay: float = 2.0,
+                 retryTimeouts: bool = False, budget: RetryBudget = None, failureThreshold: int = 5,
+                 resetTimeout: float = 30.0, halfOpenProbes: int = 1, enabled: bool = True):
+        """
+        :param maxAttempts: int 单次调用的最大尝试次数(含首次)
+        :param baseDelay: float 首次重试前的最大等待时间(秒)，此后每次翻倍
+        :param maxDelay: float 重试前的最大等待时间(秒)
+        :param retryTimeouts: bool 是否重试超时的调用(超时的代价较高，默认只重试连接失败)
+        :param budget: RetryBudget 重试预算，默认为RetryBudget()
+        :param failureThreshold: int 详见CircuitBreaker
+        :param resetTimeout: float 详见CircuitBreaker
+        :param halfOpenProbes: int 详见CircuitBreaker
+        :param enabled: bool 为False时wrap原样返回后端
+        """
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.retryTimeouts = retryTimeouts
+        self.budget = budget if budget else RetryBudget()
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.halfOpenProbes = halfOpenProbes
+        self.enabled = enabled
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.retries: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, key: str) -> CircuitBreaker:
+        """
+        获取(或创建)指定主机的熔断器
+        :param key: str 主机名(或后端名称)
+        :return: CircuitBreaker
+        """
+        with self._lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(key, self.failureThreshold, self.resetTimeout,
+                                                    self.halfOpenProbes)
+            return self.breakers[key]
+
+    @staticmethod
+    def keyOf(backend) -> str:
+        """
+        :param backend: ASRBase | NLGBase | TTSBase
+        :return: str 后端所连接的主机名，没有host属性的后端(如各家的API)使用后端名称，
+        配置了多个主机的后端使用模型名称(各主机的健康状态由其HostPool负责，重试时将改发其他主机)
+        """
+        pool = getattr(backend, "pool", None)
+        if pool is not None and len(pool.hosts) > 1:
+            return backend.model
+        host = getattr(backend, "host", None)
+        if isinstance(host, str) and host:
+            return urlparse(host).netloc or host
+        return backend.type.name
+
+    def isTransient(self, error: BaseException) -> bool:
+        """
+        :param error: BaseException 调用抛出的异常
+        :return: bool 是否为瞬时故障(计入熔断器)
+        """
+        if isinstance(error, (CircuitOpenError, ConnectionRefusedError)):
+            return False
+        turn = getCurrentTurn()
+        if turn is not None and turn.cancelled:  # 因本轮对话被打断而主动关闭的连接
+            return False
+        return isinstance(error, (ConnectionError, TimeoutError, requests.exceptions.ConnectionError,
+                                  requests.exceptions.Timeout))
+
+    def isRetryable(self, error: BaseException) -> bool:
+        """
+        :param error: BaseException 调用抛出的异常
+        :return: bool 是否应当重试
+        """
+        if isinstance(error, (TimeoutError, requests.exceptions.Timeout)):
+            return self.retryTimeouts
+        return self.isTransient(error)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        :param attempt: int 已失败的次数(从1开始)
+        :return: float 下次重试前的等待时间(秒)，在[0, min(maxDelay, baseDelay × 2^(attempt-1))]中均匀分布
+        """
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1)))
+
+    def call(self, key: str, function, *args, idempotent: bool = True, **kwargs):
+        """
+        经熔断器调用function，幂等调用在瞬时故障时按退避时间重试
+        :param key: str 主机名(或后端名称)
+        :param function: Callable 实际的调用
+        :param idempotent: bool 是否为幂等调用，非幂等调用不重试
+        :return: function的返回值
+        """
+        breaker = self.breaker(key)
+        self.budget.request()
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.allow()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if not self.isTransient(e):
+                    breaker.release()
+                    raise
+                breaker.failure()
+                if not idempotent or not self._prepareRetry(key, breaker, attempt, e):
+                    raise
+                continue
+            breaker.success()
+            return result
+
+    def stream(self, key: str, function, *args, **kwargs):
+        """
+        经熔断器调用流式(生成器)方法，在产生首个片段之前与call相同地重试，已产生的内容无法撤回，此后不再重试
+        :param key: str 主机名(或后端名称)
+        :param function: Callable 返回生成器的调用
+        """
+        breaker = self.breaker(key)
+        self.budget.request()
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.allow()
+            stream, started = function(*args, **kwargs), False
+            try:
+                for chunk in stream:
+                    started = True
+                    yield chunk
+            except GeneratorExit:  # 调用方提前关闭(如被打断)，既未成功也未失败
+                breaker.release()
+                stream.close()
+                raise
+            except Exception as e:
+                if not self.isTransient(e):
+                    breaker.release()
+                    raise
+                breaker.failure()
+                if started or not self._prepareRetry(key, breaker, attempt, e):
+                    raise
+                continue
+            breaker.success()
+            return
+
+    def _prepareRetry(self, key: str, breaker: CircuitBreaker, attempt: int, error: BaseException) -> bool:
+        """
+        判断失败的调用能否重试，可以时记录重试次数并等待退避时间
+        :param key: str 主机名(或后端名称)
+        :param breaker: CircuitBreaker 该主机的熔断器
+        :param attempt: int 已失败的次数(从1开始)
+        :param error: BaseException 调用抛出的瞬时故障
+        :return: bool 是否应当重试
+        """
+        if attempt >= self.maxAttempts or not self.isRetryable(error) or not breaker.available \
+                or not self.budget.tryRetry():
+            return False
+        with self._lock:
+            self.retries[key] = self.retries.get(key, 0) + 1
+        span = getCurrentSpan()
+        if span is not None:
+            span.set("retries", attempt)
+        delay = self.backoff(attempt)
+        retryAfter = getattr(error, "retryAfter", None)  # 推理端过载时建议的重试间隔(详见modules.utils.checkResponse)
+        if retryAfter:
+            delay = max(delay, min(retryAfter, self.maxDelay))
+        time.sleep(delay)
+        return True
+
+    def wrap(self, backend):
+        """
+        为后端添加容错层
+        :param backend: ASRBase | NLGBase | TTSBase
+        :return: ResilientBackend | 原后端(未启用时)
+        """
+        return ResilientBackend(backend, self) if self.enabled else backend
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        :return: dict[str, dict] 各主机熔断器的状态与重试次数，形如{主机: {"state": str, "failures": int, ...}}
+        """
+        with self._lock:
+            breakers, retries = list(self.breakers.items()), dict(self.retries)
+        return {key: {**breaker.snapshot(), "retries": retries.get(key, 0)} for key, breaker in breakers}
+
+    def export(self) -> str:
+        """
+        以Prometheus文本格式导出各主机的熔断器状态与重试次数
+        :return: str
+        """
+        snapshots = self.snapshot()
+        states = (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN)
+        lines = ["# HELP client_circuit_state Circuit breaker state per host (0 closed, 1 half open, 2 open).",
+                 "# TYPE client_circuit_state gauge"]
+        lines += [f'client_circuit_state{{host="{key}"}} {states.index(snapshot["state"])}'
+                  for key, snapshot in snapshots.items()]
+        lines += ["# HELP client_circuit_rejected_total Calls failed fast by an open circuit.",
+                  "# TYPE client_circuit_rejected_total counter"]
+        lines += [f'client_circuit_rejected_total{{host="{key}"}} {snapshot["rejected"]}'
+                  for key, snapshot in snapshots.items()]
+        lines += ["# HELP client_retries_total Retries issued per host.",
+                  "# TYPE client_retries_total counter"]
+        lines += [f'client_retries_total{{host="{key}"}} {snapshot["retries"]}' for key, snapshot in snapshots.items()]
+        lines += ["# HELP client_retry_budget_exhausted_total Retries skipped because the budget was spent.",
+                  "# TYPE client_retry_budget_exhausted_total counter",
+                  f"client_retry_budget_exhausted_total {self.budget.exhausted}"]
+        return "\n".join(lines) + "\n"
+
+
+class ResilientBackend:
+    """
+    对ASRBase、NLGBase与TTSBase的透明包装，主要调用均经过Resilience(其余属性直接转发至被包装的后端)
+
+    流式方法仅在产生首个片段之前重试；其余方法均视为幂等并在瞬时故障时重试
+    """
+    resilientMethods = {
+        "transcribe", "synthesize", "singleQuery", "continuedQuery", "streamSingleQuery", "streamContinuedQuery",
+        "checkConnection"
+    }
+
+    def __init__(self, backend, resilience: Resilience):
+        self._backend = backend
+        self._resilience = resilience
+
+    def __getattr__(self, name: str):
+        if name in ("_backend", "_resilience"):
+            raise AttributeError(name)
+        attribute = getattr(self._backend, name)
+        if name not in self.resilientMethods or not callable(attribute):
+            return attribute
+        key = self._resilience.keyOf(self._backend)
+        if inspect.isgeneratorfunction(attribute):  # 返回真正的生成器函数，外层(如TracedBackend)才能识别为流式方法
+            @functools.wraps(attribute)
+            def resilientStream(*args, **kwargs):
+                yield from self._resilience.stream(key, attribute, *args, **kwargs)
+
+            return resilientStream
+
+        @functools.wraps(attribute)
+        def resilientCall(*args, **kwargs):
+            return self._resilience.call(key, attribute, *args, **kwargs)
+
+        return resilientCall
+
+    def __dir__(self):
+        return sorted(set(dir(self._backend)) | set(super().__dir__()))
+
+
+def createResilience(Resilience_config: dict) -> Resilience:
+    """
+    根据配置创建Resilience
+    :param Resilience_config: dict 形如{"enabled": bool, "max_attempts": int, "base_delay": float, "max_delay": float,
+    "retry_timeouts": bool, "budget_ratio": float, "budget_min_per_second": float, "failure_threshold": int,
+    "reset_timeout": float, "half_open_probes": int}的配置
+    :return: Resilience 未启用时wrap原样返回后端
+    """
+    return Resilience(
+        maxAttempts=Resilience_config.get("max_attempts", 3),
+        baseDelay=Resilience_config.get("base_delay", 0.2),
+        maxDelay=Resilience_config.get("max_delay", 2.0),
+        retryTimeouts=Resilience_config.get("retry_timeouts", False),
+        budget=RetryBudget(Resilience_config.get("budget_ratio", 0.2),
+                           Resilience_config.get("budget_min_per_second", 1.0)),
+        failureThreshold=Resilience_config.get("failure_threshold", 5),
+        resetTimeout=Resilience_config.get("reset_timeout", 30.0),
+        halfOpenProbes=Resilience_config.get("half_open_probes", 1),
+        enabled=Resilience_config.get("enabled", True)
+    )
+
+
+resilience = createResilience(Configs.get("Resilience", {}))  # 全局单例
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
@@ -0,0 +1,234 @@
+"""该文件定义了自适应超时：根据各后端近期的实际耗时(按输入规模归一)推算超时时间，并在重启后保留所学到的结果"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import requests
+
+from modules.tracing import getCurrentSpan
+from modules.utils import Configs
+
+
+class TimeoutPolicy:
+    """
+    单个调用(如"Waltz/continuedQuery")的超时策略
+
+    以近期window次调用的(输入规模, 耗时)拟合 耗时 ≈ a + b × 规模，超时时间取
+    multiplier × (a + b × 规模 + 残差的percentile分位数)，并限制在[floor, cap]之间；样本不足minSamples时使用默认值。
+    超时的调用按超时时间计入样本(实际耗时至少为该值)，因此连续超时会使超时时间逐步放宽，直至cap
+    """
+
+    def __init__(self, name: str, default: float, perUnit: float = 0.0, floor: float = 1.0, cap: float = 120.0,
+                 unit: str = "request", samples: list = None, percentile: float = 99, multiplier: float = 1.5,
+                 minSamples: int = 10, window: int = 200, enabled: bool = True):
+        """
+        :param name: str 名称
+        :param default: float 样本不足时的固定超时(秒)
+        :param perUnit: float 样本不足时每单位输入追加的超时(秒)
+        :param floor: float 超时时间下限(秒)
+        :param cap: float 超时时间上限(秒)
+        :param unit: str 输入规模的单位，如"char"、"audio_second"
+        :param samples: list 已有的样本[[规模, 耗时]...]
+        :param percentile: float 残差的分位数
+        :param multiplier: float 安全系数
+        :param minSamples: int 开始使用拟合结果所需的最少样本数
+        :param window: int 保留的最近样本数
+        :param enabled: bool 为False时始终使用默认值(仍会记录样本)
+        """
+        self.name = name
+        self.default = default
+        self.perUnit = perUnit
+        self.floor = floor
+        self.cap = cap
+        self.unit = unit
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.minSamples = minSamples
+        self.enabled = enabled
+        self.samples = deque(samples if samples else [], maxlen=window)
+        self.timeouts = 0  # 发生超时的次数
+        self._fit = None  # (a, b, 残差分位数)，样本变化后重新计算
+        self._lock = threading.Lock()
+
+    def _getFit(self) -> tuple[float, float, float] | None:
+        if self._fit is None and len(self.samples) >= self.minSamples:
+            data = np.array(self.samples, dtype=np.float64)
+            sizes, seconds = data[:, 0], data[:, 1]
+            if np.ptp(sizes) > 0:
+                b, a = np.polyfit(sizes, seconds, 1)
+                b = max(float(b), 0.0)
+                a = max(float(np.mean(seconds - b * sizes)), 0.0)
+            else:  # 输入规模均相同(或不区分规模)时，只估计固定耗时
+                a, b = float(np.mean(seconds)), 0.0
+            residual = float(np.percentile(seconds - (a + b * sizes), self.percentile))
+            self._fit = (a, b, max(residual, 0.0))
+        return self._fit
+
+    def timeout(self, size: float = 0) -> float:
+        """
+        计算超时时间
+        :param size: float 本次的输入规模
+        :return: float 超时时间(秒)
+        """
+        with self._lock:
+            fit = self._getFit() if self.enabled else None
+        if fit is None:
+            value = self.default + self.perUnit * size
+        else:
+            a, b, residual = fit
+            value = self.multiplier * (a + b * size + residual)
+        return min(max(value, self.floor), self.cap)
+
+    def observe(self, size: float, seconds: float) -> None:
+        """
+        记录一次调用的耗时
+        :param size: float 输入规模
+        :param seconds: float 耗时(秒)
+        """
+        with self._lock:
+            self.samples.append([float(size), float(seconds)])
+            self._fit = None
+
+    @contextmanager
+    def measure(self, size: float = 0):
+        """
+        计算超时时间并记录本次调用的耗时，用法：
+            with policy.measure(len(text)) as timeout:
+                requests.post(..., timeout=timeout)
+        :param size: float 本次的输入规模
+        """
+        timeout = self.timeout(size)
+        span = getCurrentSpan()
+        if span is not None:
+            span.set("timeout_s", round(timeout, 3))
+        start = time.perf_counter()
+        try:
+            yield timeout
+        except (requests.exceptions.Timeout, TimeoutError):
+            self.timeouts += 1
+            self.observe(size, timeout)
+            raise
+        self.observe(size, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        """
+        :return: dict 当前的拟合结果与统计数据
+        """
+        with self._lock:
+            fit = self._getFit()
+            count = len(self.samples)
+        return {
+            "unit": self.unit, "samples": count, "timeouts": self.timeouts,
+            "base_seconds": fit[0] if fit else None, "seconds_per_unit": fit[1] if fit else None,
+            "residual_seconds": fit[2] if fit else None, "floor": self.floor, "cap": self.cap
+        }
+
+
+class AdaptiveTimeouts:
+    """自适应超时策略的注册表，样本定期写入path，并在程序退出时写回"""
+
+    def __init__(self, path: str = "timeouts.json", saveEvery: float = 60.0, **defaults):
+        """
+        :param path: str 样本的保存路径，为空时不保存
+        :param saveEvery: float 两次保存之间的最短间隔(秒)
+        :param defaults: 传递给每个TimeoutPolicy的默认参数(percentile、multiplier、minSamples、window、enabled)
+        """
+        self.path = path
+        self.saveEvery = saveEvery
+        self.defaults = defaults
+        self.policies: dict[str, TimeoutPolicy] = {}
+        self._stored = {}
+        self._lastSave = time.time()
+        self._lock = threading.Lock()
+        if path and os.path.isfile(path):
+            try:
+                with open(path, encoding="utf-8") as file:
+                    self._stored = json.load(file)
+            except (OSError, ValueError):
+                self._stored = {}
+        if path:
+            atexit.register(self.save)
+
+    def get(self, name: str, default: float, perUnit: float = 0.0, floor: float = 1.0, cap: float = 120.0,
+            unit: str = "request") -> TimeoutPolicy:
+        """
+        获取(或创建)超时策略，参数详见TimeoutPolicy
+        :return: TimeoutPolicy
+        """
+        with self._lock:
+            if name not in self.policies:
+                self.policies[name] = TimeoutPolicy(name, default, perUnit, floor, cap, unit,
+                                                    self._stored.get(name), **self.defaults)
+            policy = self.policies[name]
+        if self.path and time.time() - self._lastSave > self.saveEvery:
+            self.save()
+        return policy
+
+    def save(self) -> None:
+        """
+        将全部样本写入文件
+        """
+        with self._lock:
+            self._lastSave = time.time()
+            data = {**self._stored, **{name: list(policy.samples) for name, policy in self.policies.items()}}
+        try:
+            with open(self.path, "w", encoding="utf-8") as file:
+                json.dump(data, file)
+        except OSError as e:
+            print(f"Failed to save learned timeouts: {e}")
+
+    def export(self) -> str:
+        """
+        以Prometheus文本格式导出各策略的状态
+        :return: str
+        """
+        lines = [
+            "# HELP client_timeout_seconds Current adaptive timeout for a zero-size input.",
+            "# TYPE client_timeout_seconds gauge",
+        ]
+        snapshots = {name: (policy, policy.snapshot()) for name, policy in list(self.policies.items())}
+        for name, (policy, _) in snapshots.items():
+            lines.append(f'client_timeout_seconds{{call="{name}"}} {policy.timeout(0):.3f}')
+        lines += ["# HELP client_latency_seconds_per_unit Learned latency per unit of input.",
+                  "# TYPE client_latency_seconds_per_unit gauge"]
+        for name, (_, snapshot) in snapshots.items():
+            if snapshot["seconds_per_unit"] is not None:
+                lines.append(f'client_latency_seconds_per_unit{{call="{name}",unit="{snapshot["unit"]}"}} '
+                             f'{snapshot["seconds_per_unit"]:.6f}')
+        lines += ["# HELP client_latency_samples Latency samples kept for fitting.",
+                  "# TYPE client_latency_samples gauge"]
+        lines += [f'client_latency_samples{{call="{name}"}} {snapshot["samples"]}'
+                  for name, (_, snapshot) in snapshots.items()]
+        lines += ["# HELP client_timeouts_total Calls that hit their timeout since start.",
+                  "# TYPE client_timeouts_total counter"]
+        lines += [f'client_timeouts_total{{call="{name}"}} {snapshot["timeouts"]}'
+                  for name, (_, snapshot) in snapshots.items()]
+        return "\n".join(lines) + "\n"
+
+
+def createAdaptiveTimeouts(Timeouts_config: dict) -> AdaptiveTimeouts:
+    """
+    根据配置创建AdaptiveTimeouts
+    :param Timeouts_config: dict 形如{"enabled": bool, "path": str, "percentile": float, "multiplier": float,
+    "min_samples": int, "window": int}的配置
+    :return: AdaptiveTimeouts 未启用时各策略始终使用默认值
+    """
+    return AdaptiveTimeouts(
+        Timeouts_config.get("path", "timeouts.json"),
+        enabled=Timeouts_config.get("enabled", True),
+        percentile=Timeouts_config.get("percentile", 99),
+        multiplier=Timeouts_config.get("multiplier", 1.5),
+        minSamples=Timeouts_config.get("min_samples", 10),
+        window=Timeouts_config.get("window", 200)
+    )
+
+
+adaptiveTimeouts = createAdaptiveTimeouts(Configs.get("Timeouts", {}))  # 全局单例
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
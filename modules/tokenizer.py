@@ -0,0 +1,153 @@
+"""该文件定义了按NLG后端与模型区分的分词器注册表，用于更准确地估算各家API的token数"""
+import os
+import re
+from functools import lru_cache
+
+from modules.utils import NLGEnum, Configs
+
+_wordPattern = re.compile(r"[^ ,.?!';:()\[\]{}\t\n]+")  # 估算token数时使用的分词规则
+_piecePattern = re.compile(r"([\u4e00-\u9fff])|[^ ,.?!';:()\[\]{}\t\n\u4e00-\u9fff]+")  # 单个汉字或连续的非汉字片段
+
+
+def estimateTokens(content: str, token_per_zh_char: float = 1.33, token_per_en_word: float = 1.2) -> float:
+    """
+    根据经验比例估算文本的token数
+
+    按分隔符分词后，对每个词而言：汉字数为C、被汉字隔开的非汉字片段数为R时，该词计为(C + 1 - R)个汉字与R个英文单词，
+    纯英文的词(C=0, R=1)恰好计为1个英文单词。因此只需统计全文的词数W、汉字数与非汉字片段数，无需逐词切分
+    :param content: str 文本
+    :param token_per_zh_char: float 每个中文字符的token数
+    :param token_per_en_word: float 每个英文单词的token数
+    :return: float 估算的token数(未取整)
+    """
+    word_num = len(_wordPattern.findall(content))
+    pieces = _piecePattern.findall(content)  # 汉字匹配为其自身，非汉字片段匹配为空字符串
+    en_piece_num = pieces.count("")
+    zh_char_num = len(pieces) - en_piece_num
+    return (zh_char_num + word_num - en_piece_num) * token_per_zh_char + en_piece_num * token_per_en_word
+
+
+class TokenizerBase:
+    """分词器基类，count()的结果按字符串缓存(LRU)，重复出现的历史消息无需重新计算"""
+    name = "base"
+
+    def __init__(self, cacheSize: int = 4096):
+        self.count = lru_cache(maxsize=cacheSize)(self._count)
+
+    def _count(self, text: str) -> int:
+        """
+        计算文本的token数，具体实现详见子类
+        :param text: str 文本
+        :return: int token数
+        """
+        raise NotImplementedError
+
+
+class EstimatorTokenizer(TokenizerBase):
+    """按照各家文档给出的汉字/单词与token的比例进行估算的分词器"""
+
+    def __init__(self, token_per_zh_char: float = 1.33, token_per_en_word: float = 1.2, cacheSize: int = 4096):
+        super().__init__(cacheSize)
+        self.token_per_zh_char = token_per_zh_char
+        self.token_per_en_word = token_per_en_word
+        self.name = f"estimator({token_per_zh_char}/zh, {token_per_en_word}/en)"
+
+    def _count(self, text: str) -> int:
+        return int(estimateTokens(text, self.token_per_zh_char, self.token_per_en_word) + 0.5)
+
+
+class TiktokenTokenizer(TokenizerBase):
+    """基于tiktoken的分词器，适用于OpenAI的模型"""
+
+    def __init__(self, encoding: str = "cl100k_base", cacheSize: int = 4096):
+        import tiktoken
+        super().__init__(cacheSize)
+        self.encoding = tiktoken.get_encoding(encoding)
+        self.name = f"tiktoken({encoding})"
+
+    def _count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+class HuggingFaceTokenizer(TokenizerBase):
+    """加载本地tokenizer.json(HuggingFace tokenizers格式)的分词器，适用于ChatGLM、Qwen等开源模型"""
+
+    def __init__(self, path: str, cacheSize: int = 4096):
+        from tokenizers import Tokenizer
+        super().__init__(cacheSize)
+        self.tokenizer = Tokenizer.from_file(path)
+        self.name = f"huggingface({os.path.basename(os.path.dirname(path)) or path})"
+
+    def _count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+class TokenizerRegistry:
+    """
+    分词器注册表，按(NLGEnum, 模型名)查找分词器，查找顺序为：
+        1. 通过register()显式注册的分词器；
+        2. config.json中"Tokenizers"一节配置的本地tokenizer.json(键为"NLGEnum名称"或"NLGEnum名称/模型名")；
+        3. 该后端的默认分词器(OpenAI系列使用tiktoken)；
+        4. 按该后端的经验比例校准的估算器。
+    分词器在首次使用时才会加载，加载失败时退回到估算器
+    """
+    # 各家文档给出的经验比例(每个汉字的token数, 每个英文单词的token数)
+    calibration: dict[NLGEnum, tuple[float, float]] = {
+        NLGEnum.ChatGPT: (1.0, 1.3),  # cl100k_base中常用汉字多为1个token
+        NLGEnum.ERNIE_Bot: (1.0, 1.3),  # 千帆文档：token数≈汉字数+单词数×1.3
+        NLGEnum.Qwen: (0.65, 1.3),  # 通义千问文档：1个token约对应1.5~1.8个汉字
+        NLGEnum.ChatGLM: (0.6, 1.3),  # 智谱文档：1个token约对应1.6~1.8个汉字
+        NLGEnum.Spark: (0.67, 1.3),  # 星火文档：1个token约等于1.5个汉字
+        NLGEnum.Gemini: (1.0, 1.3),
+        NLGEnum.Waltz: (0.6, 1.3),  # Waltz基于ChatGLM3微调，与ChatGLM一致
+    }
+    defaultCalibration = (1.33, 1.2)  # 与NLGBase.lenOfTokens的默认值保持一致
+
+    def __init__(self, paths: dict[str, str] = None):
+        """
+        :param paths: dict[str, str] 本地分词器文件路径，键为"NLGEnum名称"或"NLGEnum名称/模型名"
+        """
+        self.paths = paths if paths is not None else Configs.get("Tokenizers", {})
+        self._factories = {}  # {(NLGEnum, model | None): Callable[[], TokenizerBase]}
+        self._tokenizers = {}  # {(NLGEnum, model): TokenizerBase}
+
+    def register(self, nlg_type: NLGEnum, factory, model: str = None) -> None:
+        """
+        注册分词器
+        :param nlg_type: NLGEnum 后端类型
+        :param factory: Callable[[], TokenizerBase] 创建分词器的函数，在首次使用时调用
+        :param model: str 模型名，为None时对该后端的全部模型生效
+        """
+        self._factories[(nlg_type, model)] = factory
+        self._tokenizers = {key: value for key, value in self._tokenizers.items() if key[0] != nlg_type}
+
+    def _createDefault(self, nlg_type: NLGEnum, model: str) -> TokenizerBase:
+        path = self.paths.get(f"{nlg_type.name}/{model}") or self.paths.get(nlg_type.name)
+        if path and os.path.isfile(path):
+            return HuggingFaceTokenizer(path)
+        if nlg_type == NLGEnum.ChatGPT:
+            return TiktokenTokenizer("o200k_base" if model and model.startswith(("gpt-4o", "o1")) else "cl100k_base")
+        raise LookupError(f"No tokenizer file configured for {nlg_type.name}/{model}")
+
+    def get(self, nlg_type: NLGEnum, model: str = None) -> TokenizerBase:
+        """
+        获取分词器，结果会被缓存
+        :param nlg_type: NLGEnum 后端类型
+        :param model: str 模型名
+        :return: TokenizerBase
+        """
+        key = (nlg_type, model)
+        if key not in self._tokenizers:
+            factory = self._factories.get(key) or self._factories.get((nlg_type, None))
+            try:
+                tokenizer = factory() if factory else self._createDefault(nlg_type, model)
+            except Exception:  # 缺少依赖、文件损坏或无法下载编码表时，均退回到估算器
+                tokenizer = EstimatorTokenizer(*self.calibration.get(nlg_type, self.defaultCalibration))
+            self._tokenizers[key] = tokenizer
+        return self._tokenizers[key]
+
+
+tokenizerRegistry = TokenizerRegistry()  # 全局单例
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
@@ -0,0 +1,282 @@
+"""该文件定义了一个轻量的链路追踪层，用于记录语音对话流程中各阶段(ASR、NLG、TTS、播放)的耗时与载荷大小"""
+import atexit
+import inspect
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Literal
+
+import requests
+
+_currentSpan: ContextVar["Span"] = ContextVar("currentSpan", default=None)
+
+
+class Span:
+    """一段被追踪的操作，trace_id在同一轮对话内相同，同时作为发往APIWrapper推理端的请求id"""
+    __slots__ = ("traceId", "spanId", "parentId", "name", "sampled", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, traceId: str, parentId: str = None, sampled: bool = True, attributes: dict = None):
+        self.traceId = traceId
+        self.spanId = os.urandom(8).hex()
+        self.parentId = parentId
+        self.name = name
+        self.sampled = sampled
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes if attributes else {}
+        self.error = None
+
+    def set(self, key: str, value) -> None:
+        """
+        设置一个属性
+        :param key: str 属性名
+        :param value: str | int | float | bool 属性值
+        """
+        self.attributes[key] = value
+
+    def toDict(self) -> dict:
+        """
+        转换为可JSON序列化的dict
+        :return: dict
+        """
+        return {
+            "trace_id": self.traceId, "span_id": self.spanId, "parent_id": self.parentId, "name": self.name,
+            "start": self.start, "end": self.end, "duration_ms": (self.end - self.start) / 1e6,
+            "attributes": self.attributes, "error": self.error
+        }
+
+
+class FileExporter:
+    """将span以JSON Lines的形式追加写入本地文件"""
+
+    def __init__(self, path: str = "traces.jsonl"):
+        self.path = path
+
+    def export(self, spans: list[Span]) -> None:
+        with open(self.path, "a", encoding="utf-8") as file:
+            for span in spans:
+                file.write(json.dumps(span.toDict(), ensure_ascii=False) + "\n")
+
+
+class OTLPExporter:
+    """以OTLP/HTTP JSON格式将span发送至兼容OTLP的收集器(如OpenTelemetry Collector或其替身)"""
+
+    def __init__(self, endpoint: str = "http://127.0.0.1:4318/v1/traces", serviceName: str = "chatbot-client"):
+        self.endpoint = endpoint
+        self.serviceName = serviceName
+
+    @staticmethod
+    def _attribute(key: str, value) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def export(self, spans: list[Span]) -> None:
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [self._attribute("service.name", self.serviceName)]},
+            "scopeSpans": [{"scope": {"name": "modules.tracing"}, "spans": [{
+                "traceId": span.traceId,
+                "spanId": span.spanId,
+                "parentSpanId": span.parentId or "",
+                "name": span.name,
+                "kind": 3 if span.name.startswith(("asr.", "nlg.", "tts.")) else 1,  # CLIENT / INTERNAL
+                "startTimeUnixNano": str(span.start),
+                "endTimeUnixNano": str(span.end),
+                "attributes": [self._attribute(key, value) for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+            } for span in spans]}]
+        }]}
+        requests.post(self.endpoint, json=payload, timeout=5)
+
+
+class Tracer:
+    """
+    链路追踪器：由trace()开启一轮对话的根span并决定是否采样，span()记录其中的各个阶段
+
+    已结束的span会被放入队列，由后台线程批量导出，不阻塞对话流程
+    """
+
+    def __init__(self, exporter=None, sampleRate: float = 1.0, flushInterval: float = 2.0, maxBatch: int = 256):
+        """
+        :param exporter: FileExporter | OTLPExporter | None 导出器，为None时不导出(仍会传播请求id)
+        :param sampleRate: float 采样率，取值0~1，未被采样的对话不记录任何span
+        :param flushInterval: float 后台线程的导出间隔(秒)
+        :param maxBatch: int 单次导出的最大span数
+        """
+        self.exporter = exporter
+        self.sampleRate = sampleRate
+        self.flushInterval = flushInterval
+        self.maxBatch = maxBatch
+        self._queue = queue.Queue()
+        if exporter:
+            threading.Thread(target=self._exportLoop, daemon=True).start()
+            atexit.register(self.flush)
+
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        """
+        开启一轮新的追踪(根span)，并按采样率决定是否记录
+        :param name: str 名称，如"voice_turn"
+        :param attributes: 附加属性
+        """
+        span = Span(name, os.urandom(16).hex(), sampled=random.random() < self.sampleRate, attributes=attributes)
+        with self._activate(span) as active:
+            yield active
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        在当前追踪下开启一个子span，若当前不在任何追踪中，则自动开启一轮新的追踪
+        :param name: str 名称，如"nlg.continuedQuery"
+        :param attributes: 附加属性
+        """
+        parent = _currentSpan.get()
+        if parent is None:
+            with self.trace(name, **attributes) as span:
+                yield span
+            return
+        span = Span(name, parent.traceId, parent.spanId, parent.sampled, attributes)
+        with self._activate(span) as active:
+            yield active
+
+    @contextmanager
+    def _activate(self, span: Span):
+        token = _currentSpan.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _currentSpan.reset(token)
+            span.end = time.time_ns()
+            if span.sampled and self.exporter:
+                self._queue.put(span)
+
+    def _exportLoop(self):
+        while True:
+            time.sleep(self.flushInterval)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        立即导出队列中的全部span，导出失败时丢弃该批次，避免影响对话流程
+        """
+        while not self._queue.empty():
+            batch = []
+            while len(batch) < self.maxBatch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                self.exporter.export(batch)
+            except Exception as e:
+                print(f"Failed to export {len(batch)} spans: {e}")
+
+
+def getCurrentSpan() -> Span | None:
+    """
+    获取当前的span，用于在后端内部补充属性(如超时时间)，不在追踪中时返回None
+    :return: Span | None
+    """
+    return _currentSpan.get()
+
+
+def getTraceHeaders() -> dict[str, str]:
+    """
+    生成用于向APIWrapper推理端传播请求id的请求头(X-Request-Id与W3C traceparent)，不在追踪中时返回空dict
+    :return: dict[str, str]
+    """
+    span = _currentSpan.get()
+    if span is None:
+        return {}
+    return {
+        "X-Request-Id": span.traceId,
+        "traceparent": f"00-{span.traceId}-{span.spanId}-{'01' if span.sampled else '00'}"
+    }
+
+
+def _payloadSize(value) -> int:
+    """估算载荷大小：文本计字符数，文件路径计字节数，历史记录计内容总字符数"""
+    if isinstance(value, str):
+        return os.path.getsize(value) if os.path.isfile(value) else len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_payloadSize(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_payloadSize(item) for item in value.values())
+    return 0
+
+
+class TracedBackend:
+    """
+    对ASRBase、NLGBase与TTSBase的透明包装，自动为主要调用记录span(含后端类型、模型与输入/输出大小)
+
+    其余属性(如type、model)均直接转发至被包装的后端
+    """
+    tracedMethods = {
+        "transcribe", "synthesize", "singleQuery", "continuedQuery", "streamSingleQuery", "streamContinuedQuery"
+    }
+
+    def __init__(self, backend, tracer: Tracer, stage: Literal["asr", "nlg", "tts"]):
+        self._backend = backend
+        self._tracer = tracer
+        self._stage = stage
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._backend, name)
+        if name not in self.tracedMethods or not callable(attribute):
+            return attribute
+        spanName = f"{self._stage}.{name}"
+        attributes = {"backend": self._backend.type.name, "model": self._backend.model}
+
+        if inspect.isgeneratorfunction(attribute):
+            def tracedStream(*args, **kwargs):
+                with self._tracer.span(spanName, **attributes, input_size=_payloadSize(args)) as span:
+                    outputSize, firstChunk = 0, None
+                    for chunk in attribute(*args, **kwargs):
+                        if firstChunk is None:
+                            firstChunk = (time.time_ns() - span.start) / 1e6
+                            span.set("first_chunk_ms", firstChunk)
+                        outputSize += len(chunk) if chunk else 0
+                        yield chunk
+                    span.set("output_size", outputSize)
+
+            return tracedStream
+
+        def traced(*args, **kwargs):
+            with self._tracer.span(spanName, **attributes, input_size=_payloadSize(args)) as span:
+                result = attribute(*args, **kwargs)
+                span.set("output_size", _payloadSize(result))
+                return result
+
+        return traced
+
+    def __dir__(self):
+        return sorted(set(dir(self._backend)) | set(super().__dir__()))
+
+
+def createTracer(Tracing_config: dict) -> Tracer:
+    """
+    根据配置创建Tracer
+    :param Tracing_config: dict 形如{"enabled": bool, "sample_rate": float, "exporter": "file" | "otlp", "path": str,
+    "endpoint": str}的配置
+    :return: Tracer 未启用时返回不导出任何span的Tracer(仍会传播请求id)
+    """
+    if not Tracing_config.get("enabled", False):
+        return Tracer()
+    if Tracing_config.get("exporter", "file") == "otlp":
+        exporter = OTLPExporter(Tracing_config.get("endpoint", "http://127.0.0.1:4318/v1/traces"))
+    else:
+        exporter = FileExporter(Tracing_config.get("path", "traces.jsonl"))
+    return Tracer(exporter, Tracing_config.get("sample_rate", 1.0))
+
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
@@ -0,0 +1,234 @@
+"""该文件定义了NLG调用的用量记账：记录每次查询的token数、耗时与估算费用，在内存中汇总并定期写入SQLite"""
+import atexit
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from modules.utils import Configs
+
+_usageScope = contextvars.ContextVar("usage_scope", default=(None, None))  # (会话id, 用户)
+
+
+@contextmanager
+def usageScope(session: str = None, user: str = None):
+    """
+    指定此范围内的查询所属的会话与用户，用法：
+        with usageScope(request.session_hash, request.username):
+            nlg_service.continuedQuery(...)
+    :param session: str 会话id
+    :param user: str 用户名
+    """
+    token = _usageScope.set((session, user))
+    try:
+        yield
+    finally:
+        _usageScope.reset(token)
+
+
+class UsageRecord:
+    """单次查询的用量"""
+    __slots__ = ("timestamp", "backend", "model", "session", "user", "promptTokens", "completionTokens", "latency",
+                 "firstToken", "cost", "estimated")
+
+    def __init__(self, backend: str, model: str, promptTokens: int, completionTokens: int, latency: float,
+                 firstToken: float = None, cost: float = 0.0, estimated: bool = False, session: str = None,
+                 user: str = None):
+        self.timestamp = time.time()
+        self.backend = backend
+        self.model = model
+        self.session = session
+        self.user = user
+        self.promptTokens = promptTokens
+        self.completionTokens = completionTokens
+        self.latency = latency
+        self.firstToken = firstToken  # 流式查询的首个片段耗时(秒)，非流式查询为None
+        self.cost = cost
+        self.estimated = estimated  # token数是否为本地估算(服务商未返回用量)
+
+    def toRow(self) -> tuple:
+        return (self.timestamp, self.backend, self.model, self.session, self.user, self.promptTokens,
+                self.completionTokens, self.latency, self.firstToken, self.cost, int(self.estimated))
+
+
+class UsageLedger:
+    """
+    用量账本
+
+    record()只在内存中追加记录并更新按(后端, 模型)的累计值，由后台线程每flushInterval秒批量写入SQLite(程序退出时也会写入)；
+    query()在写入未落盘的记录后，按后端、模型、会话、用户与时间范围进行汇总
+    """
+    columns = ("backend", "model", "session", "user")  # 允许筛选与分组的列
+
+    def __init__(self, path: str = "usage.db", flushInterval: float = 30.0, prices: dict[str, dict] = None,
+                 currency: str = "CNY"):
+        """
+        :param path: str 数据库文件路径，为":memory:"时不落盘
+        :param flushInterval: float 写入间隔(秒)
+        :param prices: dict[str, dict] 各模型每千token的单价，形如{模型: {"prompt": float, "completion": float}}
+        :param currency: str 单价的货币单位(仅用于展示)
+        """
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.prices = prices if prices else {}
+        self.currency = currency
+        self.flushInterval = flushInterval
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "timestamp REAL NOT NULL, backend TEXT NOT NULL, model TEXT NOT NULL, session TEXT, user TEXT, "
+            "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, latency REAL NOT NULL, "
+            "first_token REAL, cost REAL NOT NULL, estimated INTEGER NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS usage_timestamp ON usage (timestamp)")
+        self.connection.commit()
+        self.totals: dict[tuple[str, str], dict] = {}  # (后端, 模型): 自启动以来的累计值
+        self._pending: list[UsageRecord] = []
+        self._lock = threading.Lock()
+        self._dbLock = threading.Lock()
+        threading.Thread(target=self._flushLoop, name="usage-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def cost(self, model: str, promptTokens: int, completionTokens: int) -> float:
+        """
+        :return: float 按prices估算的费用，未配置单价的模型为0
+        """
+        price = self.prices.get(model)
+        if not price:
+            return 0.0
+        return (promptTokens * price.get("prompt", 0) + completionTokens * price.get("completion", 0)) / 1000
+
+    def record(self, backend: str, model: str, promptTokens: int, completionTokens: int, latency: float,
+               firstToken: float = None, estimated: bool = False, session: str = None) -> UsageRecord:
+        """
+        记录一次查询的用量，会话与用户默认取自usageScope
+        :param backend: str 后端名称(NLGEnum中的名称)
+        :param model: str 模型名称
+        :param promptTokens: int 输入的token数
+        :param completionTokens: int 输出的token数
+        :param latency: float 耗时(秒)
+        :param firstToken: float 流式查询的首个片段耗时(秒)
+        :param estimated: bool token数是否为本地估算
+        :param session: str 会话标识，usageScope未指定会话时使用
+        :return: UsageRecord
+        """
+        scopeSession, user = _usageScope.get()
+        record = UsageRecord(backend, model, promptTokens, completionTokens, latency, firstToken,
+                             self.cost(model, promptTokens, completionTokens), estimated, scopeSession or session, user)
+        with self._lock:
+            self._pending.append(record)
+            total = self.totals.setdefault((backend, model), {
+                "requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "latency": 0.0,
+                "estimated": 0
+            })
+            total["requests"] += 1
+            total["prompt_tokens"] += promptTokens
+            total["completion_tokens"] += completionTokens
+            total["cost"] += record.cost
+            total["latency"] += latency
+            total["estimated"] += estimated
+        return record
+
+    def _flushLoop(self):
+        while True:
+            time.sleep(self.flushInterval)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        将内存中的记录写入数据库
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self._dbLock:
+            self.connection.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [record.toRow() for record in pending])
+            self.connection.commit()
+
+    def query(self, backend: str = None, model: str = None, session: str = None, user: str = None,
+              since: float = None, until: float = None, groupBy: tuple[str, ...] = ("backend", "model")) -> list[dict]:
+        """
+        汇总用量
+        :param backend: str 只统计该后端
+        :param model: str 只统计该模型
+        :param session: str 只统计该会话
+        :param user: str 只统计该用户
+        :param since: float 起始时间(Unix时间戳，含)
+        :param until: float 结束时间(Unix时间戳，不含)
+        :param groupBy: tuple[str, ...] 分组的列，取值见UsageLedger.columns，为空时汇总为一行
+        :return: list[dict] 每组一个dict，含分组列与requests、prompt_tokens、completion_tokens、cost、avg_latency、
+        avg_first_token、estimated(估算token数的查询数)
+        """
+        unknown = set(groupBy) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Unsupported usage group: {unknown}, currently only support {self.columns}")
+        conditions, params = [], []
+        for column, value in zip(self.columns, (backend, model, session, user)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(until)
+        groups = ", ".join(groupBy)
+        sql = (f"SELECT {groups + ', ' if groups else ''}COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), "
+               f"SUM(cost), AVG(latency), AVG(first_token), SUM(estimated) FROM usage"
+               + (f" WHERE {' AND '.join(conditions)}" if conditions else "")
+               + (f" GROUP BY {groups} ORDER BY SUM(cost) DESC, COUNT(*) DESC" if groups else ""))
+        self.flush()
+        with self._dbLock:
+            rows = self.connection.execute(sql, params).fetchall()
+        fields = (*groupBy, "requests", "prompt_tokens", "completion_tokens", "cost", "avg_latency",
+                  "avg_first_token", "estimated")
+        return [dict(zip(fields, row)) for row in rows if row[len(groupBy)]]
+
+    def export(self) -> str:
+        """
+        以Prometheus文本格式导出自启动以来的累计用量
+        :return: str
+        """
+        with self._lock:
+            totals = [(backend, model, dict(total)) for (backend, model), total in self.totals.items()]
+        metrics = [
+            ("client_nlg_requests_total", "NLG queries recorded.", "requests"),
+            ("client_nlg_prompt_tokens_total", "Prompt tokens sent.", "prompt_tokens"),
+            ("client_nlg_completion_tokens_total", "Completion tokens received.", "completion_tokens"),
+            ("client_nlg_cost_total", f"Estimated cost in {self.currency}.", "cost"),
+            ("client_nlg_latency_seconds_total", "Total query latency.", "latency"),
+        ]
+        lines = []
+        for metric, description, field in metrics:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{backend="{backend}",model="{model}"}} {total[field]:g}'
+                      for backend, model, total in totals]
+        return "\n".join(lines) + "\n"
+
+
+def createUsageLedger(Usage_config: dict) -> UsageLedger | None:
+    """
+    根据配置创建UsageLedger
+    :param Usage_config: dict 形如{"enabled": bool, "path": str, "flush_interval": float, "currency": str,
+    "prices": {模型: {"prompt": float, "completion": float}}}的配置，单价为每千token的价格
+    :return: UsageLedger | None 未启用时返回None
+    """
+    if not Usage_config.get("enabled", False):
+        return None
+    return UsageLedger(
+        Usage_config.get("path", "usage.db"),
+        Usage_config.get("flush_interval", 30),
+        Usage_config.get("prices", {}),
+        Usage_config.get("currency", "CNY")
+    )
+
+
+usageLedger = createUsageLedger(Configs.get("Usage", {}))  # 全局单例，未启用时为None
+
+if __name__ == '__main__':
+    raise RuntimeError("This module is not executable!")
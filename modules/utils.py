@@ -1,10 +1,12 @@
 """本文件中声明了一些常用的函数与全局变量，供其他模块使用。"""
 from urllib.parse import urljoin
 from datetime import datetime
-from json import load, dump
+from json import load, dump, dumps, loads
 from enum import Enum
 import os
 import atexit
+import gzip
+import time
 import uuid
 from time import mktime
 from typing import TypedDict, Literal
@@ -12,6 +14,15 @@ from wsgiref.handlers import format_date_time
 
 import requests
 
+try:
+    import msgpack  # 可选，用于以二进制格式(MessagePack)与APIWrapper通讯
+except ImportError:
+    msgpack = None
+try:
+    import zstandard  # 可选，用于以zstd压缩请求体
+except ImportError:
+    zstandard = None
+
 try:
     with open('config.json') as cfg:
         Configs = load(cfg)
@@ -76,6 +87,131 @@ def getRFC1123(time: datetime = None) -> str:
     return format_date_time(mktime(time.timetuple()))
 
 
+def getDeadlineHeader(timeout: float) -> dict[str, str]:
+    """
+    生成携带截止时间的请求头，APIWrapper会据此丢弃客户端已不再等待的请求
+    :param timeout: float 本次请求的超时时间(秒)
+    :return: dict[str, str] 请求头
+    """
+    return {"X-Request-Deadline": str(time.time() + timeout)}
+
+
+def encodeBody(
+        data: dict,
+        serialization: Literal["json", "msgpack"] = "json",
+        compression: Literal["gzip", "zstd"] = None
+) -> tuple[bytes, dict[str, str]]:
+    """
+    按照指定的序列化与压缩方式编码请求体，供远端后端与APIWrapper通讯时使用
+    :param data: dict 请求数据，msgpack模式下允许包含bytes(如音频的原始采样)
+    :param serialization: str 序列化方式，"json"或"msgpack"
+    :param compression: str 压缩方式，"gzip"、"zstd"或None(不压缩)，未安装zstandard时zstd将退化为gzip
+    :return: tuple[bytes, dict[str, str]] 编码后的请求体，以及对应的请求头(含Content-Type、Content-Encoding与Accept)
+    """
+    if serialization == "msgpack":
+        if not msgpack:
+            raise ImportError("Serialization 'msgpack' requires the 'msgpack' package, please install it first.")
+        body, headers = msgpack.packb(data), {"Content-Type": "application/msgpack"}
+    else:
+        body, headers = dumps(data, ensure_ascii=False).encode(), {"Content-Type": "application/json"}
+    if compression == "zstd" and zstandard:
+        body, headers["Content-Encoding"] = zstandard.ZstdCompressor().compress(body), "zstd"
+    elif compression in ("gzip", "zstd"):
+        body, headers["Content-Encoding"] = gzip.compress(body, compresslevel=6), "gzip"
+    headers.update(getAcceptHeader(serialization, compression))
+    return body, headers
+
+
+def getAcceptHeader(
+        serialization: Literal["json", "msgpack"] = "json",
+        compression: Literal["gzip", "zstd"] = None
+) -> dict[str, str]:
+    """
+    生成用于内容协商的Accept与Accept-Encoding请求头
+    :param serialization: str 期望的响应格式，"json"或"msgpack"
+    :param compression: str 期望的压缩方式，"gzip"、"zstd"或None
+    :return: dict[str, str] 请求头
+    """
+    headers = {}
+    if serialization == "msgpack" and msgpack:
+        headers["Accept"] = "application/msgpack, application/json;q=0.9"
+    if compression == "zstd" and zstandard:
+        headers["Accept-Encoding"] = "zstd, gzip;q=0.9"
+    elif compression:
+        headers["Accept-Encoding"] = "gzip"
+    return headers
+
+
+def decodeResponse(response: requests.Response) -> dict:
+    """
+    根据Content-Type解码APIWrapper的响应(Content-Encoding已由requests自动处理)
+    :param response: requests.Response 响应
+    :return: dict 响应数据
+    """
+    if response.headers.get("Content-Type", "").startswith("application/msgpack"):
+        if not msgpack:
+            raise ImportError("Response is encoded with MessagePack, please install 'msgpack' first.")
+        return msgpack.unpackb(response.content)
+    return loads(response.content)
+
+
+class ServiceOverloadedError(ConnectionError):
+    """推理端过载(HTTP 503)，retryAfter为其通过Retry-After头建议的重试间隔(秒)"""
+
+    def __init__(self, message: str, retryAfter: float = None):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+
+def checkResponse(response: requests.Response, allowed: tuple[int, ...] = ()) -> requests.Response:
+    """
+    检查APIWrapper响应的状态码，应在pool.request()与policy.measure()的范围内调用，使主机统计与超时学习能够感知失败
+    :param response: requests.Response 响应
+    :param allowed: tuple[int, ...] 由调用方自行处理的非2xx状态码(如增量历史协议的409)
+    :return: requests.Response 原样返回的响应
+    :raise ServiceOverloadedError: 503，推理端排队已满(ConnectionError的子类，可重试并计入熔断器)
+    :raise TimeoutError: 504，请求在推理端超过了截止时间
+    :raise ConnectionRefusedError: 401/403，secret错误
+    :raise requests.exceptions.HTTPError: 其余非2xx状态码
+    """
+    status = response.status_code
+    if 200 <= status < 300 or status in allowed:
+        return response
+    try:
+        description = decodeResponse(response).get("content", {}).get("description", "")
+    except Exception:
+        description = response.text[:200]
+    message = f"Request to '{response.url}' failed with {status}: {description}"
+    if status == 503:
+        try:
+            retryAfter = float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            retryAfter = None
+        raise ServiceOverloadedError(message, retryAfter)
+    if status == 504:
+        raise TimeoutError(message)
+    if status in (401, 403):
+        raise ConnectionRefusedError(message)
+    raise requests.exceptions.HTTPError(message, response=response)
+
+
+def statusError(status: int, message: str) -> Exception:
+    """
+    将各家API返回的错误状态码转换为对应的异常，使容错层(modules.resilience)能够区分瞬时故障与请求本身的错误
+    :param status: int HTTP状态码
+    :param message: str 异常信息
+    :return: Exception 401/403为ConnectionRefusedError(鉴权失败)，408/504为TimeoutError，429与5xx为ConnectionError
+    (瞬时故障)，其余状态码为ValueError(参数错误等，重试无济于事)
+    """
+    if status in (401, 403):
+        return ConnectionRefusedError(message)
+    if status in (408, 504):
+        return TimeoutError(message)
+    if status == 429 or status >= 500:
+        return ConnectionError(message)
+    return ValueError(message)
+
+
 class Message(TypedDict):
     """按照OpenAI的API格式定义的消息类型，可用于检查消息格式是否正确。"""
     role: Literal["user", "assistant", "system"]
@@ -91,6 +227,7 @@ class NLGEnum(Enum):
     Gemini = 4  # 谷歌 Gemini
     Spark = 5  # 讯飞 星火大模型
     Waltz = 6  # 自部署 Waltz
+    Auto = 7  # 根据延迟、错误率与费用自动选择后端(详见modules.NLG.AutoRouter)
 
 
 class ASREnum(Enum):
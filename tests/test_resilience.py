@@ -0,0 +1,96 @@
+"""ResilientBackend的测试：叠加TracedBackend后流式方法仍被识别为流式，流式调用在首个片段之前重试，提前关闭时归还熔断器的探测名额"""
+import time
+
+import pytest
+
+from modules.resilience import Resilience, ResilientBackend
+from modules.tracing import Tracer, TracedBackend
+from modules.utils import NLGEnum
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class SlowStreamNLG:
+    type = NLGEnum.Waltz
+    model = "fake"
+
+    def streamContinuedQuery(self, message: str, history: list, prompt: str = None):
+        for chunk in ("你", "好", "。"):
+            time.sleep(0.02)
+            yield chunk
+
+    def continuedQuery(self, message: str, history: list, prompt: str = None) -> str:
+        return "".join(self.streamContinuedQuery(message, history, prompt))
+
+
+def makeService():
+    exporter = ListExporter()
+    tracer = Tracer(exporter, flushInterval=3600)
+    return TracedBackend(ResilientBackend(SlowStreamNLG(), Resilience()), tracer, "nlg"), tracer, exporter
+
+
+def test_stream_span_covers_whole_stream():
+    service, tracer, exporter = makeService()
+    assert "".join(service.streamContinuedQuery("hi", [])) == "你好。"
+    tracer.flush()
+    span, = [span for span in exporter.spans if span.name == "nlg.streamContinuedQuery"]
+    assert (span.end - span.start) / 1e6 >= 50
+    assert span.attributes["output_size"] == 3
+    assert "first_chunk_ms" in span.attributes
+
+
+def test_resilient_methods_keep_names():
+    backend = ResilientBackend(SlowStreamNLG(), Resilience())
+    assert backend.streamContinuedQuery.__name__ == "streamContinuedQuery"
+    assert backend.continuedQuery("hi", []) == "你好。"
+
+
+def test_closing_half_open_stream_releases_probe():
+    resilience = Resilience(failureThreshold=1, resetTimeout=0.0)
+    backend = ResilientBackend(SlowStreamNLG(), resilience)
+    breaker = resilience.breaker(resilience.keyOf(backend._backend))
+    breaker.failure()
+    stream = backend.streamContinuedQuery("hi", [])
+    assert next(stream) == "你"
+    assert breaker.state == breaker.HALF_OPEN
+    stream.close()
+    assert breaker.available
+    assert backend.continuedQuery("hi", []) == "你好。"
+    assert breaker.state == breaker.CLOSED
+
+
+class FlakyStreamNLG(SlowStreamNLG):
+    def __init__(self, failures: int, failAfterFirst: bool = False):
+        self.failures = failures
+        self.failAfterFirst = failAfterFirst
+        self.calls = 0
+
+    def streamContinuedQuery(self, message: str, history: list, prompt: str = None):
+        self.calls += 1
+        if self.failAfterFirst:
+            yield "你"
+        if self.calls <= self.failures:
+            raise ConnectionError("connection reset")
+        yield from super().streamContinuedQuery(message, history, prompt)
+
+
+def test_stream_retries_before_first_chunk():
+    backend = FlakyStreamNLG(failures=1)
+    resilient = ResilientBackend(backend, Resilience(baseDelay=0.0))
+    assert "".join(resilient.streamContinuedQuery("hi", [])) == "你好。"
+    assert backend.calls == 2
+
+
+def test_stream_does_not_retry_after_first_chunk():
+    backend = FlakyStreamNLG(failures=1, failAfterFirst=True)
+    stream = ResilientBackend(backend, Resilience(baseDelay=0.0)).streamContinuedQuery("hi", [])
+    assert next(stream) == "你"
+    with pytest.raises(ConnectionError):
+        next(stream)
+    assert backend.calls == 1